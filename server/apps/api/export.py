@@ -0,0 +1,73 @@
+import csv
+import json
+from base64 import b64encode
+from itertools import islice
+from typing import Callable, Dict, Iterator
+
+from rest_framework.fields import DateTimeField
+
+from server.apps.api.serializers import LegalBasisDataWorkspaceSerializer
+from server.apps.main.models import LegalBasisQuerySet
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+CSV_CONTENT_TYPE = "text/csv"
+
+ExportRow = Dict[str, object]
+
+
+def export_rows(queryset: LegalBasisQuerySet, chunk_size: int) -> Iterator[ExportRow]:
+    """
+    Yields each record of a queryset annotated with its consent flags as a
+    dict formatted the same way as LegalBasisDataWorkspaceSerializer.
+
+    Rows are read as values through a server-side cursor, so memory use is
+    bounded by `chunk_size`.
+    """
+    datetime_field = DateTimeField()
+    rows = queryset.values(*LegalBasisDataWorkspaceSerializer.Meta.fields).iterator(
+        chunk_size=chunk_size
+    )
+    for row in rows:
+        row["key"] = b64encode(row["key"]).decode()
+        row["phone"] = str(row["phone"])
+        row["created_at"] = datetime_field.to_representation(row["created_at"])
+        row["modified_at"] = datetime_field.to_representation(row["modified_at"])
+        yield row
+
+
+def _chunked_lines(
+    rows: Iterator[ExportRow], chunk_size: int, format_row: Callable[[ExportRow], str]
+) -> Iterator[str]:
+    # Yield a chunk of lines at a time rather than a line at a time, so the
+    # server isn't asked to write many tiny pieces
+    while True:
+        lines = [format_row(row) for row in islice(rows, chunk_size)]
+        if not lines:
+            return
+        yield "".join(lines)
+
+
+def ndjson_lines(queryset: LegalBasisQuerySet, chunk_size: int) -> Iterator[str]:
+    return _chunked_lines(
+        export_rows(queryset, chunk_size),
+        chunk_size,
+        lambda row: json.dumps(row, separators=(",", ":")) + "\n",
+    )
+
+
+class _Echo:
+    """File-like object that returns what is written to it, for csv.writer"""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def csv_lines(queryset: LegalBasisQuerySet, chunk_size: int) -> Iterator[str]:
+    field_names = LegalBasisDataWorkspaceSerializer.Meta.fields
+    writer = csv.writer(_Echo())
+    yield writer.writerow(field_names)
+    yield from _chunked_lines(
+        export_rows(queryset, chunk_size),
+        chunk_size,
+        lambda row: writer.writerow([row[name] for name in field_names]),
+    )
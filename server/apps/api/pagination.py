@@ -0,0 +1,204 @@
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from cursor_pagination import CursorPaginator, InvalidCursor
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from server.apps.main.counts import (
+    COUNT_CACHED,
+    COUNT_ESTIMATE,
+    COUNT_EXACT,
+    COUNT_MODES,
+    cached_count,
+    estimated_count,
+)
+
+
+class ProtocolLessPaginationMixin:
+    request: Request
+
+    def corrected_protocol_url(self) -> str:
+        url = self.request.build_absolute_uri()
+        if not self.request.is_allow_secure_middleware_active:
+            return url.replace('https://', 'http://')
+        return url
+
+
+class ProtocolLessLimitOffsetPagination(ProtocolLessPaginationMixin, LimitOffsetPagination):
+    """
+    Limit/offset pagination where the total count can be exact (the default),
+    an estimate from the Postgres planner, an exact count cached for a short
+    time, or omitted, chosen with the `count` query parameter.
+
+    Unless the count is exact, the next link is found by fetching one row more
+    than the limit rather than by comparing against the count.
+    """
+
+    count_query_param = 'count'
+
+    def get_count_mode(self, request) -> str:
+        count_mode = request.query_params.get(self.count_query_param)
+        if count_mode in COUNT_MODES:
+            return count_mode
+        return settings.API_PAGINATION_COUNT_MODE
+
+    def get_approximate_count(self, queryset) -> Optional[int]:
+        if self.count_mode == COUNT_ESTIMATE:
+            return estimated_count(queryset)
+        if self.count_mode == COUNT_CACHED:
+            return cached_count(queryset, settings.API_PAGINATION_COUNT_CACHE_TIMEOUT)
+        return None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_mode = self.get_count_mode(request)
+        if self.count_mode == COUNT_EXACT:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.offset = self.get_offset(request)
+
+        page = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(page) > self.limit
+        self.count = self.get_approximate_count(queryset)
+        return page[:self.limit]
+
+    def get_paginated_response(self, data):
+        if self.count_mode == COUNT_EXACT:
+            return super().get_paginated_response(data)
+
+        response = OrderedDict([
+            ('count', self.count),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ])
+        if self.count is None:
+            del response['count']
+        return Response(response)
+
+    def get_next_link(self) -> Optional[str]:
+        if self.count_mode == COUNT_EXACT:
+            if self.offset + self.limit >= self.count:
+                return None
+        elif not self.has_next:
+            return None
+
+        url = self.corrected_protocol_url()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+
+        offset = self.offset + self.limit
+        return replace_query_param(url, self.offset_query_param, offset)
+
+    def get_previous_link(self) -> Optional[str]:
+        if self.offset <= 0:
+            return None
+
+        url = self.corrected_protocol_url()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+
+        if self.offset - self.limit <= 0:
+            return remove_query_param(url, self.offset_query_param)
+
+        offset = self.offset - self.limit
+        return replace_query_param(url, self.offset_query_param, offset)
+
+
+class NonNullCursorPaginator(CursorPaginator):
+    """
+    CursorPaginator for orderings over columns that are never NULL.
+
+    The base class also matches NULLs after the cursor position, and the
+    resulting OR stops Postgres from using the cursor as an index condition, so
+    every page would scan from the start of the index.
+    """
+
+    def apply_cursor(self, cursor, queryset, from_last, reverse=False):
+        position = self.decode_cursor(cursor)
+
+        filtering = Q()
+        q_equality: Dict[str, str] = {}
+        for ordering, value in zip(self.ordering, position):
+            is_reversed = ordering.startswith('-')
+            field = ordering.lstrip('-')
+            lookup = 'lt' if reverse != is_reversed else 'gt'
+            filtering |= Q(**{f'{field}__{lookup}': value}, **q_equality)
+            q_equality[f'{field}__exact'] = value
+
+        return queryset.filter(filtering)
+
+
+class ProtocolLessCursorPagination(ProtocolLessPaginationMixin, BasePagination):
+    """
+    Keyset pagination ordered by id, so late pages cost the same as early ones
+    and no total count is computed
+    """
+
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    default_limit = api_settings.PAGE_SIZE
+    max_limit = 10000
+    ordering = ('id',)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_limit(self, request) -> int:
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.default_limit
+        if limit <= 0:
+            return self.default_limit
+        return min(limit, self.max_limit)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.paginator = NonNullCursorPaginator(queryset, ordering=self.ordering)
+
+        try:
+            self.page = self.paginator.page(
+                first=self.limit,
+                after=request.query_params.get(self.cursor_query_param) or None,
+            )
+        except (InvalidCursor, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        return list(self.page)
+
+    def get_next_link(self) -> Optional[str]:
+        if not self.page.has_next:
+            return None
+
+        url = self.corrected_protocol_url()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+
+        cursor = self.paginator.cursor(self.page[-1])
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                    'format': 'uri',
+                },
+                'results': schema,
+            },
+        }
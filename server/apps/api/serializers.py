@@ -1,16 +1,42 @@
-import types
+import binascii
+from base64 import b64decode
+from hashlib import sha512
+from typing import List, Type
 
 from django.conf import settings
+from django.utils.encoding import smart_str
 from phonenumber_field.serializerfields import PhoneNumberField
 from rest_framework import serializers
 from rest_framework.fields import DateTimeField
 
-from server.apps.main.models import Commit, Consent, LegalBasis
+from server.apps.main.consent_registry import consent_registry
+from server.apps.main.models import (
+    Commit,
+    Consent,
+    LegalBasis,
+    generate_key,
+    generate_lookup_key,
+)
+
+KEY_LENGTH = sha512().digest_size
+
+CONSENT_FLAG_FIELDS = [f"{name}_consent" for name in settings.CONSENT_TYPES]
+
+
+class ConsentNameField(serializers.SlugRelatedField):
+    """Looks consents up by name in the consent registry rather than the database"""
+
+    def to_internal_value(self, data) -> Consent:
+        try:
+            consent = consent_registry.get(str(data))
+        except Consent.DoesNotExist:
+            self.fail("does_not_exist", slug_name=self.slug_field, value=smart_str(data))
+        return consent
 
 
 class LegalBasisSerializer(serializers.ModelSerializer):
 
-    consents = serializers.SlugRelatedField(
+    consents = ConsentNameField(
         many=True,
         allow_null=True,
         allow_empty=True,
@@ -25,35 +51,66 @@ class LegalBasisSerializer(serializers.ModelSerializer):
         depth = 1
 
 
-class LegalBasisDataWorkspaceSerializer(serializers.ModelSerializer):
-    def __init__(self, *args, **kwargs) -> None:
-        """
-        Create {consent_type}_consent field for each Consent type.
-
-        This flattens consent status in the API response, rather than returning
-        nested serialized Consent objects
-        """
-        super(LegalBasisDataWorkspaceSerializer, self).__init__(*args, **kwargs)
+def consent_flags_serializer() -> Type[serializers.Serializer]:
+    """
+    Returns a serializer with a read-only {consent_type}_consent boolean for
+    each consent type in settings, built with type() so the serializer
+    metaclass collects them like fields declared in a class body
+    """
+    return type(
+        "ConsentFlagsSerializer",
+        (serializers.Serializer,),
+        {
+            field_name: serializers.BooleanField(read_only=True)
+            for field_name in CONSENT_FLAG_FIELDS
+        },
+    )
 
-        for name in settings.CONSENT_TYPES:
-            field_name = f"{name}_consent"
-            method_name = f"get_{field_name}"
 
-            def wrapper(name) -> types.MethodType:
-                def inner(self, obj) -> bool:
-                    return name in [c.name for c in obj.consents.all()]
+ConsentFlagsSerializer = consent_flags_serializer()
 
-                return types.MethodType(inner, self)
 
-            setattr(self, method_name, wrapper(name))
+class LegalBasisDataWorkspaceSerializer(ConsentFlagsSerializer, serializers.ModelSerializer):  # type: ignore
+    """
+    Flattens consent status into a {consent_type}_consent boolean for each
+    Consent type, rather than returning nested serialized Consent objects.
 
-            self.fields[field_name] = serializers.SerializerMethodField(
-                method_name=method_name
-            )
+    The flags are read from annotations, so instances must come from a
+    queryset annotated with LegalBasis.objects.with_consent_flags
+    """
 
     class Meta:
         model = LegalBasis
-        exclude = ["consents", "commit"]
+        fields = [
+            "id",
+            "key",
+            "email",
+            "phone",
+            "key_type",
+            "created_at",
+            "modified_at",
+            "current",
+            *CONSENT_FLAG_FIELDS,
+        ]
+
+
+class CreateLegalBasisListSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        """
+        Write every item under a single Commit using LegalBasis.objects.bulk_record
+        """
+        commit = Commit()
+        request = self.context.get("request")
+        if request:
+            commit.source = request.path
+        commit.save()
+
+        records = []
+        for attrs in validated_data:
+            attrs = dict(attrs)
+            consents = attrs.pop("consents", None) or []
+            records.append((LegalBasis(commit=commit, **attrs), consents))
+        return LegalBasis.objects.bulk_record(records)
 
 
 class CreateLegalBasisSerializer(LegalBasisSerializer):
@@ -94,6 +151,7 @@ class CreateLegalBasisSerializer(LegalBasisSerializer):
     class Meta(LegalBasisSerializer.Meta):
         exclude = ["commit", "key", "created_at", "current", "id"]
         read_only = ["key"]
+        list_serializer_class = CreateLegalBasisListSerializer
 
 
 class EmailListField(serializers.ListField):
@@ -102,3 +160,41 @@ class EmailListField(serializers.ListField):
 
 class ListOfEmailsSerializer(serializers.Serializer):
     emails = EmailListField()
+
+
+class BulkLookupSerializer(serializers.Serializer):
+    emails = EmailListField(required=False)
+    phones = serializers.ListField(child=PhoneNumberField(), required=False)
+    keys = serializers.ListField(child=serializers.CharField(), required=False)
+
+    def validate_keys(self, value) -> List[bytes]:
+        """Keys are base64 encoded, as they are in responses"""
+        keys = []
+        for encoded in value:
+            try:
+                key = b64decode(encoded, validate=True)
+            except binascii.Error:
+                key = b""
+            if len(key) != KEY_LENGTH:
+                raise serializers.ValidationError(f"{encoded} is not a valid key")
+            keys.append(key)
+        return keys
+
+    def validate(self, attrs):
+        count = sum(len(values) for values in attrs.values())
+        if not count:
+            raise serializers.ValidationError("One of emails, phones or keys must be supplied")
+        if count > settings.LEGAL_BASIS_BULK_LOOKUP_MAX_ITEMS:
+            raise serializers.ValidationError(
+                f"No more than {settings.LEGAL_BASIS_BULK_LOOKUP_MAX_ITEMS} items can be looked up at once"
+            )
+        return attrs
+
+    def get_keys(self) -> List[bytes]:
+        """The keys for every item, in request order without duplicates"""
+        keys = [
+            *(generate_lookup_key(email) for email in self.validated_data.get("emails", [])),
+            *(generate_key(str(phone)) for phone in self.validated_data.get("phones", [])),
+            *self.validated_data.get("keys", []),
+        ]
+        return list(dict.fromkeys(keys))
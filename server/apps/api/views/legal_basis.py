@@ -1,52 +1,36 @@
-from hashlib import sha512
+from typing import Dict
 
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
+from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
-from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.response import Response
-from rest_framework.utils.urls import remove_query_param, replace_query_param
 
+from server.apps.api.export import (
+    CSV_CONTENT_TYPE,
+    NDJSON_CONTENT_TYPE,
+    csv_lines,
+    ndjson_lines,
+)
+from server.apps.api.pagination import (
+    ProtocolLessCursorPagination,
+    ProtocolLessLimitOffsetPagination,
+)
 from server.apps.api.serializers import (
+    BulkLookupSerializer,
     CreateLegalBasisSerializer,
     LegalBasisDataWorkspaceSerializer,
     LegalBasisSerializer,
     ListOfEmailsSerializer,
 )
-from server.apps.main.models import LegalBasis
-
-
-class ProtocolLessLimitOffsetPagination(LimitOffsetPagination):
-
-    def corrected_protocol_url(self) -> str:
-        url = self.request.build_absolute_uri()
-        if not self.request.is_allow_secure_middleware_active:
-            return url.replace('https://', 'http://')
-        return url
-
-    def get_next_link(self):
-        if self.offset + self.limit >= self.count:
-            return None
-
-        url = self.corrected_protocol_url()
-        url = replace_query_param(url, self.limit_query_param, self.limit)
-
-        offset = self.offset + self.limit
-        return replace_query_param(url, self.offset_query_param, offset)
-
-    def get_previous_link(self):
-        if self.offset <= 0:
-            return None
-
-        url = self.corrected_protocol_url()
-        url = replace_query_param(url, self.limit_query_param, self.limit)
-
-        if self.offset - self.limit <= 0:
-            return remove_query_param(url, self.offset_query_param)
-
-        offset = self.offset - self.limit
-        return replace_query_param(url, self.offset_query_param, offset)
+from server.apps.main.lookup_cache import get_cached_lookup, set_cached_lookup
+from server.apps.main.middleware import send_bulk_create_actions
+from server.apps.main.models import LegalBasis, LegalBasisQuerySet, generate_lookup_key
+from server.apps.main.permissions import LegalBasisLookupPermissions
 
 
 class LegalBasisViewSet(viewsets.ModelViewSet):
@@ -54,7 +38,16 @@ class LegalBasisViewSet(viewsets.ModelViewSet):
     This viewset automatically provides `create`, `list` and `detail` actions.
 
     There is also a `bulk_lookup` endpoint that takes a list of email addresses
-    and returns their consent status.
+    and returns their consent status (POST a body of emails, phones and keys
+    for larger batches), and a `bulk_create` endpoint that takes a
+    list of records and creates them under a single commit.
+
+    List endpoints use limit/offset pagination by default. Passing
+    `pagination=cursor` switches to keyset pagination ordered by id, which
+    should be used to crawl the whole collection.
+
+    `datahub_export.ndjson` and `datahub_export.csv` stream every current
+    record in a single response.
     """
 
     queryset = LegalBasis.objects.prefetch_related("consents").filter(current=True).order_by('id')
@@ -66,26 +59,68 @@ class LegalBasisViewSet(viewsets.ModelViewSet):
     filterset_fields = ["consents__name", "consents", "key_type"]
     http_method_names = ["get", "post", "head"]
     pagination_class = ProtocolLessLimitOffsetPagination
+    cursor_pagination_class = ProtocolLessCursorPagination
+    pagination_query_param = "pagination"
+    bulk_lookup_chunk_size = 1000
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            request = getattr(self, "request", None)
+            if request is not None and request.query_params.get(self.pagination_query_param) == "cursor":
+                self._paginator = self.cursor_pagination_class()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
 
     def get_serializer_class(self):
-        if self.action == "create":
+        if self.action in ["create", "bulk_create"]:
             return self.create_serializer_class
         return super().get_serializer_class()
 
-    def get_object(self):
+    def get_export_queryset(self) -> LegalBasisQuerySet:
+        """Current records with consent flags computed in SQL, for the datahub exports"""
+        return self.queryset.prefetch_related(None).with_consent_flags(settings.CONSENT_TYPES)
+
+    def get_object(self) -> LegalBasis:
         # hash lookup_kwarg here, normalise email here (upper)
 
-        self.kwargs[self.lookup_field] = sha512(
-            self.kwargs[self.lookup_field].lower().encode()
-        ).digest()
+        self.kwargs[self.lookup_field] = generate_lookup_key(self.kwargs[self.lookup_field])
         return super().get_object()
 
+    def retrieve(self, request, *args, **kwargs) -> Response:
+        """
+        Serialised records are cached by key. Query parameters filter the
+        lookup, so requests with any bypass the cache.
+        """
+        if request.query_params:
+            return super().retrieve(request, *args, **kwargs)
+
+        key = generate_lookup_key(self.kwargs[self.lookup_field])
+        data = get_cached_lookup(key)
+        if data is None:
+            data = self.get_serializer(self.get_object()).data
+            set_cached_lookup(key, data)
+        return Response(data)
+
     @swagger_auto_schema(
         method="get",
-        request_body=ListOfEmailsSerializer,
+        manual_parameters=[
+            openapi.Parameter(
+                "email",
+                openapi.IN_QUERY,
+                type=openapi.TYPE_ARRAY,
+                items=openapi.Items(type=openapi.TYPE_STRING),
+                collection_format="multi",
+            ),
+        ],
         responses={status.HTTP_200_OK: LegalBasisSerializer(many=True)},
     )
-    @action(detail=False, methods=["GET"])  # type: ignore
+    @action(  # type: ignore
+        detail=False,
+        methods=["GET"],
+        permission_classes=[LegalBasisLookupPermissions],
+    )
     def bulk_lookup(self, request) -> Response:
         body = ListOfEmailsSerializer(data={'emails': request.GET.getlist("email")})
         if body.is_valid():
@@ -101,6 +136,33 @@ class LegalBasisViewSet(viewsets.ModelViewSet):
 
         return Response(body.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @swagger_auto_schema(
+        request_body=BulkLookupSerializer,
+        responses={status.HTTP_200_OK: LegalBasisSerializer(many=True)},
+    )
+    @bulk_lookup.mapping.post  # type: ignore
+    def bulk_lookup_by_key(self, request) -> Response:
+        """
+        Looks up the current records for the emails, phones and base64 encoded
+        keys in the request body, returned in request order without pagination.
+        Items with no record are left out.
+        """
+        body = BulkLookupSerializer(data=request.data)
+        body.is_valid(raise_exception=True)
+        keys = body.get_keys()
+
+        records: Dict[bytes, LegalBasis] = {}
+        for i in range(0, len(keys), self.bulk_lookup_chunk_size):
+            chunk = keys[i:i + self.bulk_lookup_chunk_size]
+            records.update(
+                (bytes(obj.key), obj) for obj in self.queryset.filter(key__in=chunk)
+            )
+
+        serialized = LegalBasisSerializer(
+            instance=[records[key] for key in keys if key in records], many=True
+        )
+        return Response(serialized.data)
+
     @swagger_auto_schema(
         method="get",
         responses={status.HTTP_200_OK: LegalBasisDataWorkspaceSerializer(many=True)},
@@ -108,13 +170,60 @@ class LegalBasisViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=["GET"])  # type: ignore
     def datahub_export(self, request) -> Response:
         serialized = LegalBasisDataWorkspaceSerializer(
-            instance=self.paginate_queryset(self.queryset), many=True
+            instance=self.paginate_queryset(self.get_export_queryset()), many=True
         )
         return self.get_paginated_response(serialized.data)
 
+    @swagger_auto_schema(
+        method="get",
+        responses={
+            status.HTTP_200_OK: "Every current record, in the datahub_export format, "
+            "as newline delimited JSON or CSV"
+        },
+    )
+    @action(  # type: ignore
+        detail=False,
+        methods=["GET"],
+        url_path=r"datahub_export\.(?P<export_format>ndjson|csv)",
+        url_name="datahub-export-stream",
+    )
+    def datahub_export_stream(self, request, export_format) -> StreamingHttpResponse:
+        chunk_size = settings.DATAHUB_EXPORT_CHUNK_SIZE
+        if export_format == "csv":
+            response = StreamingHttpResponse(
+                csv_lines(self.get_export_queryset(), chunk_size), content_type=CSV_CONTENT_TYPE
+            )
+        else:
+            response = StreamingHttpResponse(
+                ndjson_lines(self.get_export_queryset(), chunk_size), content_type=NDJSON_CONTENT_TYPE
+            )
+        response["Content-Disposition"] = f'attachment; filename="legal-basis.{export_format}"'
+        return response
+
     @swagger_auto_schema(
         request_body=CreateLegalBasisSerializer,
         responses={status.HTTP_200_OK: LegalBasisSerializer},
     )
     def create(self, request, *args, **kwargs):
         return super().create(request, *args, **kwargs)
+
+    @swagger_auto_schema(
+        method="post",
+        request_body=CreateLegalBasisSerializer(many=True),
+        responses={status.HTTP_201_CREATED: LegalBasisSerializer(many=True)},
+    )
+    @action(detail=False, methods=["POST"])  # type: ignore
+    def bulk_create(self, request) -> Response:
+        serializer = self.get_serializer(
+            data=request.data,
+            many=True,
+            max_length=settings.LEGAL_BASIS_BULK_CREATE_MAX_ITEMS,
+        )
+        serializer.is_valid(raise_exception=True)
+        instances = serializer.save()
+
+        prefetch_related_objects(instances, "consents")
+        send_bulk_create_actions(instances)
+
+        serialized = LegalBasisSerializer(instance=instances, many=True)
+        return Response(serialized.data, status=status.HTTP_201_CREATED)
@@ -4,6 +4,7 @@ from django.contrib import admin
 from django.http import HttpRequest, HttpResponse
 from rest_framework.authtoken.admin import TokenAdmin
 
+from server.apps.main.consent_registry import consent_registry
 from server.apps.main.models import Commit, Consent, LegalBasis, LegalBasisCurrent
 
 
@@ -16,7 +17,7 @@ class LegalBasisAdmin(admin.ModelAdmin):
     actions = ["export_as_csv"]
 
     def export_as_csv(self, request, queryset):
-        consent_types = list(Consent.objects.all().values_list("name", flat=True))
+        consent_types = consent_registry.names()
         meta = self.model._meta
         field_names = [field.name for field in meta.fields]
 
@@ -0,0 +1,127 @@
+from contextvars import ContextVar
+from typing import List, NamedTuple, Optional
+
+import structlog
+from actstream.models import Action
+from actstream.registry import check
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction
+from django.http import HttpRequest
+from django.utils.timezone import now
+
+logger = structlog.get_logger(__name__)
+
+
+def build_action(
+    actor: models.Model,
+    verb: str,
+    action_object: Optional[models.Model] = None,
+    target: Optional[models.Model] = None,
+    **data: object,
+) -> Action:
+    """
+    Returns an unsaved Action with the same fields action.send would save.
+
+    Only the content type and pk of the action object and target are used, so
+    an unsaved instance with just its pk set is enough to refer to a row.
+    """
+    new_action = Action(
+        actor_content_type=ContentType.objects.get_for_model(actor),
+        actor_object_id=actor.pk,
+        verb=verb,
+        public=True,
+        timestamp=now(),
+    )
+    for name, obj in (("target", target), ("action_object", action_object)):
+        if obj is not None:
+            check(obj)
+            setattr(new_action, f"{name}_object_id", obj.pk)
+            setattr(new_action, f"{name}_content_type", ContentType.objects.get_for_model(obj))
+    if data:
+        new_action.data = data
+    return new_action
+
+
+class AuditBuffer:
+    """
+    Collects the actions for a request so they can be written with a single
+    bulk_create once the request has been handled
+    """
+
+    def __init__(self) -> None:
+        self.actions: List[Action] = []
+
+    def add(
+        self,
+        actor: models.Model,
+        verb: str,
+        action_object: Optional[models.Model] = None,
+        target: Optional[models.Model] = None,
+        **data: object,
+    ) -> None:
+        self.actions.append(build_action(actor, verb, action_object, target, **data))
+
+    def flush(self) -> None:
+        if not self.actions:
+            return
+
+        actions, self.actions = self.actions, []
+        Action.objects.bulk_create(actions)
+        logger.info(f"{len(actions)} actions written")
+
+    def flush_on_commit(self) -> None:
+        """
+        Writes the actions once the changes they describe have been committed.
+
+        Outside a transaction they are written straight away. A failure to write
+        them is logged rather than raised, so it can't replace the response or
+        an exception raised while handling the request.
+        """
+        if self.actions:
+            transaction.on_commit(self._flush_or_log)
+
+    def _flush_or_log(self) -> None:
+        count = len(self.actions)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception(f"{count} actions could not be written")
+
+
+class AuditContext(NamedTuple):
+    request: HttpRequest
+    remote_addr: Optional[str]
+    buffer: AuditBuffer
+
+
+# Set by AuditLogMiddleware for the request being handled. Each thread and task
+# has its own value, so concurrent requests don't see each other's changes.
+current_audit: ContextVar[Optional[AuditContext]] = ContextVar("current_audit", default=None)
+
+
+def record_action(
+    verb: str,
+    action_object: Optional[models.Model] = None,
+    target: Optional[models.Model] = None,
+) -> None:
+    """
+    Adds an action by the user of the current request to its AuditBuffer.
+
+    Changes made outside a request, or by an anonymous user, aren't recorded.
+    """
+    context = current_audit.get()
+    if context is None:
+        return
+
+    user = context.request.user
+    if not isinstance(user, models.Model):
+        return
+
+    context.buffer.add(
+        actor=user,
+        verb=verb,
+        action_object=action_object,
+        target=target,
+        remote_addr=context.remote_addr,
+    )
+    logger.info(f"Action recorded: {verb} {action_object} {target or ''}".rstrip())
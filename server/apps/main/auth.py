@@ -1,7 +1,9 @@
 import logging
+import tempfile
+from typing import IO, Iterator
 
-from django.contrib.auth import get_user_model
-from django.core.cache import cache
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.utils.deprecation import MiddlewareMixin
 from mohawk import Receiver
 from mohawk.exc import HawkFail
@@ -9,8 +11,16 @@ from rest_framework.authentication import BaseAuthentication
 from rest_framework.authtoken.models import Token
 from rest_framework.exceptions import AuthenticationFailed
 
+from server.apps.main.credentials import credential_cache
+from server.apps.main.nonces import get_nonce_store
+
 logger = logging.getLogger(__name__)
 
+# Sent by clients that want responses signed without a payload hash
+SKIP_PAYLOAD_HASH_HEADER = 'X-Hawk-Skip-Payload-Hash'
+
+SPOOL_BLOCK_SIZE = 64 * 1024
+
 
 class HawkUserAuthentication(BaseAuthentication):
     """
@@ -41,17 +51,24 @@ class HawkUserAuthentication(BaseAuthentication):
             logger.warning('Failed authentication {e}'.format(e=e))
             raise AuthenticationFailed('Incorrect authentication credentials.')
 
-        user = get_user_model().objects.get(username=hawk_receiver.parsed_header['id'])
-        return user, hawk_receiver
+        return hawk_receiver.resource.credentials['user'], hawk_receiver
 
     @staticmethod
     def _lookup_credentials(username):
         """
         Raises a HawkFail if the passed token does not exist as a username
+
+        The user is returned with the credentials, so the request is
+        authenticated as the user the credentials were found for
         """
         try:
-            token = Token.objects.get(user__username=username)
-            return {'id': username, 'key': token.key, 'algorithm': 'sha256'}
+            credentials = credential_cache.get(username)
+            return {
+                'id': username,
+                'key': credentials.key,
+                'algorithm': 'sha256',
+                'user': credentials.user,
+            }
         except Token.DoesNotExist:
             logger.warning('Provided token does not exist %s', username)
             raise HawkFail(f'No Hawk ID of {username}')
@@ -61,15 +78,12 @@ class HawkUserAuthentication(BaseAuthentication):
         """
         Returns true if the passed access_key_id/nonce combination has been used within 120 seconds
         """
-        cache_key = f'legal-basis:{token}:{nonce}'
-        seen_cache_key = not cache.add(
-            cache_key, True, timeout=120,
-        )
+        seen = get_nonce_store().seen(token, nonce)
 
-        if seen_cache_key:
+        if seen:
             logger.warning('Already seen nonce {nonce}'.format(nonce=nonce))
 
-        return seen_cache_key
+        return seen
 
     def _authorise(self, request) -> Receiver:
         """Raises a HawkFail if the passed request cannot be authenticated"""
@@ -85,13 +99,51 @@ class HawkUserAuthentication(BaseAuthentication):
         )
 
 
+def spool_streaming_content(response: StreamingHttpResponse) -> IO[bytes]:
+    """
+    Reads a streaming response's body into a temporary file, which is kept in
+    memory up to HAWK_RESPONSE_SPOOL_MAX_MEMORY bytes and on disk after that
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=settings.HAWK_RESPONSE_SPOOL_MAX_MEMORY)
+    for chunk in response:
+        body.write(chunk)
+    body.seek(0)
+    return body
+
+
+def read_spooled_content(body: IO[bytes]) -> Iterator[bytes]:
+    with body:
+        body.seek(0)
+        yield from iter(lambda: body.read(SPOOL_BLOCK_SIZE), b'')
+
+
 class HawkResponseMiddleware(MiddlewareMixin):
     """
     Adds Hawk Server-Authorization header to the response
+
+    Clients can send the X-Hawk-Skip-Payload-Hash header to have the response
+    signed without a payload hash, so a streaming response is sent as it is
+    generated. Otherwise the body of a streaming response is spooled to a
+    temporary file, which mohawk hashes a block at a time, and then streamed
+    from the file, so it is never held in memory as a whole.
     """
 
     def process_response(self, request, response):
-        if getattr(request, 'auth', None) is not None:
+        if getattr(request, 'auth', None) is None:
+            return response
+
+        if request.headers.get(SKIP_PAYLOAD_HASH_HEADER, '').lower() in ('1', 'true'):
+            response['Server-Authorization'] = request.auth.respond(
+                always_hash_content=False,
+            )
+        elif response.streaming:
+            body = spool_streaming_content(response)
+            response['Server-Authorization'] = request.auth.respond(
+                content=body,
+                content_type=response['Content-Type'],
+            )
+            response.streaming_content = read_spooled_content(body)
+        else:
             response['Server-Authorization'] = request.auth.respond(
                 content=response.content,
                 content_type=response['Content-Type'],
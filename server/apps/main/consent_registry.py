@@ -0,0 +1,78 @@
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from server.apps.main.models import Consent
+
+VERSION_CACHE_KEY = "legal-basis:consents:version"
+
+Catalogue = Dict[str, Consent]
+
+
+class ConsentRegistry:
+    """
+    Process-local catalogue of Consent rows, looked up by name.
+
+    Consents almost never change, so they are loaded once and kept until the
+    version stored in the shared cache changes. Saving or deleting a Consent
+    bumps that version, and the other processes notice within
+    CONSENT_REGISTRY_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self) -> None:
+        self._catalogue: Optional[Catalogue] = None
+        self._version: Optional[str] = None
+        self._checked_at = 0.0
+
+    def _get_catalogue(self) -> Catalogue:
+        now = time.monotonic()
+        checked_recently = now - self._checked_at < settings.CONSENT_REGISTRY_CHECK_INTERVAL
+        if self._catalogue is not None and checked_recently:
+            return self._catalogue
+
+        version = cache.get(VERSION_CACHE_KEY)
+        if self._catalogue is None or version != self._version:
+            self._catalogue = {consent.name: consent for consent in Consent.objects.all()}
+            self._version = version
+        self._checked_at = now
+        return self._catalogue
+
+    def get(self, name: str) -> Consent:
+        """Raises Consent.DoesNotExist if there is no consent with the name"""
+        try:
+            return self._get_catalogue()[name]
+        except KeyError:
+            raise Consent.DoesNotExist(f"No consent named {name}")
+
+    def get_or_create(self, name: str) -> Consent:
+        try:
+            return self.get(name)
+        except Consent.DoesNotExist:
+            consent, _ = Consent.objects.get_or_create(name=name)
+            return consent
+
+    def names(self) -> List[str]:
+        return list(self._get_catalogue())
+
+    def clear(self) -> None:
+        """Forgets the loaded consents, so the next lookup reloads them"""
+        self._catalogue = None
+
+    def invalidate(self) -> None:
+        """
+        Makes every process reload its consents, once the current transaction
+        has committed
+        """
+        self.clear()
+        transaction.on_commit(self._bump_version)
+
+    def _bump_version(self) -> None:
+        self.clear()
+        cache.set(VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+
+
+consent_registry = ConsentRegistry()
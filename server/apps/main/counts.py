@@ -0,0 +1,37 @@
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.db.models import QuerySet
+
+COUNT_EXACT = "exact"
+COUNT_ESTIMATE = "estimate"
+COUNT_CACHED = "cached"
+COUNT_NONE = "none"
+COUNT_MODES = (COUNT_EXACT, COUNT_ESTIMATE, COUNT_CACHED, COUNT_NONE)
+
+
+def estimated_count(queryset: QuerySet) -> int:
+    """
+    Returns the Postgres planner's row estimate for the queryset.
+
+    This is read from the table statistics rather than by scanning the rows,
+    so it is cheap on large tables but only as accurate as the last ANALYZE.
+    """
+    plan = json.loads(queryset.explain(format="json"))
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def cached_count(queryset: QuerySet, timeout: int) -> int:
+    """
+    Returns the exact row count for the queryset, cached for `timeout` seconds
+    under a key derived from its SQL
+    """
+    query_hash = hashlib.sha256(str(queryset.query).encode()).hexdigest()
+    cache_key = f"legal-basis:count:{query_hash}"
+
+    count = cache.get(cache_key)
+    if count is None:
+        count = queryset.count()
+        cache.set(cache_key, count, timeout)
+    return count
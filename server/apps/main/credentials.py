@@ -0,0 +1,83 @@
+import copy
+import time
+import uuid
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+VERSION_CACHE_KEY = "legal-basis:hawk-credentials:version"
+CREDENTIALS_CACHE_PREFIX = "legal-basis:hawk-credentials"
+
+
+class HawkCredentials(NamedTuple):
+    key: str
+    user: User
+
+
+class CredentialCache:
+    """
+    Caches the Hawk key and user for each Hawk id, with the user's permissions
+    already loaded, so warm clients are authenticated without any queries.
+
+    Credentials are kept in this process for HAWK_CREDENTIALS_LOCAL_CACHE_TIMEOUT
+    seconds and in the shared cache for HAWK_CREDENTIALS_CACHE_TIMEOUT seconds.
+    Any change to tokens, users, groups or permissions changes the version
+    stored in the shared cache, which makes the shared entries stale.
+    """
+
+    def __init__(self) -> None:
+        self._local: Dict[str, Tuple[float, HawkCredentials]] = {}
+
+    def get(self, hawk_id: str) -> HawkCredentials:
+        """Raises Token.DoesNotExist if the Hawk id has no token"""
+        now = time.monotonic()
+        expires_at, credentials = self._local.get(hawk_id, (0.0, None))
+        if credentials is None or expires_at <= now:
+            credentials = self._get_shared(hawk_id)
+            self._local[hawk_id] = (now + settings.HAWK_CREDENTIALS_LOCAL_CACHE_TIMEOUT, credentials)
+
+        # Each request gets its own user, as the cached one is shared
+        return credentials._replace(user=copy.copy(credentials.user))
+
+    def _get_shared(self, hawk_id: str) -> HawkCredentials:
+        cache_key = f"{CREDENTIALS_CACHE_PREFIX}:{hawk_id}"
+        cached = cache.get_many([VERSION_CACHE_KEY, cache_key])
+        version: Optional[str] = cached.get(VERSION_CACHE_KEY)
+        entry_version, credentials = cached.get(cache_key, (None, None))
+        if credentials is not None and entry_version == version:
+            return credentials
+
+        token = Token.objects.select_related("user").get(user__username=hawk_id)
+        user = token.user
+        # Loads the permissions into the user's permission caches, which are
+        # cached with it
+        user.get_all_permissions()
+        credentials = HawkCredentials(key=token.key, user=user)
+        cache.set(cache_key, (version, credentials), settings.HAWK_CREDENTIALS_CACHE_TIMEOUT)
+        return credentials
+
+    def clear(self) -> None:
+        """Forgets the credentials held by this process"""
+        self._local = {}
+
+    def invalidate(self) -> None:
+        """
+        Makes every process reload credentials.
+
+        The version is changed straight away and again once the current
+        transaction commits, so credentials loaded before the commit aren't
+        kept.
+        """
+        self._bump_version()
+        transaction.on_commit(self._bump_version)
+
+    def _bump_version(self) -> None:
+        self.clear()
+        cache.set(VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+
+
+credential_cache = CredentialCache()
@@ -1,25 +1,69 @@
+import hashlib
 import json
-from typing import Dict, List
+from datetime import timedelta
+from typing import Dict, List, NamedTuple, Optional
+from urllib.parse import urlencode
 
 from actstream.feeds import ModelJSONActivityFeed
 from actstream.models import Action
 from cursor_pagination import CursorPaginator
+from django.conf import settings
 from django.contrib.auth import authenticate, login
+from django.core.cache import cache
+from django.db.models import QuerySet
 from django.http import HttpRequest, HttpResponse, HttpResponseForbidden
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.timezone import now
 from django.utils.feedgenerator import rfc3339_date
+from django.utils.http import quote_etag
 from mohawk.exc import InvalidCredentials
 from rest_framework.exceptions import AuthenticationFailed
 
+from server.apps.main.counts import (
+    COUNT_CACHED,
+    COUNT_ESTIMATE,
+    COUNT_EXACT,
+    COUNT_MODES,
+    cached_count,
+    estimated_count,
+)
+
+FEED_PAGE_CACHE_PREFIX = "legal-basis:feed-page:v2"
+
+
+class FeedPage(NamedTuple):
+    # JSON array of the formatted actions
+    ordered_items: bytes
+    next_cursor: Optional[str]
+    # Weak, as totalItems can change while the page's items don't
+    etag: str
+
 
 class W3CModelJSONActivityFeed(ModelJSONActivityFeed):
     """
     Returns JSON activity stream as per W3C Activity Stream 2.0 spec,
     with cursor-based pagination
+
+    The `page_size` query parameter sets the number of items per page, up to
+    ACTIVITY_FEED_MAX_PAGE_SIZE. The `count` query parameter chooses how
+    totalItems is found: exact, an estimate from the Postgres planner, an exact
+    count cached for a short time, or "none" to leave it out.
+
+    Pages behind the head of the feed only hold actions older than their
+    cursor, so once they have a next page they only change if an action is
+    committed after its timestamp, which audit buffers and poller pages do.
+    Once their newest action is ACTIVITY_FEED_PAGE_SETTLE_TIME seconds old,
+    they are cached already encoded.
+
+    Every page has an ETag from its items and next cursor, so a conditional
+    request is answered before totalItems is counted.
     """
 
     raise_exception = True
     id_prefix = ["dit", "ConsentAPI"]
+    page_size_query_param = "page_size"
+    count_query_param = "count"
 
     def get_action_id(self, parts: List) -> str:
         """
@@ -64,31 +108,105 @@ class W3CModelJSONActivityFeed(ModelJSONActivityFeed):
             "name": str(obj),
         }
 
-    def serialize(self, request: HttpRequest, *args, **kwargs) -> str:
+    def items(self, request: HttpRequest, *args, **kwargs) -> QuerySet:
         """
-        Serialize activity stream to JSON, and handle pagination
+        Returns the actions for the content type, with the actors, action
+        objects and targets of each page fetched in one query per content type.
+
+        actstream does this itself unless its FETCH_RELATIONS setting is off,
+        but without it each action costs up to three more queries.
         """
-        items = self.items(request, *args, **kwargs)
+        return (
+            super()
+            .items(request, *args, **kwargs)
+            .prefetch_related("actor", "action_object", "target")
+        )
+
+    def get_page_size(self, request: HttpRequest) -> int:
+        try:
+            page_size = int(request.GET[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return settings.ACTIVITY_FEED_PAGE_SIZE
+        if page_size < 1:
+            return settings.ACTIVITY_FEED_PAGE_SIZE
+        return min(page_size, settings.ACTIVITY_FEED_MAX_PAGE_SIZE)
+
+    def get_count_mode(self, request: HttpRequest) -> str:
+        count_mode = request.GET.get(self.count_query_param)
+        if count_mode in COUNT_MODES:
+            return count_mode
+        return settings.ACTIVITY_FEED_COUNT_MODE
+
+    def get_total_items(self, items: QuerySet, count_mode: str) -> Optional[int]:
+        if count_mode == COUNT_EXACT:
+            return items.count()
+        if count_mode == COUNT_ESTIMATE:
+            return estimated_count(items)
+        if count_mode == COUNT_CACHED:
+            return cached_count(items, settings.ACTIVITY_FEED_COUNT_CACHE_TIMEOUT)
+        return None
+
+    def get_page(
+        self, request: HttpRequest, items: QuerySet, page_size: int, content_type_id: int,
+    ) -> FeedPage:
+        cursor = request.GET.get("cursor")
+        cache_key = f"{FEED_PAGE_CACHE_PREFIX}:{content_type_id}:{page_size}:{cursor}"
+        if cursor is not None:
+            cached_page = cache.get(cache_key)
+            if cached_page is not None:
+                return cached_page
 
-        page_size = 10
         paginator = CursorPaginator(items, ordering=("-timestamp", "-id"))
-        page = paginator.page(first=page_size, after=request.GET.get("cursor"))
+        page = paginator.page(first=page_size, after=cursor)
+        ordered_items = json.dumps([self.format(item) for item in page]).encode()
+        next_cursor = paginator.cursor(page[-1]) if page.has_next else None
+        feed_page = FeedPage(
+            ordered_items=ordered_items,
+            next_cursor=next_cursor,
+            etag="W/" + quote_etag(
+                hashlib.sha256(ordered_items + (next_cursor or "").encode()).hexdigest()
+            ),
+        )
 
-        response = {
+        settled_at = now() - timedelta(seconds=settings.ACTIVITY_FEED_PAGE_SETTLE_TIME)
+        if cursor is not None and next_cursor is not None and page[0].timestamp <= settled_at:
+            cache.set(cache_key, feed_page, settings.ACTIVITY_FEED_PAGE_CACHE_TIMEOUT)
+        return feed_page
+
+    def serialize(self, request: HttpRequest, items: QuerySet, page: FeedPage, **kwargs) -> bytes:
+        """
+        Serialize activity stream to JSON, and handle pagination
+        """
+        response: Dict[str, object] = {
             "@context": [
                 "https://www.w3.org/ns/activitystreams",
                 {"dit": "https://www.trade.gov.uk/ns/activitystreams/v1"},
             ],
             "type": "Collection",
-            "totalItems": items.count(),
-            "orderedItems": [self.format(item) for item in page],
+            "totalItems": self.get_total_items(items, self.get_count_mode(request)),
         }
+        if response["totalItems"] is None:
+            del response["totalItems"]
 
-        if page.has_next:
+        if page.next_cursor is not None:
             url = reverse("actstream_model_feed_json", kwargs=kwargs)
-            response["next"] = f"{url}?cursor={paginator.cursor(page[-1])}"
-
-        return json.dumps(response, indent=4 if "pretty" in request.GET else None)
+            # The next page is fetched with the same page size and count mode
+            params = {
+                name: request.GET[name]
+                for name in (self.page_size_query_param, self.count_query_param)
+                if name in request.GET
+            }
+            params["cursor"] = page.next_cursor
+            response["next"] = f"{url}?{urlencode(params)}"
+
+        if "pretty" in request.GET:
+            response["orderedItems"] = json.loads(page.ordered_items)
+            return json.dumps(response, indent=4).encode()
+
+        # The items are already encoded, so they are added as the last member
+        # of the encoded object
+        encoded = json.dumps(response).encode()
+        return encoded[:-1] + b', "orderedItems": ' + page.ordered_items + b"}"
 
     def dispatch(self, request: HttpRequest, *args, **kwargs) -> HttpResponse:
         """
@@ -109,6 +227,17 @@ class W3CModelJSONActivityFeed(ModelJSONActivityFeed):
             if user is not None:
                 login(request, user)
 
-        return HttpResponse(
-            self.serialize(request, *args, **kwargs), content_type="application/json"
+        items = self.items(request, *args, **kwargs)
+        page = self.get_page(
+            request, items, self.get_page_size(request), kwargs["content_type_id"]
+        )
+        not_modified = get_conditional_response(request, etag=page.etag)
+        if not_modified is not None:
+            not_modified["ETag"] = page.etag
+            return not_modified
+
+        response = HttpResponse(
+            self.serialize(request, items, page, **kwargs), content_type="application/json"
         )
+        response["ETag"] = page.etag
+        return response
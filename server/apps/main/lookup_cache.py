@@ -0,0 +1,48 @@
+from typing import Dict, Iterable, Optional
+
+import structlog
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from elasticapm.traces import get_transaction_id, label
+
+logger = structlog.get_logger(__name__)
+
+LOOKUP_CACHE_PREFIX = "legal-basis:lookup"
+
+
+def lookup_cache_key(key: bytes) -> str:
+    return f"{LOOKUP_CACHE_PREFIX}:{bytes(key).hex()}"
+
+
+def get_cached_lookup(key: bytes) -> Optional[Dict]:
+    """
+    Returns the cached serialised current record for the key, if there is one,
+    and records whether the lookup was a cache hit
+    """
+    data = cache.get(lookup_cache_key(key))
+    outcome = "miss" if data is None else "hit"
+    if get_transaction_id():  # type: ignore
+        label(legal_basis_lookup_cache=outcome)
+    logger.debug(f"Legal basis lookup cache {outcome}")
+    return data
+
+
+def set_cached_lookup(key: bytes, data: Dict) -> None:
+    cache.set(lookup_cache_key(key), data, settings.LEGAL_BASIS_LOOKUP_CACHE_TIMEOUT)
+
+
+def invalidate_lookups(keys: Iterable[bytes], using: Optional[str] = None) -> None:
+    """
+    Removes the cached records for the given keys.
+
+    They are removed straight away and again once the surrounding transaction
+    commits, so a lookup made before the commit can't leave a stale record in
+    the cache.
+    """
+    cache_keys = [lookup_cache_key(key) for key in keys]
+    if not cache_keys:
+        return
+
+    cache.delete_many(cache_keys)
+    transaction.on_commit(lambda: cache.delete_many(cache_keys), using=using)
@@ -1,12 +1,13 @@
 import argparse
+from typing import List, Optional, Tuple
 
 import tablib
 from dateutil.parser import parse
-from django.utils.functional import cached_property
 from django.utils.timezone import now
 from django_tqdm import BaseCommand
 from str2bool import str2bool
 
+from server.apps.main.consent_registry import consent_registry
 from server.apps.main.models import KEY_TYPE, Commit, Consent, LegalBasis
 
 
@@ -23,15 +24,21 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("csv", type=argparse.FileType("r"))
+        parser.add_argument(
+            "--batch-size",
+            action="store",
+            type=int,
+            help="How many rows to write per batch, default: 1000",
+            default=1000,
+        )
 
-    @cached_property
+    @property
     def email_consent(self):
-        email_consent, _ = Consent.objects.get_or_create(name="email_marketing")
-        return email_consent
+        return consent_registry.get_or_create("email_marketing")
 
-    def _update_email_consent(
+    def _email_consent_record(
         self, commit, email_address, email_contact_consent, modified_at
-    ) -> None:
+    ) -> Optional[Tuple[LegalBasis, List[Consent]]]:
         if email_address:
             obj: LegalBasis = LegalBasis(
                 email=email_address,
@@ -39,11 +46,8 @@ class Command(BaseCommand):
                 key_type=KEY_TYPE.EMAIL,
                 modified_at=modified_at,
             )
-            obj.save()
-            if email_contact_consent:
-                obj.consents.add(self.email_consent)
-            else:
-                obj.consents.remove(self.email_consent)
+            return obj, [self.email_consent] if email_contact_consent else []
+        return None
 
     def handle(self, *args, **options):
         input_csv = options["csv"]
@@ -56,12 +60,21 @@ class Command(BaseCommand):
 
         commit.source = "management command: import_email_consent"
         commit.save()
+        batch_size = options["batch_size"]
         with self.tqdm(total=row_count) as progress_bar:
-            for row in dataset.dict:
-                self._update_email_consent(
-                    commit,
-                    row["email"],
-                    str2bool(row["accepts_dit_email_marketing"]),
-                    parse(row["modified_at"]),
+            rows = dataset.dict
+            for start in range(0, row_count, batch_size):
+                batch = rows[start:start + batch_size]
+                records = [
+                    self._email_consent_record(
+                        commit,
+                        row["email"],
+                        str2bool(row["accepts_dit_email_marketing"]),
+                        parse(row["modified_at"]),
+                    )
+                    for row in batch
+                ]
+                LegalBasis.objects.bulk_record(
+                    [record for record in records if record is not None]
                 )
-                progress_bar.update(1)
+                progress_bar.update(len(batch))
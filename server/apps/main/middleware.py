@@ -1,142 +1,64 @@
-import structlog
 import re
-import uuid
-from typing import Callable, Dict, List, Optional
+from typing import Iterable, Optional
 
-from actstream import action
 from django.conf import settings
-from django.db.models import Model
-from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.http import HttpRequest, HttpResponse
 
-from server.apps.main.models import Consent, LegalBasis
-
-logger = structlog.get_logger(__name__)
+from server.apps.main.audit import (
+    AuditBuffer,
+    AuditContext,
+    current_audit,
+    record_action,
+)
+from server.apps.main.models import LegalBasis
 
 
 class AuditLogMiddleware:
+    """
+    Records an action for every change made to a LegalBasis during a request.
+
+    The receivers in signals.py are connected once, and record actions against
+    the request set here in `current_audit`. The actions are collected in an
+    AuditBuffer and written with a single bulk_create once the request's changes
+    have been committed.
+    """
+
     def __init__(self, get_response) -> None:
         self.get_response = get_response
 
     def __call__(self, request) -> HttpResponse:
-
-        signal_calls = self.get_signal_calls(request)
-
-        for call in signal_calls:
-            call["signal"].connect(weak=False, **call["kwargs"])
-
-        response = self.get_response(request)
-
-        for call in signal_calls:
-            call["signal"].disconnect(**call["kwargs"])
-
-        return response
-
-    def get_signal_calls(self, request: HttpRequest) -> List[Dict]:
-        return [
-            {
-                "signal": post_save,
-                "kwargs": {
-                    "sender": LegalBasis,
-                    "receiver": self.make_save_signal_receiver(request),
-                    "dispatch_uid": uuid.uuid4(),
-                },
-            },
-            {
-                "signal": post_delete,
-                "kwargs": {
-                    "sender": LegalBasis,
-                    "receiver": self.make_delete_signal_receiver(request),
-                    "dispatch_uid": uuid.uuid4(),
-                },
-            },
-            {
-                "signal": m2m_changed,
-                "kwargs": {
-                    "sender": LegalBasis.consents.through,
-                    "receiver": self.make_m2m_signal_receiver(request),
-                    "dispatch_uid": uuid.uuid4(),
-                },
-            },
-        ]
-
-    def make_m2m_signal_receiver(self, request: HttpRequest) -> Callable:
-        def inner(sender: Model, **kwargs) -> None:
-            action_kwargs = {
-                "sender": request.user,
-                "remote_addr": self.get_remote_addr(request),
-            }
-
-            if kwargs["action"] in ["post_add", "post_remove"]:
-                self.handle_m2m_post_add_remove_actions(
-                    instance=kwargs["instance"],
-                    action_kwargs=action_kwargs,
-                    action_name=kwargs["action"],
-                    pk_set=kwargs["pk_set"],
-                )
-
-            if kwargs["action"] == "post_clear":
-                self.handle_m2m_post_clear_action(
-                    instance=kwargs["instance"], action_kwargs=action_kwargs
-                )
-
-        return inner
-
-    def handle_m2m_post_add_remove_actions(
-        self, instance: Model, action_kwargs: Dict, action_name: str, pk_set: List
-    ) -> None:
-        for pk in pk_set:
-            action_kwargs["verb"] = "Add" if action_name == "post_add" else "Remove"
-            action_kwargs["action_object"] = Consent.objects.get(pk=pk)
-            action_kwargs["target"] = instance
-
-            action.send(**action_kwargs)
-            logger.info(f"Action sent: {action_kwargs}")
-
-    def handle_m2m_post_clear_action(
-        self, instance: Model, action_kwargs: Dict
-    ) -> None:
-        action_kwargs["verb"] = "Update"
-        action_kwargs["action_object"] = instance
-
-        action.send(**action_kwargs)
-        logger.info(f"Action sent: {action_kwargs}")
-
-    def make_save_signal_receiver(self, request: HttpRequest) -> Callable:
-        def inner(sender: Model, **kwargs) -> None:
-            action_kwargs = {
-                "sender": request.user,
-                "action_object": kwargs["instance"],
-                "verb": "Create" if kwargs.get("created") is True else "Update",
-                "remote_addr": self.get_remote_addr(request),
-            }
-
-            action.send(**action_kwargs)
-            logger.info(f"Action sent: {action_kwargs}")
-
-        return inner
-
-    def make_delete_signal_receiver(self, request: HttpRequest) -> Callable:
-        def inner(sender: Model, **kwargs) -> None:
-            action_kwargs = {
-                "sender": request.user,
-                "action_object": kwargs["instance"],
-                "verb": "Delete",
-                "remote_addr": self.get_remote_addr(request),
-            }
-
-            action.send(**action_kwargs)
-            logger.info(f"Action sent: {action_kwargs}")
-
-        return inner
-
-    def get_remote_addr(self, request: HttpRequest) -> Optional[str]:
+        buffer = AuditBuffer()
+        token = current_audit.set(
+            AuditContext(request, self.get_remote_addr(request), buffer)
+        )
+
+        try:
+            return self.get_response(request)
+        finally:
+            current_audit.reset(token)
+            buffer.flush_on_commit()
+
+    @staticmethod
+    def get_remote_addr(request: HttpRequest) -> Optional[str]:
         remote_addr = request.META.get("HTTP_X_FORWARDED_FOR")
         if remote_addr is not None:
             return remote_addr.split(",")[0]
         return request.META.get("REMOTE_ADDR")
 
 
+def send_bulk_create_actions(instances: Iterable[LegalBasis]) -> None:
+    """
+    Records the actions that the audit receivers would record for each instance.
+
+    Rows written with bulk_create don't send post_save or m2m_changed signals,
+    so callers using LegalBasis.objects.bulk_record call this instead.
+    """
+    for instance in instances:
+        record_action("Create", action_object=instance)
+        for consent in instance.consents.all():
+            record_action("Add", action_object=consent, target=instance)
+
+
 class NeverCacheMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
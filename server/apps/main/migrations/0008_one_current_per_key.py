@@ -0,0 +1,60 @@
+# Generated by Django 4.2.16 on 2026-10-18 06:50
+
+from django.db import migrations, models
+
+# Concurrent saves could previously leave more than one current row for a key,
+# so keep only the latest one before the constraint is added
+DEMOTE_DUPLICATE_CURRENT_SQL = """
+UPDATE main_legalbasis SET current = false
+WHERE current AND id NOT IN (
+    SELECT DISTINCT ON (key) id
+    FROM main_legalbasis
+    WHERE current
+    ORDER BY key, modified_at DESC, id ASC
+)
+"""
+
+
+# The constraint is a partial unique index, which is built without locking the
+# legal bases table. A build that fails, such as on a second current row saved
+# since the demotion, leaves an invalid index behind, so any earlier attempt
+# is dropped first.
+CREATE_UNIQUE_INDEX_SQL = [
+    "DROP INDEX CONCURRENTLY IF EXISTS one_current_per_key",
+    """
+    CREATE UNIQUE INDEX CONCURRENTLY one_current_per_key
+    ON main_legalbasis (key) WHERE current
+    """,
+]
+
+DROP_UNIQUE_INDEX_SQL = "DROP INDEX CONCURRENTLY IF EXISTS one_current_per_key"
+
+
+class Migration(migrations.Migration):
+
+    # The legal bases table is the largest, so neither step holds a lock on it
+    # for longer than its own statement
+    atomic = False
+
+    dependencies = [
+        ("main", "0007_alter_commit_extra_alter_legalbasis_email"),
+    ]
+
+    operations = [
+        migrations.RunSQL(DEMOTE_DUPLICATE_CURRENT_SQL, migrations.RunSQL.noop),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(CREATE_UNIQUE_INDEX_SQL, DROP_UNIQUE_INDEX_SQL),
+            ],
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name="legalbasis",
+                    constraint=models.UniqueConstraint(
+                        condition=models.Q(("current", True)),
+                        fields=("key",),
+                        name="one_current_per_key",
+                    ),
+                ),
+            ],
+        ),
+    ]
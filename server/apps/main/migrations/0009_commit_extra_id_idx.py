@@ -0,0 +1,29 @@
+# Generated by Django 4.2.16 on 2026-10-18 07:38
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.operations
+from django.db import migrations, models
+import django.db.models.fields.json
+
+
+class Migration(migrations.Migration):
+
+    # The commits table is large, so the index is built without locking it
+    atomic = False
+
+    dependencies = [
+        ("main", "0008_one_current_per_key"),
+    ]
+
+    operations = [
+        django.contrib.postgres.operations.AddIndexConcurrently(
+            model_name="commit",
+            index=models.Index(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.fields.json.KeyTextTransform("id", "extra"),
+                    name="text_pattern_ops",
+                ),
+                name="main_commit_extra_id_idx",
+            ),
+        ),
+    ]
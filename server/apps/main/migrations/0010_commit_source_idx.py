@@ -0,0 +1,21 @@
+# Generated by Django 4.2.16 on 2026-10-18 07:41
+
+import django.contrib.postgres.operations
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # The commits table is large, so the index is built without locking it
+    atomic = False
+
+    dependencies = [
+        ("main", "0009_commit_extra_id_idx"),
+    ]
+
+    operations = [
+        django.contrib.postgres.operations.AddIndexConcurrently(
+            model_name="commit",
+            index=models.Index(fields=["source"], name="main_commit_source_idx"),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 4.2.16 on 2026-10-18 07:44
+
+from django.db import migrations
+
+# A Forms API page that failed after its commits were written, but before its
+# checkpoint was saved, was written again by the next run. Keep one commit per
+# source document, the one with the most records, and delete the others with
+# their records, before the unique constraint is added. The actions sent for
+# the deleted records are kept, as they are when records are bulk deleted.
+FIND_DUPLICATE_COMMITS_SQL = """
+CREATE TEMPORARY TABLE duplicate_commit ON COMMIT DROP AS
+SELECT id FROM main_commit
+WHERE extra->>'id' IS NOT NULL AND id NOT IN (
+    SELECT DISTINCT ON (extra->>'id') id
+    FROM main_commit AS candidate
+    WHERE extra->>'id' IS NOT NULL
+    ORDER BY
+        extra->>'id',
+        (SELECT COUNT(*) FROM main_legalbasis WHERE commit_id = candidate.id) DESC,
+        id ASC
+)
+"""
+
+FIND_DUPLICATE_LEGAL_BASES_SQL = """
+CREATE TEMPORARY TABLE duplicate_legalbasis ON COMMIT DROP AS
+SELECT id, key FROM main_legalbasis
+WHERE commit_id IN (SELECT id FROM duplicate_commit)
+"""
+
+DELETE_DUPLICATE_CONSENTS_SQL = """
+DELETE FROM main_legalbasis_consents
+WHERE legalbasis_id IN (SELECT id FROM duplicate_legalbasis)
+"""
+
+DELETE_DUPLICATE_LEGAL_BASES_SQL = """
+DELETE FROM main_legalbasis WHERE id IN (SELECT id FROM duplicate_legalbasis)
+"""
+
+DELETE_DUPLICATE_COMMITS_SQL = """
+DELETE FROM main_commit WHERE id IN (SELECT id FROM duplicate_commit)
+"""
+
+# Keys whose current row was deleted get their latest remaining row back
+PROMOTE_LATEST_SQL = """
+UPDATE main_legalbasis SET current = true
+WHERE id IN (
+    SELECT DISTINCT ON (key) id
+    FROM main_legalbasis AS legalbasis
+    WHERE key IN (SELECT key FROM duplicate_legalbasis)
+    AND NOT EXISTS (
+        SELECT 1 FROM main_legalbasis WHERE key = legalbasis.key AND current
+    )
+    ORDER BY key, modified_at DESC, id ASC
+)
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0010_commit_source_idx"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            [
+                FIND_DUPLICATE_COMMITS_SQL,
+                FIND_DUPLICATE_LEGAL_BASES_SQL,
+                DELETE_DUPLICATE_CONSENTS_SQL,
+                DELETE_DUPLICATE_LEGAL_BASES_SQL,
+                DELETE_DUPLICATE_COMMITS_SQL,
+                PROMOTE_LATEST_SQL,
+            ],
+            migrations.RunSQL.noop,
+        ),
+    ]
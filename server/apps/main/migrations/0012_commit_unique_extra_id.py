@@ -0,0 +1,44 @@
+# Generated by Django 4.2.16 on 2026-10-18 07:44
+
+from django.db import migrations, models
+import django.db.models.fields.json
+
+# The constraint is a unique index, which is built without locking the commits
+# table. A build that fails, such as on a duplicate committed since 0011, leaves
+# an invalid index behind, so any earlier attempt is dropped first.
+CREATE_UNIQUE_INDEX_SQL = [
+    "DROP INDEX CONCURRENTLY IF EXISTS main_commit_unique_extra_id",
+    """
+    CREATE UNIQUE INDEX CONCURRENTLY main_commit_unique_extra_id
+    ON main_commit ((extra ->> 'id'))
+    """,
+]
+
+DROP_UNIQUE_INDEX_SQL = "DROP INDEX CONCURRENTLY IF EXISTS main_commit_unique_extra_id"
+
+
+class Migration(migrations.Migration):
+
+    # The commits table is large, so the index is built without locking it
+    atomic = False
+
+    dependencies = [
+        ("main", "0011_delete_duplicate_commits"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(CREATE_UNIQUE_INDEX_SQL, DROP_UNIQUE_INDEX_SQL),
+            ],
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name="commit",
+                    constraint=models.UniqueConstraint(
+                        django.db.models.fields.json.KeyTextTransform("id", "extra"),
+                        name="main_commit_unique_extra_id",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -1,16 +1,119 @@
 import hashlib
+from typing import Collection, Iterable, List, Tuple
 
 import django.db.models as models
 import django.utils.timezone
+from django.contrib.postgres.indexes import OpClass
 from django.core.exceptions import ValidationError
-from django.db.models import JSONField, Max, Q, TextField
+from django.db import connections, router, transaction
+from django.db.models import Exists, JSONField, OuterRef, Q, TextField
+from django.db.models.fields.json import KeyTextTransform
 from extended_choices import AutoChoices
 from phonenumber_field.modelfields import PhoneNumberField
 from typing_extensions import final
 
+from server.apps.main.lookup_cache import invalidate_lookups
+
 # noinspection PyTypeChecker
 KEY_TYPE = AutoChoices("EMAIL", "PHONE")
 
+# Takes a lock on the bucket of each key that is held until the transaction
+# ends, so writers for the same key resolve its current row one at a time. The
+# statements that follow read the key's rows with a new snapshot, which
+# includes the rows committed by the writer before. Buckets are locked in the
+# order given, which is sorted, so writers wait for each other rather than
+# deadlock.
+LOCK_KEYS_SQL = """
+SELECT pg_advisory_xact_lock(%(namespace)s, bucket) FROM unnest(%(buckets)s::int[]) AS bucket
+"""
+
+# Each advisory lock takes an entry in Postgres's shared lock table, which only
+# holds max_locks_per_transaction * max_connections of them, so keys share a
+# fixed number of locks however many a transaction writes. A power of two, so
+# the keys of a bucket all fall in the same shard of a sharded poller.
+KEY_LOCK_BUCKETS = 128
+
+# Keeps the buckets apart from any other advisory locks
+KEY_LOCK_NAMESPACE = 0x4C42
+
+# Demotes the current row for a key if the row being saved is newer than every
+# other row for that key, and reports whether the row being saved is now the
+# latest, in a single round trip once the key is locked.
+IS_CURRENT_SQL = """
+WITH latest AS (
+    SELECT MAX(modified_at) AS modified_at
+    FROM {table}
+    WHERE key = %(key)s AND id IS DISTINCT FROM %(id)s
+), demoted AS (
+    UPDATE {table} SET current = false
+    WHERE key = %(key)s
+    AND current
+    AND id IS DISTINCT FROM %(id)s
+    AND %(modified_at)s > COALESCE((SELECT modified_at FROM latest), '-infinity')
+)
+SELECT %(modified_at)s > COALESCE(modified_at, '-infinity') FROM latest
+"""
+
+# The latest row for each key, ties going to the row saved first, matching the
+# per-save rule in LegalBasis._is_current
+LATEST_PER_KEY_SQL = """
+SELECT DISTINCT ON (key) id
+FROM {table}
+WHERE key = ANY(%(keys)s)
+ORDER BY key, modified_at DESC, id ASC
+"""
+
+# Demoting before promoting keeps the one_current_per_key constraint satisfied
+# after every row update
+DEMOTE_STALE_CURRENT_SQL = """
+UPDATE {table} SET current = false
+WHERE key = ANY(%(keys)s) AND current AND id NOT IN ({latest})
+"""
+
+PROMOTE_LATEST_SQL = """
+UPDATE {table} SET current = true
+WHERE id IN ({latest}) AND NOT current
+"""
+
+# Deletes rows, and their consent through rows, without loading them,
+# returning the keys that the rows were under
+DELETE_CONSENTS_SQL = """
+DELETE FROM {through_table} WHERE legalbasis_id = ANY(%(ids)s)
+"""
+
+DELETE_RETURNING_KEYS_SQL = """
+DELETE FROM {table} WHERE id = ANY(%(ids)s) RETURNING key
+"""
+
+
+def lock_keys(keys: Iterable[bytes], using: str) -> None:
+    """
+    Locks the keys' buckets until the end of the current transaction. The keys
+    are SHA-512 digests, so their first eight bytes spread them evenly.
+    """
+    buckets = sorted({
+        int.from_bytes(bytes(key)[:8], "big") % KEY_LOCK_BUCKETS for key in keys
+    })
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            LOCK_KEYS_SQL, {"namespace": KEY_LOCK_NAMESPACE, "buckets": buckets}
+        )
+
+
+def generate_key(value: str) -> bytes:
+    """
+    Returns the key that records for an email address or phone number are
+    stored under. Emails are lowercased before they are saved, but phone
+    numbers that don't parse are stored as they are, so the value is hashed
+    unchanged to match the keys already stored.
+    """
+    return hashlib.sha512(value.encode()).digest()
+
+
+def generate_lookup_key(value: str) -> bytes:
+    """Returns the key to look up an email address or phone number given by a client"""
+    return generate_key(value.lower())
+
 
 @final
 class Consent(models.Model):
@@ -21,6 +124,31 @@ class Consent(models.Model):
         return f"{self.name}"
 
 
+class CommitQuerySet(models.QuerySet):
+    """
+    Looks commits up by their provenance: the id of the source document, kept
+    in extra["id"], and the source. Each lookup is served by an index.
+    """
+
+    def _with_document_id(self) -> "CommitQuerySet":
+        # Compared as text, so main_commit_extra_id_idx is used, rather than
+        # as JSON as extra__id would be
+        return self.alias(document_id=KeyTextTransform("id", "extra"))
+
+    def for_document(self, document_id: str) -> "CommitQuerySet":
+        return self._with_document_id().filter(document_id=document_id)
+
+    def for_documents(self, document_ids: Iterable[str]) -> "CommitQuerySet":
+        return self._with_document_id().filter(document_id__in=list(document_ids))
+
+    def for_document_prefix(self, prefix: str) -> "CommitQuerySet":
+        """Commits for every document whose id starts with the prefix"""
+        return self._with_document_id().filter(document_id__startswith=prefix)
+
+    def for_source(self, source: str) -> "CommitQuerySet":
+        return self.filter(source=source)
+
+
 @final
 class Commit(models.Model):
 
@@ -28,9 +156,141 @@ class Commit(models.Model):
     source = TextField()
     extra = JSONField(default=dict)
 
+    objects = CommitQuerySet.as_manager()
+
     def __str__(self) -> str:
         return f"created: {self.created_at}, source: {self.source}"
 
+    class Meta:
+        indexes = [
+            # For finding the commits of a source document, or of every
+            # document from a source by the prefix of their ids
+            models.Index(
+                OpClass(KeyTextTransform("id", "extra"), name="text_pattern_ops"),
+                name="main_commit_extra_id_idx",
+            ),
+            models.Index(fields=["source"], name="main_commit_source_idx"),
+        ]
+        constraints = [
+            # Each source document is recorded once, however many times the
+            # poller that reads it replays it
+            models.UniqueConstraint(
+                KeyTextTransform("id", "extra"), name="main_commit_unique_extra_id"
+            ),
+        ]
+
+
+class LegalBasisQuerySet(models.QuerySet):
+    def bulk_record(
+        self,
+        records: Iterable[Tuple["LegalBasis", Iterable[Consent]]],
+        batch_size: int = 1000,
+        defer_current: bool = False,
+    ) -> List["LegalBasis"]:
+        """
+        Saves many unsaved LegalBasis instances along with their consents.
+
+        Rows and consent through rows are written with bulk_create, and the
+        current flag is resolved once for every affected key, so a batch costs
+        a handful of statements rather than several round trips per row.
+        Signals are not sent for the created rows.
+
+        With `defer_current`, the rows are saved as not current and the caller
+        is left to call resolve_current for their keys, so bulk loads can
+        resolve each key once at the end.
+        """
+        objs = []
+        through_objs = []
+        for obj, consents in records:
+            obj._normalise_email()
+            obj._generate_hash()
+            if not obj.modified_at:
+                obj.modified_at = django.utils.timezone.now()
+            obj.current = False
+            objs.append((obj, consents))
+
+        with transaction.atomic(using=self.db, savepoint=False):
+            self.bulk_create([obj for obj, _ in objs], batch_size=batch_size)
+
+            through = self.model.consents.through
+            for obj, consents in objs:
+                through_objs += [
+                    through(legalbasis_id=obj.pk, consent_id=consent.pk)
+                    for consent in consents
+                ]
+            through.objects.using(self.db).bulk_create(
+                through_objs, batch_size=batch_size
+            )
+
+            if not defer_current:
+                self.resolve_current({obj.key for obj, _ in objs})
+
+        return [obj for obj, _ in objs]
+
+    def bulk_delete(self) -> int:
+        """
+        Deletes the rows in the queryset and their consent through rows, then
+        resolves the current flag once for the affected keys.
+
+        Unlike delete(), rows are not loaded and signals are not sent, so the
+        cost doesn't grow with a query or signal per row. Returns the number of
+        rows deleted.
+        """
+        ids = list(self.values_list("pk", flat=True))
+        if not ids:
+            return 0
+
+        through_table = self.model.consents.through._meta.db_table
+        with transaction.atomic(using=self.db, savepoint=False):
+            with connections[self.db].cursor() as cursor:
+                cursor.execute(
+                    DELETE_CONSENTS_SQL.format(through_table=through_table), {"ids": ids}
+                )
+                cursor.execute(
+                    DELETE_RETURNING_KEYS_SQL.format(table=self.model._meta.db_table),
+                    {"ids": ids},
+                )
+                deleted = cursor.fetchall()
+            self.resolve_current({bytes(key) for (key,) in deleted})
+
+        return len(deleted)
+
+    def with_consent_flags(self, names: Iterable[str]) -> "LegalBasisQuerySet":
+        """
+        Annotates a `<name>_consent` boolean for each of the given consent
+        names, computed in SQL rather than by loading the consents
+        """
+        through = self.model.consents.through
+        return self.annotate(**{
+            f"{name}_consent": Exists(
+                through.objects.filter(legalbasis_id=OuterRef("pk"), consent__name=name)
+            )
+            for name in names
+        })
+
+    def resolve_current(self, keys: Collection[bytes]) -> None:
+        """
+        Sets the current flag on the latest row for each of the given keys and
+        clears it on every other row for those keys.
+
+        The keys are locked until the end of the transaction, so it should be
+        called in one, as bulk_record and bulk_delete do.
+        """
+        if not keys:
+            return
+
+        table = self.model._meta.db_table
+        latest = LATEST_PER_KEY_SQL.format(table=table)
+        params = {"keys": list(keys)}
+        lock_keys(keys, self.db)
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                DEMOTE_STALE_CURRENT_SQL.format(table=table, latest=latest), params
+            )
+            cursor.execute(PROMOTE_LATEST_SQL.format(table=table, latest=latest), params)
+
+        invalidate_lookups(keys, using=self.db)
+
 
 class LegalBasis(models.Model):
     """
@@ -51,36 +311,46 @@ class LegalBasis(models.Model):
     modified_at = models.DateTimeField(default=django.utils.timezone.now)
     current = models.BooleanField(default=False, db_index=True)
 
+    objects = LegalBasisQuerySet.as_manager()
+
     def save(
         self, force_insert=False, force_update=False, using=None, update_fields=None
     ) -> None:
         self._normalise_email()
         self._generate_hash()
-        self._is_current()
 
-        return super(LegalBasis, self).save(
-            force_insert, force_update, using, update_fields
-        )
+        using = using or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=using, savepoint=False):
+            self._is_current(using)
 
-    def _is_current(self) -> None:
-        last_modified = (
-            LegalBasis.objects.filter(key=self.key)
-            .exclude(id=self.id)
-            .aggregate(Max("modified_at"))["modified_at__max"]
-        )
+            return super(LegalBasis, self).save(
+                force_insert, force_update, using, update_fields
+            )
+
+    def _is_current(self, using: str) -> None:
+        """
+        Marks this instance as current if it is newer than every other row for
+        its key, demoting the previous current row in the same statement.
+
+        The key is locked first, so a concurrent writer for the same key waits
+        for this one to commit and then sees its row. The `one_current_per_key`
+        constraint still guarantees there is never more than one current row.
+        """
         if not self.modified_at:
             self.modified_at = django.utils.timezone.now()
-        if last_modified is None or self.modified_at > last_modified:
-            self.current = True
-            LegalBasis.objects.filter(key=self.key).exclude(id=self.id).update(
-                current=False
+        lock_keys([self.key], using)
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                IS_CURRENT_SQL.format(table=self._meta.db_table),
+                {"key": self.key, "id": self.id, "modified_at": self.modified_at},
             )
+            (is_latest,) = cursor.fetchone()
+        if is_latest:
+            self.current = True
 
     def _generate_hash(self) -> None:
         if not self.key:
-            to_hash = self.email + str(self.phone)
-            hasher = hashlib.sha512(to_hash.encode())
-            self.key = hasher.digest()
+            self.key = generate_key(self.email + str(self.phone))
 
     def _normalise_email(self) -> None:
         if self.email:
@@ -110,7 +380,12 @@ class LegalBasis(models.Model):
             models.CheckConstraint(
                 check=(Q(email="") & ~Q(phone="")) | (~Q(email="") & Q(phone="")),
                 name="only_one_key",
-            )
+            ),
+            models.UniqueConstraint(
+                fields=["key"],
+                condition=Q(current=True),
+                name="one_current_per_key",
+            ),
         ]
 
 
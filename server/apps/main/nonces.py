@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django_redis import get_redis_connection
+
+NONCE_KEY_PREFIX = "legal-basis:nonce"
+
+# Seconds a Hawk id and nonce pair can't be used again for. Hawk rejects
+# timestamps more than 60 seconds out, so this comfortably covers any request
+# that could still be accepted.
+NONCE_TIMEOUT = 120
+
+
+class MemoryNonceStore:
+    """
+    Remembers the nonces seen by this process.
+
+    Only suitable when there is a single process, such as in tests, as a nonce
+    used against one process can be replayed against another. Requests are
+    authenticated on several threads, so the nonces are only read and changed
+    while holding a lock.
+    """
+
+    def __init__(self) -> None:
+        # Every entry has the same timeout, so the oldest is always first
+        self._recent: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, hawk_id: str, nonce: str) -> bool:
+        """Returns True if the nonce has been used by the Hawk id recently"""
+        key = f"{NONCE_KEY_PREFIX}:{hawk_id}:{nonce}"
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._recent:
+                return True
+            self._recent[key] = now + NONCE_TIMEOUT
+
+        return self._seen_elsewhere(key)
+
+    def _seen_elsewhere(self, key: str) -> bool:
+        return False
+
+    def _expire(self, now: float) -> None:
+        while self._recent:
+            key, expires_at = self._recent.popitem(last=False)
+            if expires_at > now:
+                # Still current, so it goes back to the front
+                self._recent[key] = expires_at
+                self._recent.move_to_end(key, last=False)
+                break
+
+    def clear(self) -> None:
+        with self._lock:
+            self._recent.clear()
+
+
+class RedisNonceStore(MemoryNonceStore):
+    """
+    Remembers the nonces seen by any process in Redis.
+
+    Each nonce is stored with a single SET NX EX on the cache's connection pool,
+    with a plain value rather than a pickled one. Nonces already seen by this
+    process are rejected without going to Redis, and Redis is asked outside
+    the lock, so threads don't wait for each other's round trips.
+    """
+
+    def _seen_elsewhere(self, key: str) -> bool:
+        added = get_redis_connection("default").set(key, b"1", nx=True, ex=NONCE_TIMEOUT)
+        return not added
+
+
+NONCE_STORES = {
+    "memory": MemoryNonceStore,
+    "redis": RedisNonceStore,
+}
+
+_stores: Dict[str, MemoryNonceStore] = {}
+
+
+def get_nonce_store() -> MemoryNonceStore:
+    """Returns this process's store for the HAWK_NONCE_STORE backend"""
+    backend = settings.HAWK_NONCE_STORE
+    if backend not in _stores:
+        try:
+            _stores[backend] = NONCE_STORES[backend]()
+        except KeyError:
+            raise ImproperlyConfigured(
+                f"HAWK_NONCE_STORE must be one of {', '.join(NONCE_STORES)}, not {backend}"
+            )
+    return _stores[backend]
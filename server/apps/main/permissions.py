@@ -11,3 +11,15 @@ class LegalBasisModelPermissions(DjangoModelPermissions):
         "PATCH": ["%(app_label)s.change_%(model_name)s"],
         "DELETE": ["%(app_label)s.delete_%(model_name)s"],
     }
+
+
+class LegalBasisLookupPermissions(LegalBasisModelPermissions):
+    """
+    Lookups may be POSTed so that large batches fit in the request body, but
+    only read records, so they need the view permission
+    """
+
+    perms_map = {
+        **LegalBasisModelPermissions.perms_map,
+        "POST": ["%(app_label)s.view_%(model_name)s"],
+    }
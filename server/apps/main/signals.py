@@ -1,6 +1,15 @@
+from django.contrib.auth.models import Group, User
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.utils import timezone
 from django_structlog.signals import bind_extra_request_metadata
+from rest_framework.authtoken.models import Token
+
+from server.apps.main.audit import record_action
+from server.apps.main.consent_registry import consent_registry
+from server.apps.main.credentials import credential_cache
+from server.apps.main.lookup_cache import invalidate_lookups
+from server.apps.main.models import Consent, LegalBasis
 
 
 @receiver(bind_extra_request_metadata)
@@ -17,3 +26,71 @@ def bind_extra_log_data(request, logger, **kwargs):
         service="Consent API",
         request_time=timezone.now().isoformat(),
     )
+
+
+@receiver(post_save, sender=LegalBasis)
+@receiver(post_delete, sender=LegalBasis)
+def invalidate_lookup_on_change(sender, instance, using, **kwargs):
+    invalidate_lookups([instance.key], using=using)
+
+
+@receiver(m2m_changed, sender=LegalBasis.consents.through)
+def invalidate_lookup_on_consents_change(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if not reverse:
+        if action in ["post_add", "post_remove", "post_clear"]:
+            invalidate_lookups([instance.key], using=using)
+        return
+
+    # The instance is a Consent, so look up the records it was added to or
+    # removed from. The records are gone by post_clear, so use pre_clear.
+    if action in ["post_add", "post_remove"]:
+        records = LegalBasis.objects.using(using).filter(pk__in=pk_set)
+    elif action == "pre_clear":
+        records = instance.legalbasis_set.using(using).all()
+    else:
+        return
+    invalidate_lookups(records.values_list("key", flat=True), using=using)
+
+
+@receiver(post_save, sender=LegalBasis)
+def audit_save(sender, instance, created, **kwargs):
+    record_action("Create" if created else "Update", action_object=instance)
+
+
+@receiver(post_delete, sender=LegalBasis)
+def audit_delete(sender, instance, **kwargs):
+    record_action("Delete", action_object=instance)
+
+
+@receiver(m2m_changed, sender=LegalBasis.consents.through)
+def audit_consents_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ["post_add", "post_remove"]:
+        verb = "Add" if action == "post_add" else "Remove"
+        # Only the pk is needed to refer to the other side, so don't fetch it
+        for pk in pk_set:
+            if reverse:
+                record_action(verb, action_object=instance, target=LegalBasis(pk=pk))
+            else:
+                record_action(verb, action_object=Consent(pk=pk), target=instance)
+
+    if action == "post_clear" and not reverse:
+        record_action("Update", action_object=instance)
+
+
+@receiver(post_save, sender=Consent)
+@receiver(post_delete, sender=Consent)
+def invalidate_consent_registry(sender, **kwargs):
+    consent_registry.invalidate()
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_hawk_credentials(sender, **kwargs):
+    credential_cache.invalidate()
@@ -1,11 +1,16 @@
+import queue
+import threading
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import ClassVar, Optional, Tuple
+from typing import Callable, ClassVar, Iterator, Optional, Tuple, Union
 
 from opensearchpy import OpenSearch
-from opensearch_dsl import Search
+from opensearch_dsl import Q, Search
 from opensearch_dsl.response import Hit, Response
 
+# How many documents are fetched per page, unless the caller asks for another size
+DEFAULT_PAGE_SIZE = 500
+
 
 @dataclass
 class ActivityStreamClient(ABC):
@@ -18,7 +23,7 @@ class ActivityStreamClient(ABC):
         raise NotImplementedError()
 
     @abstractmethod
-    def get_documents(self, search_after) -> Response:
+    def get_documents(self, search_after, size: int = DEFAULT_PAGE_SIZE) -> Response:
         raise NotImplementedError()
 
     @abstractmethod
@@ -27,11 +32,23 @@ class ActivityStreamClient(ABC):
 
     sort = ({"published": "asc"}, {"id": "asc"})
 
+    @staticmethod
+    def next_search_after(results: Response) -> Tuple[int, str]:
+        """Returns the sort values of the last hit, to fetch the page after it"""
+        timestamp, document_id = results.to_dict()["hits"]["hits"][-1]["sort"]
+        return timestamp, document_id
+
 
 class FormsApi(ActivityStreamClient):
 
     name: ClassVar[str] = "dit:directoryFormsApi:Submission"
 
+    # Fields of the submitted data: those should_process looks for, those
+    # that say who submitted it, and the rest of those update_consent reads
+    consent_fields: ClassVar[Tuple[str, ...]] = ("email_contact_consent", "contact_consent")
+    contact_fields: ClassVar[Tuple[str, ...]] = ("email_address", "email", "phone_number")
+    other_fields: ClassVar[Tuple[str, ...]] = ("country", "telephone_contact_consent")
+
     def should_process(self, hit: Hit) -> bool:
         if "object" in hit:
             if f"{self.name}:Data" in hit.object:
@@ -57,15 +74,110 @@ class FormsApi(ActivityStreamClient):
         }
         return filtered
 
-    def get_documents(self, search_after: Optional[Tuple[int, str]]) -> Response:
-
+    def get_documents(
+        self, search_after: Optional[Tuple[int, str]], size: int = DEFAULT_PAGE_SIZE
+    ) -> Response:
+        """
+        Returns the next `size` submissions that could have consent fields,
+        with only the parts of their documents that are parsed.
+
+        An empty contact_consent list isn't indexed as present, so submissions
+        with contact details are fetched too, and should_process has the final
+        say.
+        """
+        data = f"object.{self.name}:Data"
         documents = (
             Search(using=self.es_client, index="activities")
             .filter("term", object__type=self.name)
+            .filter(
+                "bool",
+                should=[
+                    Q("exists", field=f"{data}.{field}")
+                    for field in self.consent_fields + self.contact_fields
+                ],
+                minimum_should_match=1,
+            )
+            .source(
+                ["id", "published", "object.url"]
+                + [
+                    f"{data}.{field}"
+                    for field in self.consent_fields + self.contact_fields + self.other_fields
+                ]
+            )
             .sort(*self.sort)
+            .extra(size=size)
         )
 
         if search_after:
             documents = documents.extra(search_after=search_after)
 
         return documents.execute()
+
+
+SearchAfter = Optional[Tuple[int, str]]
+PrefetchedItem = Union[Response, Exception, None]
+
+
+class PagePrefetcher:
+    """
+    Fetches the pages of an activity stream search in a background thread, so
+    the next page is on its way while the current one is being processed.
+
+    At most `depth` pages are held ahead of the one being processed. Pages are
+    yielded in order, and an error fetching a page is raised from the loop over
+    them. Only the fetching happens in the background: saving checkpoints is
+    left to the caller, once each page has been written.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[SearchAfter], Response],
+        search_after: SearchAfter,
+        depth: int = 2,
+    ) -> None:
+        self._fetch = fetch
+        self._search_after = search_after
+        self._pages: "queue.Queue[PrefetchedItem]" = queue.Queue(maxsize=max(depth, 1))
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="page-prefetcher", daemon=True)
+
+    def __enter__(self) -> "PagePrefetcher":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def __iter__(self) -> Iterator[Response]:
+        while True:
+            page = self._pages.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page
+
+    def _run(self) -> None:
+        search_after = self._search_after
+        try:
+            while not self._stopped.is_set():
+                results = self._fetch(search_after)
+                if not len(results.hits):
+                    break
+                self._put(results)
+                search_after = ActivityStreamClient.next_search_after(results)
+        except Exception as e:
+            self._put(e)
+        else:
+            self._put(None)
+
+    def _put(self, item: PrefetchedItem) -> None:
+        # Gives up once the caller has stopped reading, rather than waiting
+        # forever for room in the queue
+        while not self._stopped.is_set():
+            try:
+                self._pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
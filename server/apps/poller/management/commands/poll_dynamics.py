@@ -1,16 +1,21 @@
 from datetime import datetime, timedelta
 from time import sleep
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-from actstream import action
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import User
 from django.db import transaction
-from django.db.models import Model
 from django.utils.functional import cached_property
 from django_tqdm import BaseCommand
 
+from server.apps.main.consent_registry import consent_registry
 from server.apps.main.models import KEY_TYPE, Commit, Consent, LegalBasis
 from server.apps.poller.api_client.dynamics import DynamicsClient
+from server.apps.poller.management.commands.poll_formsapi import write_records
+
+# An email address and whether it consents to email marketing
+ConsentChange = Tuple[str, bool]
 
 queryset = LegalBasis.objects.filter(current=True)
 
@@ -38,32 +43,44 @@ class Command(BaseCommand):
             default=60,
         )
 
-    @cached_property
-    def email_consent(self) -> Consent:
-        email_consent, _ = Consent.objects.get_or_create(name="email_marketing")
-        return email_consent
+        parser.add_argument(
+            "--batch-size",
+            action="store",
+            type=int,
+            help="How many consents to write per batch, default: 1000",
+            default=1000,
+        )
 
-    @transaction.atomic()
-    def update_consent(self, email_address, meta=None) -> None:
-        self.write(f"Updating consent for {self._masked_email(email_address)}")
-        if meta is None:
-            meta = {}
-        commit = Commit(extra=meta)
-        commit.source = meta.get("url", settings.DYNAMICS_INSTANCE_URI)
-        commit.save()
+    @property
+    def email_consent(self) -> Consent:
+        return consent_registry.get_or_create("email_marketing")
 
-        self._update_email_consent(commit, email_address, False)
+    @cached_property
+    def dynamics_user(self) -> User:
+        return get_user_model().objects.get_or_create(username="dynamics")[0]
 
     @transaction.atomic()
-    def create_consent(self, email_address, meta=None) -> None:
-        self.write(f"Creating consent for {self._masked_email(email_address)}")
+    def write_consents(self, changes: List[ConsentChange], meta=None) -> None:
+        """
+        Records each email address's consent, with a commit and a Create action
+        for each, in one transaction
+        """
         if meta is None:
             meta = {}
-        commit = Commit(extra=meta)
-        commit.source = meta.get("url", settings.DYNAMICS_INSTANCE_URI)
-        commit.save()
-
-        self._update_email_consent(commit, email_address, True)
+        commits = [
+            Commit(extra=meta, source=meta.get("url", settings.DYNAMICS_INSTANCE_URI))
+            for _ in changes
+        ]
+        Commit.objects.bulk_create(commits)
+
+        records = [
+            (
+                LegalBasis(email=email_address, commit=commit, key_type=KEY_TYPE.EMAIL),
+                [self.email_consent] if consented else [],
+            )
+            for (email_address, consented), commit in zip(changes, commits)
+        ]
+        write_records(records, self.dynamics_user)
 
     @staticmethod
     def _masked_email(full_email: str) -> str:
@@ -72,52 +89,77 @@ class Command(BaseCommand):
             return f"{email_parts[0][:2]}...@...{email_parts[1][-4:]}"
         return email_parts[0]
 
-    def _send_action(self, instance: Model) -> None:
-        dynamics_user, _ = get_user_model().objects.get_or_create(username="dynamics")
-        action_kwargs = {
-            "sender": dynamics_user,
-            "action_object": instance,
-            "verb": "Create",
-        }
-        action.send(**action_kwargs)
-
-    def _update_email_consent(
-        self, commit, email_address, email_contact_consent
-    ) -> None:
-        if email_address:
-            obj: LegalBasis = LegalBasis(
-                email=email_address, commit=commit, key_type=KEY_TYPE.EMAIL
-            )
-            obj.save()
-            if email_contact_consent:
-                obj.consents.add(self.email_consent)
-            else:
-                obj.consents.remove(self.email_consent)
-
-            self._send_action(obj)
-
-    def _should_update(self, email_address) -> bool:
-        # check if there is already a legal basis for this email address
-        try:
-            lb: LegalBasis = queryset.get(email=email_address)
-        except LegalBasis.DoesNotExist:
-            return True
-
-        # check if it is already opted out
-        if self.email_consent in lb.consents.all():
-            return True
-
-        return False
-
-    def _should_create(self, email_address) -> bool:
-        return not queryset.filter(
-            key_type=KEY_TYPE.EMAIL, email=email_address
-        ).exists()
+    @staticmethod
+    def _current_consents(email_addresses: Iterable[str]) -> Dict[str, bool]:
+        """
+        Returns whether the current legal basis for each of the email addresses
+        that has one consents to email marketing, in one query
+        """
+        return dict(
+            queryset.filter(key_type=KEY_TYPE.EMAIL, email__in=email_addresses)
+            .with_consent_flags(["email_marketing"])
+            .values_list("email", "email_marketing_consent")
+        )
 
-    def _sync_unsubs(self) -> None:
+    def _should_update(
+        self, email_address, current_consents: Optional[Dict[str, bool]] = None
+    ) -> bool:
+        if current_consents is None:
+            current_consents = self._current_consents([email_address])
+
+        # Update if there is no legal basis for this email address yet, or if
+        # it isn't already opted out
+        return current_consents.get(email_address, True)
+
+    def _should_create(
+        self, email_address, current_consents: Optional[Dict[str, bool]] = None
+    ) -> bool:
+        if current_consents is None:
+            current_consents = self._current_consents([email_address])
+
+        return email_address not in current_consents
+
+    def _write_batch(self, records: List[ConsentChange]) -> Tuple[int, int]:
+        """
+        Writes the consents in the batch that change what is recorded, and
+        returns how many opt outs were written and how many were created
+        """
+        current_consents = self._current_consents(email for email, _ in records)
+
+        changes: List[ConsentChange] = []
+        pending: Set[str] = set()
+        update_count = create_count = 0
+        for email_address, consented in records:
+            # If the contact is opted in, and we don't have a record of them, create one
+            if consented and self._should_create(email_address, current_consents):
+                self.write(f"Creating consent for {self._masked_email(email_address)}")
+                create_count += 1
+            # If the contact is opted out, and we have an opt-in record for them, opt them out
+            elif not consented and self._should_update(email_address, current_consents):
+                self.write(f"Updating consent for {self._masked_email(email_address)}")
+                update_count += 1
+            else:
+                continue
+
+            # The records for an address are written in order, so a second
+            # change to one already in this write is left for the next
+            if email_address in pending:
+                self.write_consents(changes)
+                changes = []
+                pending.clear()
+            changes.append((email_address, consented))
+            pending.add(email_address)
+            current_consents[email_address] = consented
+
+        if changes:
+            self.write_consents(changes)
+        return update_count, create_count
+
+    def _sync_unsubs(self, batch_size: int) -> None:
         self.write("Syncing unsubscribed users")
         client = DynamicsClient()
         record_count = update_count = create_count = 0
+        batch: List[ConsentChange] = []
         for record in client.get_consents():
             record_count += 1
             email_address = record["email"]
@@ -125,21 +167,24 @@ class Command(BaseCommand):
             self.write(
                 f"Got {'un' if not consented else ''}subbed email {self._masked_email(email_address)}"
             )
-            # If the contact is opted in, and we don't have a record of them, create one
-            if consented and self._should_create(email_address):
-                self.create_consent(email_address)
-                create_count += 1
-            # If the contact is opted out, and we have an opt-in record for them, opt them out
-            elif not consented and self._should_update(email_address):
-                self.update_consent(email_address)
-                update_count += 1
+            batch.append((email_address, consented))
+            if len(batch) == batch_size:
+                updated, created = self._write_batch(batch)
+                update_count += updated
+                create_count += created
+                batch = []
+
+        if batch:
+            updated, created = self._write_batch(batch)
+            update_count += updated
+            create_count += created
 
         self.write(
             f"Updated {update_count} and created {create_count} records out of {record_count} in total"
         )
 
     def run(self, *args, **options) -> None:
-        self._sync_unsubs()
+        self._sync_unsubs(options["batch_size"])
 
     def handle(self, *args, **options):
         run_forever = options.pop("forever")
@@ -148,10 +193,10 @@ class Command(BaseCommand):
         if run_forever:
             while True:
                 self.write("Polling dynamics 365")
-                self.run(args, options)
+                self.run(*args, **options)
                 self.write(
                     f"sleeping until {datetime.now() + timedelta(seconds=sleep_time)}"
                 )
                 sleep(sleep_time)
         else:
-            self.run(args, options)
+            self.run(*args, **options)
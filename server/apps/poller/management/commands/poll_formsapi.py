@@ -1,23 +1,73 @@
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, wait
+from contextlib import nullcontext
 from datetime import datetime, timedelta, timezone
 from pprint import pformat
 from time import sleep
+from typing import ContextManager, Dict, List, Optional, Tuple
 
-from actstream import action
+from actstream.models import Action
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import transaction
-from django.db.models import Model
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db import connections, transaction
 from django.utils.functional import cached_property
 from django_tqdm import BaseCommand
 from opensearchpy import OpenSearch, RequestsHttpConnection
 from phonenumber_field.phonenumber import PhoneNumber
 from phonenumbers import NumberParseException
+from opensearch_dsl.response import Response
 from requests_hawk import HawkAuth
 
-from server.apps.main.models import KEY_TYPE, Commit, Consent, LegalBasis
-from server.apps.poller.api_client.activity import FormsApi
+from server.apps.main.audit import AuditBuffer
+from server.apps.main.consent_registry import consent_registry
+from server.apps.main.models import KEY_TYPE, Commit, Consent, LegalBasis, generate_key
+from server.apps.poller.api_client.activity import (
+    DEFAULT_PAGE_SIZE,
+    FormsApi,
+    PagePrefetcher,
+)
 from server.apps.poller.models import ActivityStreamType
 
+LegalBasisRecord = Tuple[LegalBasis, List[Consent]]
+# The object data and meta of an activity stream document
+Submission = Tuple[dict, dict]
+
+
+def shard_for(obj: LegalBasis, shards: int) -> int:
+    """
+    Returns the shard for a record's key. Every record for a key goes to the
+    same shard, so each key is only ever written by one worker at a time.
+    """
+    # The key is already a SHA-512 digest, so its first bytes are evenly spread.
+    # Emails are lowercased before the key is generated, as when it is saved
+    key = obj.key or generate_key(obj.email.lower() + str(obj.phone))
+    return int.from_bytes(bytes(key)[:8], "big") % shards
+
+
+def write_records(
+    records: List[LegalBasisRecord], actor: User, defer_current: bool = False
+) -> List[int]:
+    """
+    Writes the records, with their consents and a Create action for each, in
+    one transaction, and returns their ids. Runs in the worker processes of the
+    sharded mode, and in the command itself otherwise.
+    """
+    with transaction.atomic():
+        legal_bases = LegalBasis.objects.bulk_record(records, defer_current=defer_current)
+
+        audit = AuditBuffer()
+        for obj in legal_bases:
+            audit.add(actor=actor, verb="Create", action_object=obj)
+        audit.flush()
+    return [obj.pk for obj in legal_bases]
+
+
+def _start_worker() -> None:
+    pass
+
 
 class Command(BaseCommand):
     help = """
@@ -40,15 +90,50 @@ class Command(BaseCommand):
             default=60,
         )
 
-    @cached_property
+        parser.add_argument(
+            "--page-size",
+            action="store",
+            type=int,
+            help=f"How many submissions to fetch per page, default: {DEFAULT_PAGE_SIZE}",
+            default=DEFAULT_PAGE_SIZE,
+        )
+
+        parser.add_argument(
+            "--workers",
+            action="store",
+            type=int,
+            help=(
+                "How many processes to write each page with, split by consent key. "
+                "The checkpoint is saved once every process has written its part. "
+                "default: 1"
+            ),
+            default=1,
+        )
+
+        parser.add_argument(
+            "--defer-current",
+            action="store_true",
+            help=(
+                "Leave the records written as not current, for bulk loads that "
+                "resolve the current records once they have finished"
+            ),
+        )
+
+        parser.add_argument(
+            "--prefetch-depth",
+            action="store",
+            type=int,
+            help="How many pages to fetch ahead while writing the current one, default: 2",
+            default=2,
+        )
+
+    @property
     def email_consent(self) -> Consent:
-        email_consent, _ = Consent.objects.get_or_create(name="email_marketing")
-        return email_consent
+        return consent_registry.get_or_create("email_marketing")
 
-    @cached_property
+    @property
     def phone_consent(self) -> Consent:
-        phone_consent, _ = Consent.objects.get_or_create(name="phone_marketing")
-        return phone_consent
+        return consent_registry.get_or_create("phone_marketing")
 
     def get_client(self) -> FormsApi:
         es_client = OpenSearch(
@@ -70,8 +155,15 @@ class Command(BaseCommand):
             print(f"First run for {name}. Creating model {obj}")
         return obj
 
-    @transaction.atomic()
-    def update_consent(self, object_data, meta) -> None:
+    @cached_property
+    def directoryforms_user(self) -> User:
+        return get_user_model().objects.get(username="directoryforms")
+
+    def build_records(self, object_data, meta) -> Tuple[Commit, List[LegalBasisRecord]]:
+        """
+        Returns the unsaved Commit for a submission, and the unsaved LegalBasis
+        records for its email address and phone number with their consents
+        """
         email_address = object_data.get("email_address", object_data.get("email"))
         email_contact_consent = object_data.get("email_contact_consent") or "consents_to_email_contact" in object_data.get("contact_consent", [])
 
@@ -81,93 +173,244 @@ class Command(BaseCommand):
 
         commit = Commit(extra=meta)
         commit.source = meta["url"] or ''  # Not all forms API submissions have an URL
-        commit.save()
 
-        self._update_email_consent(
+        records = self._email_consent_records(
             commit,
             email_address,
             email_contact_consent,
             datetime.fromisoformat(meta["published"]).replace(tzinfo=timezone.utc),
         )
-
-        self._update_phone_consent(
+        records += self._phone_consent_records(
             commit, phone_consent, phone_number, phone_number_country
         )
+        return commit, records
 
-    def _update_phone_consent(
+    def _phone_consent_records(
         self, commit, phone_consent, phone_number, phone_number_country
-    ) -> None:
-        if phone_number:
-            try:
-                phone_number_parsed: PhoneNumber = PhoneNumber.from_string(
-                    phone_number, region=phone_number_country
-                )
-                phone_number = phone_number_parsed.as_e164
-            except NumberParseException:
-                pass
+    ) -> List[LegalBasisRecord]:
+        if not phone_number:
+            return []
 
-            obj = LegalBasis(
-                phone=phone_number[:128], commit=commit, key_type=KEY_TYPE.PHONE,
+        try:
+            phone_number_parsed: PhoneNumber = PhoneNumber.from_string(
+                phone_number, region=phone_number_country
             )
-            obj.save()
-            if phone_consent:
-                obj.consents.add(self.phone_consent)
-            else:
-                obj.consents.remove(self.phone_consent)
-
-            self._send_action(obj)
-
-    def _send_action(self, instance: Model) -> None:
-        User = get_user_model()
-        directoryforms_user = User.objects.get(username="directoryforms")
-        action_kwargs = {
-            "sender": directoryforms_user,
-            "action_object": instance,
-            "verb": "Create",
-        }
-        action.send(**action_kwargs)
+            phone_number = phone_number_parsed.as_e164
+        except NumberParseException:
+            pass
 
-    def _update_email_consent(
+        obj = LegalBasis(
+            phone=phone_number[:128], commit=commit, key_type=KEY_TYPE.PHONE,
+        )
+        return [(obj, [self.phone_consent] if phone_consent else [])]
+
+    def _email_consent_records(
         self, commit, email_address, email_contact_consent, hit_modified_at
+    ) -> List[LegalBasisRecord]:
+        if not email_address:
+            return []
+
+        obj: LegalBasis = LegalBasis(
+            email=email_address,
+            commit=commit,
+            key_type=KEY_TYPE.EMAIL,
+            modified_at=hit_modified_at,
+        )
+        return [(obj, [self.email_consent] if email_contact_consent else [])]
+
+    def parse_page(self, client: FormsApi, results: Response) -> List[Submission]:
+        submissions = []
+        for hit in results:
+            if client.should_process(hit):
+                self.write(pformat(hit.to_dict()))
+                submissions.append(
+                    (client.parse_object_data(hit), client.parse_object_meta(hit))
+                )
+        return submissions
+
+    @staticmethod
+    def get_applied(document_ids: List[str]) -> Dict[str, Tuple[int, List[str]]]:
+        """
+        Returns the id of the commit already written for each of the documents
+        that has one, with the key types of the records written under it,
+        in one query
+        """
+        applied = (
+            Commit.objects.for_documents(document_ids)
+            .values_list("extra__id", "pk")
+            .annotate(key_types=ArrayAgg("legalbasis__key_type", distinct=True))
+        )
+        return {
+            document_id: (commit_id, key_types)
+            for document_id, commit_id, key_types in applied
+        }
+
+    def build_page(
+        self, client: FormsApi, results: Response
+    ) -> Tuple[List[Commit], List[LegalBasisRecord]]:
+        """
+        Returns the unsaved commits and records for the page's submissions.
+
+        A submission whose document already has a commit, from a page that
+        was written again because its checkpoint wasn't saved, isn't recorded
+        again. Only the records missing from its commit, from a sharded page
+        that was partly written, are returned, under the existing commit.
+        """
+        submissions = self.parse_page(client, results)
+        applied = self.get_applied([meta["id"] for _, meta in submissions])
+
+        commits = []
+        records: List[LegalBasisRecord] = []
+        seen = set()
+        for object_data, meta in submissions:
+            # A document repeated on the page is only recorded once
+            if meta["id"] in seen:
+                continue
+            seen.add(meta["id"])
+
+            commit, hit_records = self.build_records(object_data, meta)
+            if meta["id"] not in applied:
+                commits.append(commit)
+                records += hit_records
+                continue
+
+            commit_id, key_types = applied[meta["id"]]
+            for record, consents in hit_records:
+                if record.key_type not in key_types:
+                    record.commit_id = commit_id
+                    records.append((record, consents))
+        return commits, records
+
+    def save_checkpoint(
+        self, client: FormsApi, results: Response, activity: ActivityStreamType
     ) -> None:
-        if email_address:
-            obj: LegalBasis = LegalBasis(
-                email=email_address,
-                commit=commit,
-                key_type=KEY_TYPE.EMAIL,
-                modified_at=hit_modified_at,
-            )
-            obj.save()
-            if email_contact_consent:
-                obj.consents.add(self.email_consent)
-            else:
-                obj.consents.remove(self.email_consent)
+        activity.last_document_timestamp, activity.last_document_id = (
+            client.next_search_after(results)
+        )
+        activity.save()
+
+    def apply_page(
+        self,
+        client: FormsApi,
+        results: Response,
+        activity: ActivityStreamType,
+        defer_current: bool = False,
+    ) -> None:
+        """
+        Writes every submission on the page that hasn't been written already,
+        and the checkpoint after it, in one transaction, so a page is either
+        applied once or not at all
+        """
+        commits, records = self.build_page(client, results)
+        with transaction.atomic():
+            Commit.objects.bulk_create(commits)
+            write_records(records, self.directoryforms_user, defer_current)
+            self.save_checkpoint(client, results, activity)
+
+    def apply_page_sharded(
+        self,
+        client: FormsApi,
+        results: Response,
+        activity: ActivityStreamType,
+        executor: Executor,
+        workers: int,
+        defer_current: bool = False,
+    ) -> None:
+        """
+        Writes the page's records with one worker per shard of consent keys,
+        and saves the checkpoint once every shard has committed.
+
+        Records keep their page order within a shard, so each key's records
+        are applied in order, and the next page isn't started until this one
+        is written. If a shard fails, the records the other shards wrote, with
+        their actions, and the page's new commits are deleted once every shard
+        has finished, so the page is left unapplied as it would be by a
+        rollback. A page that stopped part way without that, such as when the
+        process was killed, is applied again from the checkpoint, which only
+        writes the records it is missing.
+        """
+        commits, records = self.build_page(client, results)
+        # The commits are shared by records in different shards, so they're
+        # written first
+        Commit.objects.bulk_create(commits)
 
-            self._send_action(obj)
+        shards: List[List[LegalBasisRecord]] = [[] for _ in range(workers)]
+        for record in records:
+            shards[shard_for(record[0], workers)].append(record)
+
+        futures = [
+            executor.submit(write_records, shard, self.directoryforms_user, defer_current)
+            for shard in shards
+            if shard
+        ]
+        wait(futures)
+        failed = [future for future in futures if future.exception() is not None]
+        if failed:
+            written = [pk for future in futures if future not in failed for pk in future.result()]
+            self.undo_page(commits, written)
+            failed[0].result()
+
+        self.save_checkpoint(client, results, activity)
+
+    @staticmethod
+    def undo_page(commits: List[Commit], legal_basis_ids: List[int]) -> None:
+        """
+        Deletes the records written for a page, with their consents and
+        actions, and the page's new commits
+        """
+        with transaction.atomic():
+            Action.objects.filter(
+                action_object_content_type=ContentType.objects.get_for_model(LegalBasis),
+                action_object_object_id__in=[str(pk) for pk in legal_basis_ids],
+            ).delete()
+            LegalBasis.objects.filter(pk__in=legal_basis_ids).bulk_delete()
+            Commit.objects.filter(pk__in=[commit.pk for commit in commits]).delete()
+
+    def get_executor(self, workers: int) -> Optional[ProcessPoolExecutor]:
+        """
+        Returns a pool of worker processes for the sharded mode, already
+        started so they aren't forked while pages are being prefetched
+        """
+        if workers < 2:
+            return None
+
+        # The workers are forked, so they start with Django set up and the same
+        # databases, but each needs its own connections
+        connections.close_all()
+        executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork")
+        )
+        executor.submit(_start_worker).result()
+        return executor
 
     def run(self, *args, **options) -> None:
         client = self.get_client()
 
         obj = self.get_activity_instance(client.name)
-        results = client.get_documents(obj.search_after)
-        total_hits = results.hits.total.value
-        with self.tqdm(total=total_hits) as progress_bar:
-            while len(results.hits):
-
-                for hit in results:
-                    if client.should_process(hit):
-                        self.write(pformat(hit.to_dict()))
-                        object_data = client.parse_object_data(hit)
-                        meta = client.parse_object_meta(hit)
-                        self.update_consent(object_data, meta)
-                    progress_bar.update(1)
-
-                obj.last_document_timestamp, obj.last_document_id = results.to_dict()[
-                    "hits"
-                ]["hits"][-1]["sort"]
-                obj.save()
-
-                results = client.get_documents(obj.search_after)
+        # The next pages are fetched while each page is written, and the
+        # checkpoint is saved in the same transaction as its page
+        page_size = options["page_size"]
+        workers = options["workers"]
+        defer_current = options["defer_current"]
+        executor = self.get_executor(workers)
+        pages = PagePrefetcher(
+            lambda search_after: client.get_documents(search_after, page_size),
+            obj.search_after,
+            options["prefetch_depth"],
+        )
+        pool: ContextManager = executor or nullcontext()
+        with pool, pages, self.tqdm() as progress_bar:
+            for results in pages:
+                if progress_bar.total is None:
+                    progress_bar.total = results.hits.total.value
+
+                if executor is None:
+                    self.apply_page(client, results, obj, defer_current)
+                else:
+                    self.apply_page_sharded(
+                        client, results, obj, executor, workers, defer_current
+                    )
+                progress_bar.update(len(results.hits))
 
     def handle(self, *args, **options):
         run_forever = options.pop("forever")
@@ -176,8 +419,8 @@ class Command(BaseCommand):
         if run_forever:
             while True:
                 self.write("Polling activity stream")
-                self.run(args, options)
+                self.run(*args, **options)
                 self.write(f"sleeping until {datetime.now() + timedelta(seconds=60)}")
                 sleep(sleep_time)
         else:
-            self.run(args, options)
+            self.run(*args, **options)
@@ -1,15 +1,19 @@
 import logging
+from typing import List
 
 from django.core.management import call_command
 from django.db import transaction
+from django.db.models import QuerySet
 from django_tqdm import BaseCommand
 
-from server.apps.main.models import Commit
+from server.apps.main.models import Commit, LegalBasis
 from server.apps.poller.models import ActivityStreamType
 
 
 logger = logging.getLogger(__name__)
 
+FORMS_API_DOCUMENT_PREFIX = "dit:directoryFormsApi:Submission:"
+
 
 class Command(BaseCommand):
     help = """
@@ -17,24 +21,134 @@ class Command(BaseCommand):
     any previously ingested Commit and LegalBasis instances first
 
     e.g. ./manage.py poll_formsapi_rerun
+
+    With --chunked, the old records are deleted a chunk of commits at a time,
+    the stream is loaded with the current records left unresolved, and they
+    are resolved a chunk of keys at a time at the end. Each chunk and page is
+    its own transaction, so nothing is locked for the whole rerun.
+
+    e.g. ./manage.py poll_formsapi_rerun --chunked --workers 4
     """
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            action="store",
+            type=int,
+            help="How many processes poll_formsapi writes each page with, default: 1",
+            default=1,
+        )
+
+        parser.add_argument(
+            "--chunked",
+            action="store_true",
+            help="Delete and rebuild in chunks rather than in one transaction",
+        )
+
+        parser.add_argument(
+            "--chunk-size",
+            action="store",
+            type=int,
+            help="How many commits to delete, or keys to resolve, at a time, default: 1000",
+            default=1000,
+        )
+
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help=(
+                "Carry on loading from the poller's checkpoint after a chunked rerun "
+                "stopped while loading. One that stopped while deleting is carried "
+                "on by running it again without --resume."
+            ),
+        )
+
+    @staticmethod
+    def forms_api_commits() -> QuerySet:
+        return Commit.objects.for_document_prefix(FORMS_API_DOCUMENT_PREFIX)
+
+    @staticmethod
+    def reset_checkpoint() -> None:
+        logger.info('Resetting the Forms API poller to the beginning')
+        activity_stream_obj, _ = ActivityStreamType.objects.get_or_create(name='dit:directoryFormsApi:Submission')
+        activity_stream_obj.last_document_timestamp = None
+        activity_stream_obj.last_document_id = ''
+        activity_stream_obj.save(update_fields=['last_document_timestamp', 'last_document_id'])
+
     def handle(self, *args, **options) -> None:
+        workers = options["workers"]
+
+        if options["chunked"]:
+            self.rerun_chunked(workers, options["chunk_size"], options["resume"])
+            return
 
         with transaction.atomic():
             logger.info('Deleting all Commits created by the Forms API poller')
-            for commit in Commit.objects.filter(
-                extra__id__startswith="dit:directoryFormsApi:Submission:"
-            ):
+            for commit in self.forms_api_commits():
                 logger.info('Deleting commit %s', commit)
                 commit.legalbasis_set.all().delete()
                 commit.delete()
 
-            logger.info('Resetting the Forms API poller to the beginning')
-            activity_stream_obj, _ = ActivityStreamType.objects.get_or_create(name='dit:directoryFormsApi:Submission')
-            activity_stream_obj.last_document_timestamp = None
-            activity_stream_obj.last_document_id = ''
-            activity_stream_obj.save(update_fields=['last_document_timestamp', 'last_document_id'])
+            self.reset_checkpoint()
+
+            if workers <= 1:
+                logger.info('Running the Forms API poller')
+                call_command('poll_formsapi')
+
+        # The worker processes write in their own transactions, so the reset
+        # has to be committed before they start
+        if workers > 1:
+            logger.info('Running the Forms API poller with %s workers', workers)
+            call_command('poll_formsapi', workers=workers)
+
+    def rerun_chunked(self, workers: int, chunk_size: int, resume: bool) -> None:
+        if not resume:
+            self.delete_commits(chunk_size)
+            self.reset_checkpoint()
+
+        logger.info('Running the Forms API poller with %s workers', workers)
+        call_command('poll_formsapi', workers=workers, defer_current=True)
 
-            logger.info('Running the Forms API poller')
-            call_command('poll_formsapi')
+        self.resolve_current(chunk_size)
+
+    def delete_commits(self, chunk_size: int) -> None:
+        """
+        Deletes the Forms API commits and their legal bases, a chunk of commits
+        per transaction. Stopping part way leaves whole chunks deleted, and
+        running again carries on with the rest.
+        """
+        commits = self.forms_api_commits()
+        logger.info('Deleting all Commits created by the Forms API poller')
+        with self.tqdm(total=commits.count(), desc="Deleting commits") as progress_bar:
+            while True:
+                with transaction.atomic():
+                    commit_ids = list(commits.values_list("pk", flat=True)[:chunk_size])
+                    if not commit_ids:
+                        break
+                    LegalBasis.objects.filter(commit_id__in=commit_ids).bulk_delete()
+                    Commit.objects.filter(pk__in=commit_ids).delete()
+                progress_bar.update(len(commit_ids))
+
+    def resolve_current(self, chunk_size: int) -> None:
+        """Resolves the current record for every key with a Forms API record"""
+        keys = (
+            LegalBasis.objects.filter(commit__in=self.forms_api_commits())
+            .values_list("key", flat=True)
+            .distinct()
+        )
+        logger.info('Resolving the current records for the Forms API keys')
+        with self.tqdm(desc="Resolving current records") as progress_bar:
+            chunk: List[bytes] = []
+            for key in keys.iterator(chunk_size=chunk_size):
+                chunk.append(bytes(key))
+                if len(chunk) == chunk_size:
+                    self._resolve_chunk(chunk)
+                    progress_bar.update(len(chunk))
+                    chunk = []
+            self._resolve_chunk(chunk)
+            progress_bar.update(len(chunk))
+
+    @staticmethod
+    def _resolve_chunk(keys: List[bytes]) -> None:
+        with transaction.atomic():
+            LegalBasis.objects.resolve_current(keys)
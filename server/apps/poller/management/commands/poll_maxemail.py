@@ -1,16 +1,21 @@
 from datetime import datetime, timedelta
 from time import sleep
+from typing import Dict, Iterable, List, Optional
 
-from actstream import action
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import User
 from django.db import transaction
-from django.db.models import Model
 from django.utils.functional import cached_property
 from django_tqdm import BaseCommand
 
+from server.apps.main.consent_registry import consent_registry
 from server.apps.main.models import KEY_TYPE, Commit, Consent, LegalBasis
 from server.apps.poller.api_client.maxemail import MaxEmail
+from server.apps.poller.management.commands.poll_formsapi import (
+    LegalBasisRecord,
+    write_records,
+)
 
 queryset = LegalBasis.objects.filter(current=True)
 
@@ -36,69 +41,94 @@ class Command(BaseCommand):
             default=60,
         )
 
-    @cached_property
+        parser.add_argument(
+            "--batch-size",
+            action="store",
+            type=int,
+            help="How many unsubscribes to write per batch, default: 1000",
+            default=1000,
+        )
+
+    @property
     def email_consent(self) -> Consent:
-        email_consent, _ = Consent.objects.get_or_create(name="email_marketing")
-        return email_consent
+        return consent_registry.get_or_create("email_marketing")
 
     def get_client(self) -> MaxEmail:
         return MaxEmail(settings.MAXEMAIL_USERNAME, settings.MAXEMAIL_PASSWORD)  # type: ignore
 
+    @cached_property
+    def maxemail_user(self) -> User:
+        return get_user_model().objects.get_or_create(username="maxemail")[0]
+
     @transaction.atomic()
-    def update_consent(self, email_address, meta=None) -> None:
-        self.write("Updating consent")
+    def update_consents(self, email_addresses: List[str], meta=None) -> None:
+        """
+        Opts the email addresses out, with a commit and a Create action for
+        each, in one transaction
+        """
+        self.write(f"Updating consent for {len(email_addresses)} email addresses")
         if meta is None:
             meta = {}
-        commit = Commit(extra=meta)
-        commit.source = meta.get("url", settings.MAXEMAIL_BASE_URL)
-        commit.save()
-
-        self._update_email_consent(commit, email_address, False)
-
-    def _send_action(self, instance: Model) -> None:
-        User = get_user_model()
-        maxemail_user, _ = User.objects.get_or_create(username="maxemail")
-        action_kwargs = {
-            "sender": maxemail_user,
-            "action_object": instance,
-            "verb": "Create",
-        }
-        action.send(**action_kwargs)
-
-    def _update_email_consent(
-        self, commit, email_address, email_contact_consent
-    ) -> None:
-        if email_address:
-            obj: LegalBasis = LegalBasis(
-                email=email_address, commit=commit, key_type=KEY_TYPE.EMAIL
-            )
-            obj.save()
-            if email_contact_consent:
-                obj.consents.add(self.email_consent)
-            else:
-                obj.consents.remove(self.email_consent)
-
-            self._send_action(obj)
-
-    def _should_update(self, email_address) -> bool:
-        # check if there is already a legal basis for this email address
-        try:
-            lb: LegalBasis = queryset.get(email=email_address)
-        except LegalBasis.DoesNotExist:
-            return True
-
-        # check if it is already opted out
-        if self.email_consent in lb.consents.all():
-            return True
-
-        return False
+        commits = [
+            Commit(extra=meta, source=meta.get("url", settings.MAXEMAIL_BASE_URL))
+            for _ in email_addresses
+        ]
+        Commit.objects.bulk_create(commits)
+
+        records: List[LegalBasisRecord] = [
+            (LegalBasis(email=email_address, commit=commit, key_type=KEY_TYPE.EMAIL), [])
+            for email_address, commit in zip(email_addresses, commits)
+        ]
+        write_records(records, self.maxemail_user)
+
+    @staticmethod
+    def _current_consents(email_addresses: Iterable[str]) -> Dict[str, bool]:
+        """
+        Returns whether the current legal basis for each of the email addresses
+        that has one consents to email marketing, in one query
+        """
+        return dict(
+            queryset.filter(key_type=KEY_TYPE.EMAIL, email__in=email_addresses)
+            .with_consent_flags(["email_marketing"])
+            .values_list("email", "email_marketing_consent")
+        )
+
+    def _should_update(
+        self, email_address, current_consents: Optional[Dict[str, bool]] = None
+    ) -> bool:
+        if current_consents is None:
+            current_consents = self._current_consents([email_address])
+
+        # Update if there is no legal basis for this email address yet, or if
+        # it isn't already opted out
+        return current_consents.get(email_address, True)
+
+    def _write_batch(self, email_addresses: List[str]) -> int:
+        """
+        Opts out the email addresses in the batch that aren't opted out already,
+        and returns how many were
+        """
+        current_consents = self._current_consents(email_addresses)
+
+        updates = []
+        for email_address in email_addresses:
+            if self._should_update(email_address, current_consents):
+                updates.append(email_address)
+                # A repeat of the address in the batch is then already opted out
+                current_consents[email_address] = False
+
+        if updates:
+            self.update_consents(updates)
+        return len(updates)
 
     def run(self, *args, **options) -> None:
         client = self.get_client()
+        batch_size = options["batch_size"]
 
         unsub_list_id = self._get_unsub_list_id(client)
 
         count = updated = 0
+        batch: List[str] = []
         for recipient in client.get_members_for_list(unsub_list_id):
             count += 1
             email_address = recipient["email_address"]
@@ -107,9 +137,13 @@ class Command(BaseCommand):
 
             self.write(f"Got email address {email_log_str}")
 
-            if self._should_update(email_address):
-                self.update_consent(email_address)
-                updated += 1
+            batch.append(email_address)
+            if len(batch) == batch_size:
+                updated += self._write_batch(batch)
+                batch = []
+
+        if batch:
+            updated += self._write_batch(batch)
 
         self.write(f"Updated {updated} records out of {count} in total")
 
@@ -128,10 +162,10 @@ class Command(BaseCommand):
         if run_forever:
             while True:
                 self.write("Polling maxemail")
-                self.run(args, options)
+                self.run(*args, **options)
                 self.write(
                     f"sleeping until {datetime.now() + timedelta(seconds=sleep_time)}"
                 )
                 sleep(sleep_time)
         else:
-            self.run(args, options)
+            self.run(*args, **options)
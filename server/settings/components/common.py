@@ -52,6 +52,7 @@ INSTALLED_APPS: Tuple[str, ...] = (
     "django.contrib.messages",
     "django.contrib.staticfiles",
     "django.contrib.sites",
+    "django.contrib.postgres",
     # django-admin:
     "django.contrib.admin",
     "django.contrib.admindocs",
@@ -284,6 +285,40 @@ SECURE_PROXY_SSL_HEADER = ("HTTP_X_FORWARDED_PROTO", "https")
 
 CONSENT_TYPES = ("email_marketing", "phone_marketing")
 
+# How often, in seconds, each process checks whether Consents have changed since
+# it loaded them
+CONSENT_REGISTRY_CHECK_INTERVAL = env.int("CONSENT_REGISTRY_CHECK_INTERVAL", default=5)
+
+# Maximum number of records accepted by a single /person/bulk_create/ request
+LEGAL_BASIS_BULK_CREATE_MAX_ITEMS = env.int(
+    "LEGAL_BASIS_BULK_CREATE_MAX_ITEMS", default=1000
+)
+
+# Rows fetched per round trip by the streaming /person/datahub_export.<format> endpoints
+DATAHUB_EXPORT_CHUNK_SIZE = env.int("DATAHUB_EXPORT_CHUNK_SIZE", default=2000)
+
+# Maximum number of emails, phones and keys accepted by a single POST to /person/bulk_lookup/
+LEGAL_BASIS_BULK_LOOKUP_MAX_ITEMS = env.int("LEGAL_BASIS_BULK_LOOKUP_MAX_ITEMS", default=20000)
+
+# Seconds a /person/<email>/ lookup stays cached; records are also removed from
+# the cache whenever they change
+LEGAL_BASIS_LOOKUP_CACHE_TIMEOUT = env.int("LEGAL_BASIS_LOOKUP_CACHE_TIMEOUT", default=300)
+
+# Activity feed paging: the default and largest `page_size`, and the default for
+# the `count` query parameter, one of "exact", "estimate", "cached" or "none"
+ACTIVITY_FEED_PAGE_SIZE = env.int("ACTIVITY_FEED_PAGE_SIZE", default=10)
+ACTIVITY_FEED_MAX_PAGE_SIZE = env.int("ACTIVITY_FEED_MAX_PAGE_SIZE", default=1000)
+ACTIVITY_FEED_COUNT_MODE = env.str("ACTIVITY_FEED_COUNT_MODE", default="exact")
+ACTIVITY_FEED_COUNT_CACHE_TIMEOUT = env.int("ACTIVITY_FEED_COUNT_CACHE_TIMEOUT", default=60)
+
+# Seconds the encoded items of activity feed pages behind the head are cached
+ACTIVITY_FEED_PAGE_CACHE_TIMEOUT = env.int("ACTIVITY_FEED_PAGE_CACHE_TIMEOUT", default=3600)
+# Seconds after its newest action's timestamp before a page is cached. Actions
+# are inserted when the audit buffer or poller page holding them is written,
+# after their timestamp, so until then an older action can still be added to
+# the page. This should be longer than any of those transactions.
+ACTIVITY_FEED_PAGE_SETTLE_TIME = env.int("ACTIVITY_FEED_PAGE_SETTLE_TIME", default=300)
+
 # Adobe Campaigns
 
 ADOBE_PRIVATE_KEY = env.str("ADOBE_PRIVATE_KEY", "").replace(
@@ -1,3 +1,5 @@
+from server.settings.components import env
+
 # Django Rest Framework (same as datahub-api)
 
 REST_FRAMEWORK = {
@@ -15,3 +17,28 @@ REST_FRAMEWORK = {
     "ORDERING_PARAM": "sortby",
     "TEST_REQUEST_DEFAULT_FORMAT": "json",
 }
+
+# Default for the `count` query parameter of ProtocolLessLimitOffsetPagination:
+# one of "exact", "estimate", "cached" or "none"
+API_PAGINATION_COUNT_MODE = env.str("API_PAGINATION_COUNT_MODE", default="exact")
+API_PAGINATION_COUNT_CACHE_TIMEOUT = env.int(
+    "API_PAGINATION_COUNT_CACHE_TIMEOUT", default=60
+)
+
+# Seconds that Hawk credentials, with the user and their permissions, are cached
+# in each process and in the shared cache. They are also invalidated whenever a
+# token, user, group or permission changes.
+HAWK_CREDENTIALS_LOCAL_CACHE_TIMEOUT = env.int(
+    "HAWK_CREDENTIALS_LOCAL_CACHE_TIMEOUT", default=5
+)
+HAWK_CREDENTIALS_CACHE_TIMEOUT = env.int("HAWK_CREDENTIALS_CACHE_TIMEOUT", default=60)
+
+# Where Hawk nonces are kept to stop requests being replayed: "redis", or
+# "memory", which is only suitable for a single process, such as in tests
+HAWK_NONCE_STORE = env.str("HAWK_NONCE_STORE", default="redis")
+
+# Bytes of a streaming response's body held in memory while its payload hash is
+# calculated, beyond which the body is spooled to a temporary file
+HAWK_RESPONSE_SPOOL_MAX_MEMORY = env.int(
+    "HAWK_RESPONSE_SPOOL_MAX_MEMORY", default=10 * 1024 * 1024
+)
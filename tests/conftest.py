@@ -8,8 +8,13 @@ It may be also used for extending doctest's context:
 
 import pytest
 from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
 from rest_framework.authtoken.models import Token
 
+from server.apps.main.consent_registry import consent_registry
+from server.apps.main.credentials import credential_cache
+from server.apps.main.nonces import get_nonce_store
+
 
 @pytest.fixture(autouse=True)
 def _media_root(settings, tmpdir_factory):
@@ -31,6 +36,15 @@ def _auth_backends(settings):
     settings.AUTHENTICATION_BACKENDS = ("django.contrib.auth.backends.ModelBackend",)
 
 
+@pytest.fixture(autouse=True)
+def _clear_cache():
+    """Stops cached values leaking between tests."""
+    cache.clear()
+    consent_registry.clear()
+    credential_cache.clear()
+    get_nonce_store().clear()
+
+
 @pytest.fixture
 def authenticated_client(client, django_user_model):
     username = "user1"
@@ -0,0 +1,56 @@
+import pytest
+from django.core.cache import cache
+from mixer.backend.django import mixer
+from rest_framework.exceptions import ValidationError
+
+from server.apps.api.serializers import ConsentNameField
+from server.apps.main.consent_registry import VERSION_CACHE_KEY, consent_registry
+from server.apps.main.models import Consent
+
+
+class TestConsentRegistry:
+    pytestmark = pytest.mark.django_db
+
+    def test_consents_are_loaded_once(self, django_assert_num_queries):
+        consent = mixer.blend(Consent, name="email_marketing")
+
+        with django_assert_num_queries(1):
+            assert consent_registry.get("email_marketing") == consent
+            assert consent_registry.get("email_marketing") == consent
+            assert "email_marketing" in consent_registry.names()
+
+    def test_saving_a_consent_reloads_the_registry(self):
+        assert "email_marketing" not in consent_registry.names()
+
+        consent = mixer.blend(Consent, name="email_marketing")
+
+        assert consent_registry.get("email_marketing") == consent
+
+    def test_version_change_reloads_the_registry(self, settings, django_assert_num_queries):
+        settings.CONSENT_REGISTRY_CHECK_INTERVAL = 0
+        consent_registry.names()
+
+        with django_assert_num_queries(0):
+            consent_registry.names()
+
+        # As another process would after saving a Consent
+        cache.set(VERSION_CACHE_KEY, "changed")
+        with django_assert_num_queries(1):
+            consent_registry.names()
+
+    def test_get_or_create(self):
+        with pytest.raises(Consent.DoesNotExist):
+            consent_registry.get("email_marketing")
+
+        consent = consent_registry.get_or_create("email_marketing")
+
+        assert consent.pk
+        assert consent_registry.get_or_create("email_marketing") == consent
+
+    def test_consent_name_field(self):
+        consent = mixer.blend(Consent, name="email_marketing")
+        field = ConsentNameField(slug_field="name", queryset=Consent.objects.all())
+
+        assert field.to_internal_value("email_marketing") == consent
+        with pytest.raises(ValidationError):
+            field.to_internal_value("phone_marketing")
@@ -0,0 +1,24 @@
+import pytest
+from mixer.backend.django import mixer
+
+from server.apps.main.counts import cached_count, estimated_count
+from server.apps.main.models import Consent
+
+
+class TestCounts:
+    pytestmark = pytest.mark.django_db
+
+    def test_estimated_count(self):
+        assert isinstance(estimated_count(Consent.objects.all()), int)
+
+    def test_cached_count(self, django_assert_num_queries):
+        mixer.cycle(2).blend(Consent)
+        queryset = Consent.objects.all()
+        count = queryset.count()
+
+        with django_assert_num_queries(1):
+            assert cached_count(queryset, 60) == count
+
+        mixer.blend(Consent)
+        with django_assert_num_queries(0):
+            assert cached_count(Consent.objects.all(), 60) == count
@@ -0,0 +1,79 @@
+from unittest.mock import patch
+
+import pytest
+from django.contrib.auth.models import Group, Permission
+from mohawk import Sender
+from rest_framework.authtoken.models import Token
+
+from server.apps.main.auth import HawkUserAuthentication
+from server.apps.main.credentials import credential_cache
+
+
+class TestCredentialCache:
+    pytestmark = pytest.mark.django_db
+
+    @pytest.fixture
+    def user(self, django_user_model):
+        user = django_user_model.objects.create_user(username="read-only")
+        Token.objects.create(user=user, key="test-hawk-key")
+        group = Group.objects.create(name="Read only users")
+        group.permissions.add(Permission.objects.get(codename="view_legalbasis"))
+        user.groups.add(group)
+        return user
+
+    def test_warm_credentials_need_no_queries(self, user, django_assert_num_queries):
+        credentials = credential_cache.get("read-only")
+        assert credentials.key == "test-hawk-key"
+        assert credentials.user == user
+
+        with django_assert_num_queries(0):
+            credentials = credential_cache.get("read-only")
+            assert credentials.user.has_perm("main.view_legalbasis")
+            assert not credentials.user.has_perm("main.add_legalbasis")
+
+    def test_credentials_are_shared_between_processes(self, user, django_assert_num_queries):
+        credential_cache.get("read-only")
+        # As a new process would start out
+        credential_cache.clear()
+
+        with django_assert_num_queries(0):
+            credentials = credential_cache.get("read-only")
+            assert credentials.user.has_perm("main.view_legalbasis")
+
+    def test_permission_changes_invalidate_credentials(self, user):
+        assert credential_cache.get("read-only").user.has_perm("main.view_legalbasis")
+
+        Group.objects.get().permissions.clear()
+
+        assert not credential_cache.get("read-only").user.has_perm("main.view_legalbasis")
+
+    def test_token_changes_invalidate_credentials(self, user):
+        credential_cache.get("read-only")
+
+        Token.objects.filter(user=user).delete()
+        Token.objects.create(user=user, key="new-hawk-key")
+
+        assert credential_cache.get("read-only").key == "new-hawk-key"
+
+    def test_unknown_hawk_id(self, user):
+        with pytest.raises(Token.DoesNotExist):
+            credential_cache.get("unknown")
+
+    def test_request_is_authenticated_with_one_lookup(self, user, rf):
+        url = "http://testserver/api/v1/person/"
+        sender = Sender(
+            {"id": "read-only", "key": "test-hawk-key", "algorithm": "sha256"},
+            url,
+            "GET",
+            content="",
+            content_type="",
+        )
+        request = rf.get(url, HTTP_AUTHORIZATION=sender.request_header)
+        # The token is deleted once it has been looked up
+        lookups = [credential_cache.get("read-only"), Token.DoesNotExist]
+
+        with patch.object(credential_cache, "get", side_effect=lookups) as get:
+            authenticated_user, _ = HawkUserAuthentication().authenticate(request)
+
+        assert authenticated_user == user
+        get.assert_called_once_with("read-only")
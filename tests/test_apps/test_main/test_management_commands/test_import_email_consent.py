@@ -0,0 +1,29 @@
+import io
+
+import pytest
+from django.core.management import call_command
+
+from server.apps.main.models import Commit, LegalBasis
+
+
+class TestImportEmailConsentCommand:
+
+    pytestmark = pytest.mark.django_db
+
+    def test_import_in_batches(self, tmp_path):
+        csv_file = tmp_path / "consent.csv"
+        csv_file.write_text(
+            "email,accepts_dit_email_marketing,modified_at\n"
+            "foo@bar.com,TRUE,2015-05-01T00:00:01Z\n"
+            "baz@bar.com,FALSE,2015-05-01T00:00:01Z\n"
+            "foo@bar.com,FALSE,2016-05-01T00:00:01Z\n"
+        )
+
+        call_command("import_email_consent", str(csv_file), batch_size=2, stdout=io.StringIO())
+
+        assert Commit.objects.count() == 1
+        assert LegalBasis.objects.count() == 3
+        foo = LegalBasis.objects.get(email="foo@bar.com", current=True)
+        assert foo.modified_at.year == 2016
+        assert not foo.consents.exists()
+        assert not LegalBasis.objects.get(email="baz@bar.com").consents.exists()
@@ -1,11 +1,16 @@
-import uuid
-from unittest.mock import Mock, call, patch
+import threading
+from unittest.mock import Mock, patch
 
 import pytest
-from django.db.models.signals import m2m_changed, post_delete, post_save
+from actstream.models import Action
+from django.db import DatabaseError, connection
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from mixer.backend.django import mixer
 
+from server.apps.main.audit import current_audit
 from server.apps.main.middleware import AuditLogMiddleware
-from server.apps.main.models import LegalBasis
+from server.apps.main.models import Commit, Consent, LegalBasis
 
 
 class TestAuditLogMiddleWare:
@@ -15,236 +20,146 @@ class TestAuditLogMiddleWare:
     def setup_class(cls):
         cls.get_response = Mock()
 
-    @classmethod
-    def is_valid_uuid(cls, v):
-        try:
-            uuid.UUID(str(v))
-            return True
-        except ValueError:
-            return False
-
-    def test_init(self):
-        middleware = AuditLogMiddleware(self.get_response)
-        assert middleware.get_response == self.get_response
-
-    @patch.object(AuditLogMiddleware, "make_m2m_signal_receiver")
-    @patch.object(AuditLogMiddleware, "make_save_signal_receiver")
-    @patch.object(AuditLogMiddleware, "make_delete_signal_receiver")
-    def test_get_signal_calls(
-        self,
-        make_delete_signal_receiver,
-        make_save_signal_receiver,
-        make_m2m_signal_receiver,
-    ):
-        middleware = AuditLogMiddleware(self.get_response)
-
-        request = Mock()
-        calls = middleware.get_signal_calls(request)
-
-        assert calls[0]["signal"] == post_save
-        assert calls[0]["kwargs"]["sender"] == LegalBasis
-        assert callable(calls[0]["kwargs"]["receiver"])
-        assert self.is_valid_uuid(calls[0]["kwargs"]["dispatch_uid"])
-
-        assert calls[1]["signal"] == post_delete
-        assert calls[1]["kwargs"]["sender"] == LegalBasis
-        assert callable(calls[1]["kwargs"]["receiver"])
-        assert self.is_valid_uuid(calls[1]["kwargs"]["dispatch_uid"])
-
-        assert calls[2]["signal"] == m2m_changed
-        assert calls[2]["kwargs"]["sender"] == LegalBasis.consents.through
-        assert callable(calls[2]["kwargs"]["receiver"])
-        assert self.is_valid_uuid(calls[2]["kwargs"]["dispatch_uid"])
-
-        make_delete_signal_receiver.assert_called_once_with(request)
-        make_save_signal_receiver.assert_called_once_with(request)
-        make_m2m_signal_receiver.assert_called_once_with(request)
+    @staticmethod
+    def _call(rf, user, get_response, remote_addr="192.168.0.1"):
+        request = rf.post("/", REMOTE_ADDR=remote_addr)
+        request.user = user
+        return AuditLogMiddleware(get_response)(request)
 
-    @patch.object(AuditLogMiddleware, "get_remote_addr")
-    @patch("server.apps.main.middleware.action")
-    def test_make_save_signal_receiver_when_created(self, action, get_remote_addr):
-        middleware = AuditLogMiddleware(self.get_response)
-
-        get_remote_addr.return_value = "127.0.0.1"
-        request = Mock()
-        instance = Mock()
-
-        middleware.make_save_signal_receiver(request)(
-            Mock(), instance=instance, created=True
-        )
-
-        action.send.assert_called_once_with(
-            sender=request.user,
-            action_object=instance,
-            verb="Create",
-            remote_addr="127.0.0.1",
-        )
-
-    @patch.object(AuditLogMiddleware, "get_remote_addr")
-    @patch("server.apps.main.middleware.action")
-    def test_make_save_signal_receiver_when_updated(self, action, get_remote_addr):
-        middleware = AuditLogMiddleware(self.get_response)
-
-        get_remote_addr.return_value = "127.0.0.1"
-        instance = Mock()
-        request = Mock()
-
-        middleware.make_save_signal_receiver(request)(
-            Mock(), instance=instance, created=False
-        )
-
-        action.send.assert_called_once_with(
-            sender=request.user,
-            action_object=instance,
-            verb="Update",
-            remote_addr="127.0.0.1",
-        )
+    @pytest.fixture
+    def call(self, rf, django_capture_on_commit_callbacks):
+        """Handles a request, running the callbacks the test's transaction holds back"""
 
-    @patch.object(AuditLogMiddleware, "get_remote_addr")
-    @patch("server.apps.main.middleware.action")
-    def test_make_delete_signal_receiver(self, action, get_remote_addr):
-        middleware = AuditLogMiddleware(self.get_response)
+        def call(user, get_response):
+            with django_capture_on_commit_callbacks(execute=True):
+                return self._call(rf, user, get_response)
 
-        get_remote_addr.return_value = "127.0.0.1"
-        instance = Mock()
-        request = Mock()
-        middleware.make_delete_signal_receiver(request)(Mock(), instance=instance)
+        return call
 
-        action.send.assert_called_once_with(
-            sender=request.user,
-            action_object=instance,
-            verb="Delete",
-            remote_addr="127.0.0.1",
-        )
+    @staticmethod
+    def _legal_basis():
+        return LegalBasis(email="foo@bar.com", key_type="email", commit=mixer.blend(Commit))
 
-    @patch.object(AuditLogMiddleware, "handle_m2m_post_add_remove_actions")
-    @patch.object(AuditLogMiddleware, "get_remote_addr")
-    def test_m2m_signal_receiver_with_post_add(
-        self, get_remote_addr, handle_m2m_post_add_remove_actions
-    ):
+    def test_init(self):
         middleware = AuditLogMiddleware(self.get_response)
+        assert middleware.get_response == self.get_response
 
-        get_remote_addr.return_value = "127.0.0.1"
-        instance = Mock()
-        request = Mock()
-
-        action_kwargs = {"sender": request.user, "remote_addr": "127.0.0.1"}
-
-        middleware.make_m2m_signal_receiver(request)(
-            Mock(), instance=instance, action="post_add", pk_set=[1, 2, 3]
-        )
-        handle_m2m_post_add_remove_actions.assert_called_once_with(
-            instance=instance,
-            action_kwargs=action_kwargs,
-            action_name="post_add",
-            pk_set=[1, 2, 3],
-        )
-
-    @patch.object(AuditLogMiddleware, "handle_m2m_post_add_remove_actions")
-    @patch.object(AuditLogMiddleware, "get_remote_addr")
-    def test_m2m_signal_receiver_with_post_remove(
-        self, get_remote_addr, handle_m2m_post_add_remove_actions
+    def test_save_and_delete_are_recorded(self, call, admin_user):
+        def get_response(request):
+            obj = self._legal_basis()
+            obj.save()
+            obj.save()
+            obj.delete()
+            return HttpResponse()
+
+        call(admin_user, get_response)
+
+        assert list(Action.objects.order_by("id").values_list("verb", flat=True)) == [
+            "Create", "Update", "Delete",
+        ]
+        action = Action.objects.first()
+        assert action.actor == admin_user
+        assert action.data == {"remote_addr": "192.168.0.1"}
+
+    def test_consent_changes_are_recorded(self, call, admin_user):
+        consent = mixer.blend(Consent)
+        obj = self._legal_basis()
+        obj.save()
+
+        def get_response(request):
+            obj.consents.add(consent)
+            obj.consents.remove(consent)
+            obj.consents.clear()
+            consent.legalbasis_set.add(obj)
+            return HttpResponse()
+
+        call(admin_user, get_response)
+
+        actions = list(Action.objects.order_by("id"))
+        assert [action.verb for action in actions] == ["Add", "Remove", "Update", "Add"]
+        assert actions[0].action_object == consent
+        assert actions[0].target == obj
+        assert actions[2].action_object == obj
+        assert actions[3].action_object == consent
+        assert actions[3].target == obj
+
+    def test_actions_are_written_in_one_statement(self, call, admin_user):
+        consents = mixer.cycle(2).blend(Consent)
+
+        def get_response(request):
+            obj = self._legal_basis()
+            obj.save()
+            obj.consents.add(*consents)
+            return HttpResponse()
+
+        with CaptureQueriesContext(connection) as queries:
+            call(admin_user, get_response)
+
+        inserts = [q for q in queries if q["sql"].startswith('INSERT INTO "actstream_action"')]
+        assert len(inserts) == 1
+        assert sorted(Action.objects.values_list("verb", flat=True)) == ["Add", "Add", "Create"]
+
+    def test_actions_are_written_once_the_transaction_commits(
+        self, rf, admin_user, django_capture_on_commit_callbacks
     ):
-        middleware = AuditLogMiddleware(self.get_response)
-
-        get_remote_addr.return_value = "127.0.0.1"
-        instance = Mock()
-        request = Mock()
+        def get_response(request):
+            self._legal_basis().save()
+            return HttpResponse()
 
-        action_kwargs = {"sender": request.user, "remote_addr": "127.0.0.1"}
+        with django_capture_on_commit_callbacks() as callbacks:
+            self._call(rf, admin_user, get_response)
 
-        middleware.make_m2m_signal_receiver(request)(
-            Mock(), instance=instance, action="post_remove", pk_set=[3, 4, 5]
-        )
-        handle_m2m_post_add_remove_actions.assert_called_once_with(
-            instance=instance,
-            action_kwargs=action_kwargs,
-            action_name="post_remove",
-            pk_set=[3, 4, 5],
-        )
+        assert not Action.objects.exists()
 
-    @patch.object(AuditLogMiddleware, "handle_m2m_post_clear_action")
-    @patch.object(AuditLogMiddleware, "get_remote_addr")
-    def test_m2m_signal_receiver_with_post_clear(
-        self, get_remote_addr, handle_m2m_post_clear_action,
-    ):
-        middleware = AuditLogMiddleware(self.get_response)
+        for callback in callbacks:
+            callback()
 
-        get_remote_addr.return_value = "127.0.0.1"
-        instance = Mock()
-        request = Mock()
+        assert list(Action.objects.values_list("verb", flat=True)) == ["Create"]
 
-        action_kwargs = {"sender": request.user, "remote_addr": "127.0.0.1"}
+    def test_failed_write_is_logged_not_raised(self, call, admin_user):
+        def get_response(request):
+            self._legal_basis().save()
+            return HttpResponse("ok")
 
-        middleware.make_m2m_signal_receiver(request)(
-            Mock(), instance=instance, action="post_clear"
-        )
-        handle_m2m_post_clear_action.assert_called_once_with(
-            instance=instance, action_kwargs=action_kwargs,
-        )
+        with patch.object(Action.objects, "bulk_create", side_effect=DatabaseError), patch(
+            "server.apps.main.audit.logger"
+        ) as logger:
+            response = call(admin_user, get_response)
 
-    @patch("server.apps.main.middleware.Consent")
-    @patch("server.apps.main.middleware.action")
-    def test_handle_m2m_post_add_remove_actions_with_post_add(self, action, Consent):
-        middleware = AuditLogMiddleware(self.get_response)
-        instance = Mock()
+        assert response.content == b"ok"
+        logger.exception.assert_called_once_with("1 actions could not be written")
 
-        middleware.handle_m2m_post_add_remove_actions(
-            instance=instance,
-            action_kwargs={},
-            action_name="post_add",
-            pk_set=[1, 2, 3],
-        )
+    def test_failed_write_does_not_hide_the_request_error(self, call, admin_user):
+        def get_response(request):
+            self._legal_basis().save()
+            raise ValueError("from the view")
 
-        kwargs = {
-            "target": instance,
-            "verb": "Add",
-        }
-
-        action.send.assert_has_calls(
-            [
-                call(action_object=Consent.objects.get(pk=1), **kwargs),
-                call(action_object=Consent.objects.get(pk=2), **kwargs),
-                call(action_object=Consent.objects.get(pk=3), **kwargs),
-            ]
-        )
+        with patch.object(Action.objects, "bulk_create", side_effect=DatabaseError):
+            with pytest.raises(ValueError, match="from the view"):
+                call(admin_user, get_response)
 
-    @patch("server.apps.main.middleware.Consent")
-    @patch("server.apps.main.middleware.action")
-    def test_handle_m2m_post_add_remove_actions_with_post_remove(self, action, Consent):
-        middleware = AuditLogMiddleware(self.get_response)
-        instance = Mock()
+    def test_changes_outside_a_request_are_not_recorded(self):
+        self._legal_basis().save()
 
-        middleware.handle_m2m_post_add_remove_actions(
-            instance=instance,
-            action_kwargs={},
-            action_name="post_remove",
-            pk_set=[3, 4, 5],
-        )
+        assert current_audit.get() is None
+        assert not Action.objects.exists()
 
-        kwargs = {
-            "target": instance,
-            "verb": "Remove",
-        }
-
-        action.send.assert_has_calls(
-            [
-                call(action_object=Consent.objects.get(pk=3), **kwargs),
-                call(action_object=Consent.objects.get(pk=4), **kwargs),
-                call(action_object=Consent.objects.get(pk=5), **kwargs),
-            ]
-        )
+    def test_concurrent_requests_see_their_own_request(self, rf):
+        both_in_progress = threading.Barrier(2)
+        seen = {}
 
-    @patch("server.apps.main.middleware.action")
-    def test_handle_m2m_post_clear_action(self, action):
-        middleware = AuditLogMiddleware(self.get_response)
-        instance = Mock()
+        def get_response(request):
+            # Wait until both requests are being handled before looking
+            both_in_progress.wait(timeout=5)
+            seen[request.user] = current_audit.get().request.user
+            return HttpResponse()
 
-        middleware.handle_m2m_post_clear_action(
-            instance=instance, action_kwargs={},
-        )
+        thread = threading.Thread(target=self._call, args=(rf, "other", get_response))
+        thread.start()
+        self._call(rf, "admin", get_response)
+        thread.join()
 
-        action.send.assert_called_once_with(verb="Update", action_object=instance)
+        assert seen == {"admin": "admin", "other": "other"}
 
     def test_get_remote_addr_x_forwarded_for(self):
         middleware = AuditLogMiddleware(self.get_response)
@@ -0,0 +1,47 @@
+import pytest
+from django.db import connection
+
+from server.apps.main.models import Commit
+
+
+class TestCommitLookups:
+    pytestmark = pytest.mark.django_db
+
+    @pytest.fixture(autouse=True)
+    def _commits(self):
+        Commit.objects.create(source="/contact/", extra={"id": "dit:directoryFormsApi:Submission:1:Create"})
+        Commit.objects.create(source="/contact/", extra={"id": "dit:directoryFormsApi:Submission:2:Create"})
+        Commit.objects.create(source="maxemail", extra={"id": "maxemail:1"})
+        Commit.objects.create(source="admin", extra={})
+
+    def test_for_document(self):
+        commit = Commit.objects.for_document("maxemail:1").get()
+
+        assert commit.source == "maxemail"
+
+    def test_for_documents(self):
+        commits = Commit.objects.for_documents(["maxemail:1", "dit:directoryFormsApi:Submission:2:Create"])
+
+        assert sorted(commit.extra["id"] for commit in commits) == [
+            "dit:directoryFormsApi:Submission:2:Create",
+            "maxemail:1",
+        ]
+
+    def test_for_document_prefix(self):
+        assert Commit.objects.for_document_prefix("dit:directoryFormsApi:Submission:").count() == 2
+
+    def test_for_source(self):
+        assert Commit.objects.for_source("/contact/").count() == 2
+        assert not Commit.objects.for_source("/other/").exists()
+
+    @pytest.mark.parametrize(("lookup", "index"), [
+        (lambda: Commit.objects.for_document("maxemail:1"), "main_commit_extra_id_idx"),
+        (lambda: Commit.objects.for_documents(["maxemail:1"]), "main_commit_extra_id_idx"),
+        (lambda: Commit.objects.for_document_prefix("maxemail:"), "main_commit_extra_id_idx"),
+        (lambda: Commit.objects.for_source("maxemail"), "main_commit_source_idx"),
+    ])
+    def test_lookups_use_an_index(self, lookup, index):
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+        assert index in lookup().explain()
@@ -0,0 +1,278 @@
+import datetime
+import hashlib
+import threading
+
+import pytest
+from django.db import IntegrityError, connection, transaction
+from mixer.backend.django import mixer
+
+from server.apps.main.models import KEY_LOCK_BUCKETS, Commit, Consent, LegalBasis
+
+
+class TestLegalBasisModel:
+    pytestmark = pytest.mark.django_db
+
+    @staticmethod
+    def _save(email, modified_at):
+        obj = LegalBasis(
+            email=email,
+            key_type="email",
+            commit=mixer.blend(Commit),
+            modified_at=modified_at,
+        )
+        obj.save()
+        return obj
+
+    def test_newer_save_becomes_current(self):
+        older = self._save("foo@bar.com", datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+        newer = self._save("foo@bar.com", datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc))
+
+        older.refresh_from_db()
+        newer.refresh_from_db()
+        assert not older.current
+        assert newer.current
+
+    def test_older_save_does_not_become_current(self):
+        newer = self._save("foo@bar.com", datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc))
+        older = self._save("foo@bar.com", datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+
+        older.refresh_from_db()
+        newer.refresh_from_db()
+        assert not older.current
+        assert newer.current
+
+    def test_equal_modified_at_keeps_first_current(self):
+        modified_at = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        first = self._save("foo@bar.com", modified_at)
+        second = self._save("foo@bar.com", modified_at)
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        assert first.current
+        assert not second.current
+
+    def test_other_keys_are_untouched(self):
+        other = self._save("other@bar.com", datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+        self._save("foo@bar.com", datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc))
+
+        other.refresh_from_db()
+        assert other.current
+
+    def test_save_resolves_current_in_one_statement(self, django_assert_num_queries):
+        self._save("foo@bar.com", datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+        commit = mixer.blend(Commit)
+
+        obj = LegalBasis(
+            email="foo@bar.com",
+            key_type="email",
+            commit=commit,
+            modified_at=datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc),
+        )
+        # One statement to lock the key, one to resolve the current flag, one
+        # to insert
+        with django_assert_num_queries(3):
+            obj.save()
+
+    @pytest.mark.parametrize(("email", "phone", "hashed"), [
+        ("Foo@Bar.com", "", "foo@bar.com"),
+        ("", "+447897395794", "+447897395794"),
+        ("", "Call Me", "Call Me"),
+    ])
+    def test_key_is_the_hash_of_the_stored_value(self, email, phone, hashed):
+        obj = LegalBasis(email=email, phone=phone, key_type="phone" if phone else "email")
+        obj.commit = mixer.blend(Commit)
+        obj.save()
+
+        assert bytes(obj.key) == hashlib.sha512(hashed.encode()).digest()
+
+    def test_only_one_current_row_per_key(self):
+        self._save("foo@bar.com", datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+        self._save("foo@bar.com", datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc))
+
+        with pytest.raises(IntegrityError):
+            LegalBasis.objects.filter(email="foo@bar.com").update(current=True)
+
+
+class TestLegalBasisConcurrentWrites:
+    pytestmark = pytest.mark.django_db(transaction=True)
+
+    @staticmethod
+    def _record(commit, year):
+        return LegalBasis(
+            email="foo@bar.com",
+            key_type="email",
+            commit=commit,
+            modified_at=datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc),
+        )
+
+    @pytest.mark.parametrize("write", [
+        lambda obj: obj.save(),
+        lambda obj: LegalBasis.objects.bulk_record([(obj, [])]),
+    ])
+    def test_writer_waits_for_a_concurrent_writer_of_the_key(self, write):
+        commit = mixer.blend(Commit)
+        first_saved = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def write_first():
+            try:
+                with transaction.atomic():
+                    self._record(commit, 2020).save()
+                    first_saved.set()
+                    release.wait(5)
+            finally:
+                connection.close()
+
+        def write_second():
+            try:
+                with transaction.atomic():
+                    write(self._record(commit, 2021))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        first = threading.Thread(target=write_first)
+        first.start()
+        assert first_saved.wait(5)
+        second = threading.Thread(target=write_second)
+        second.start()
+        second.join(0.5)
+        waited = second.is_alive()
+        release.set()
+        first.join(5)
+        second.join(5)
+
+        assert waited
+        assert errors == []
+        current = LegalBasis.objects.get(current=True)
+        assert current.modified_at.year == 2021
+        assert LegalBasis.objects.count() == 2
+
+
+class TestLegalBasisBulkRecord:
+    pytestmark = pytest.mark.django_db
+
+    def test_bulk_record_creates_rows_and_consents(self):
+        commit = mixer.blend(Commit)
+        consent = mixer.blend(Consent, name="email_marketing")
+
+        objs = LegalBasis.objects.bulk_record([
+            (LegalBasis(email="FOO@bar.com", key_type="email", commit=commit), [consent]),
+            (LegalBasis(email="baz@bar.com", key_type="email", commit=commit), []),
+        ])
+
+        assert [obj.email for obj in objs] == ["foo@bar.com", "baz@bar.com"]
+        assert all(obj.pk for obj in objs)
+        assert list(LegalBasis.objects.get(email="foo@bar.com").consents.all()) == [consent]
+        assert not LegalBasis.objects.get(email="baz@bar.com").consents.exists()
+
+    def test_bulk_record_resolves_current_per_key(self):
+        commit = mixer.blend(Commit)
+        existing = LegalBasis(
+            email="foo@bar.com",
+            key_type="email",
+            commit=commit,
+            modified_at=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        )
+        existing.save()
+
+        LegalBasis.objects.bulk_record([
+            (
+                LegalBasis(
+                    email="foo@bar.com",
+                    key_type="email",
+                    commit=commit,
+                    modified_at=datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc),
+                ),
+                [],
+            )
+            for year in (2022, 2019, 2021)
+        ])
+
+        current = LegalBasis.objects.get(email="foo@bar.com", current=True)
+        assert current.modified_at.year == 2022
+        assert LegalBasis.objects.filter(email="foo@bar.com").count() == 4
+
+    def test_bulk_record_statement_count_is_constant(self, django_assert_num_queries):
+        commit = mixer.blend(Commit)
+        consent = mixer.blend(Consent, name="email_marketing")
+        records = [
+            (LegalBasis(email=f"foo_{i}@bar.com", key_type="email", commit=commit), [consent])
+            for i in range(50)
+        ]
+
+        # Insert rows, insert through rows, lock keys, demote, promote
+        with django_assert_num_queries(5):
+            LegalBasis.objects.bulk_record(records)
+
+    def test_locks_are_bounded_however_many_keys_are_written(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT current_setting('max_locks_per_transaction')::int"
+                " * (current_setting('max_connections')::int"
+                " + current_setting('max_prepared_transactions')::int)"
+            )
+            (lock_table_size,) = cursor.fetchone()
+        commit = mixer.blend(Commit)
+
+        with transaction.atomic():
+            LegalBasis.objects.bulk_record([
+                (LegalBasis(email=f"user{i}@bar.com", key_type="email", commit=commit), [])
+                for i in range(lock_table_size + 1)
+            ])
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT COUNT(*) FROM pg_locks"
+                    " WHERE locktype = 'advisory' AND pid = pg_backend_pid()"
+                )
+                (advisory_locks,) = cursor.fetchone()
+
+        assert advisory_locks <= KEY_LOCK_BUCKETS
+        assert LegalBasis.objects.filter(current=True).count() == lock_table_size + 1
+
+    def test_bulk_record_can_defer_current(self):
+        commit = mixer.blend(Commit)
+        LegalBasis.objects.bulk_record(
+            [(LegalBasis(email="foo@bar.com", key_type="email", commit=commit), [])],
+            defer_current=True,
+        )
+        assert not LegalBasis.objects.filter(current=True).exists()
+
+        LegalBasis.objects.resolve_current(LegalBasis.objects.values_list("key", flat=True))
+
+        assert LegalBasis.objects.get().current
+
+    def test_bulk_delete_promotes_the_remaining_latest_row(self, django_assert_num_queries):
+        consent = mixer.blend(Consent, name="email_marketing")
+        save = TestLegalBasisModel._save
+        older = save("foo@bar.com", datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+        newer = save("foo@bar.com", datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc))
+        newer.consents.add(consent)
+
+        # Ids, through rows, rows, lock keys, demote, promote
+        with django_assert_num_queries(6):
+            deleted = LegalBasis.objects.filter(pk=newer.pk).bulk_delete()
+
+        assert deleted == 1
+        assert list(LegalBasis.objects.all()) == [older]
+        assert LegalBasis.objects.get().current
+        assert not LegalBasis.consents.through.objects.exists()
+
+
+class TestLegalBasisConsentFlags:
+    pytestmark = pytest.mark.django_db
+
+    def test_with_consent_flags(self):
+        email_marketing = mixer.blend(Consent, name="email_marketing")
+        phone_marketing = mixer.blend(Consent, name="phone_marketing")
+        both = mixer.blend(LegalBasis, consents=[email_marketing, phone_marketing], key=None, phone="")
+        neither = mixer.blend(LegalBasis, consents=[], key=None, phone="")
+
+        flags = {
+            obj.pk: (obj.email_marketing_consent, obj.phone_marketing_consent)
+            for obj in LegalBasis.objects.with_consent_flags(["email_marketing", "phone_marketing"])
+        }
+
+        assert flags == {both.pk: (True, True), neither.pk: (False, False)}
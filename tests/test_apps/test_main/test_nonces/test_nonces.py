@@ -0,0 +1,94 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django_redis import get_redis_connection
+
+from server.apps.main.nonces import (
+    NONCE_TIMEOUT,
+    MemoryNonceStore,
+    RedisNonceStore,
+    get_nonce_store,
+)
+
+
+@pytest.mark.parametrize("store_class", [MemoryNonceStore, RedisNonceStore])
+def test_nonces_are_only_accepted_once(store_class):
+    store = store_class()
+
+    assert not store.seen("read-only", "abc")
+    assert store.seen("read-only", "abc")
+    assert not store.seen("read-only", "def")
+    assert not store.seen("other", "abc")
+
+
+def test_memory_nonces_expire():
+    store = MemoryNonceStore()
+    with mock.patch("server.apps.main.nonces.time.monotonic", return_value=1000.0):
+        store.seen("read-only", "abc")
+
+    with mock.patch(
+        "server.apps.main.nonces.time.monotonic", return_value=1000.0 + NONCE_TIMEOUT
+    ):
+        assert not store.seen("read-only", "abc")
+
+
+@pytest.fixture
+def _switch_threads_often():
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+@pytest.mark.usefixtures("_switch_threads_often")
+def test_memory_store_is_safe_across_threads():
+    store = MemoryNonceStore()
+    # Every nonce has expired by the next check, so each call also expires one
+    with mock.patch("server.apps.main.nonces.NONCE_TIMEOUT", 0):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(
+                lambda i: store.seen("read-only", str(i)), range(20000)
+            ))
+
+    assert not any(results)
+
+
+@pytest.mark.usefixtures("_switch_threads_often")
+@pytest.mark.parametrize("store_class", [MemoryNonceStore, RedisNonceStore])
+def test_nonce_is_accepted_once_across_threads(store_class):
+    store = store_class()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: store.seen("read-only", "abc"), range(64)))
+
+    assert results.count(False) == 1
+
+
+def test_redis_nonces_are_shared_between_processes():
+    RedisNonceStore().seen("read-only", "abc")
+
+    assert RedisNonceStore().seen("read-only", "abc")
+    connection = get_redis_connection("default")
+    assert connection.get("legal-basis:nonce:read-only:abc") == b"1"
+    assert 0 < connection.ttl("legal-basis:nonce:read-only:abc") <= NONCE_TIMEOUT
+
+
+def test_redis_is_not_asked_about_nonces_seen_by_this_process():
+    store = RedisNonceStore()
+    store.seen("read-only", "abc")
+
+    with mock.patch("server.apps.main.nonces.get_redis_connection") as connection:
+        assert store.seen("read-only", "abc")
+    connection.assert_not_called()
+
+
+def test_get_nonce_store(settings):
+    settings.HAWK_NONCE_STORE = "memory"
+    assert type(get_nonce_store()) is MemoryNonceStore
+    assert get_nonce_store() is get_nonce_store()
+
+    settings.HAWK_NONCE_STORE = "unknown"
+    with pytest.raises(ImproperlyConfigured):
+        get_nonce_store()
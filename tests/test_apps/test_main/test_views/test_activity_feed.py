@@ -0,0 +1,157 @@
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from actstream import action
+from django.contrib.contenttypes.models import ContentType
+from django.urls import reverse
+from mixer.backend.django import mixer
+
+from server.apps.main.feeds import W3CModelJSONActivityFeed
+from server.apps.main.models import Commit, Consent, LegalBasis
+
+
+class TestActivityFeed:
+    pytestmark = pytest.mark.django_db
+
+    @pytest.fixture(autouse=True)
+    def _disable_axes(self, settings):
+        """Stops anonymous requests being locked out as failed logins."""
+        settings.AXES_ENABLED = False
+
+    @pytest.fixture
+    def url(self):
+        content_type = ContentType.objects.get_for_model(LegalBasis)
+        return reverse("actstream_model_feed_json", kwargs={"content_type_id": content_type.pk})
+
+    @pytest.fixture(autouse=True)
+    def _actions(self, admin_user):
+        commit = mixer.blend(Commit)
+        for i in range(15):
+            legal_basis = LegalBasis.objects.create(
+                email=f"user{i}@example.com", key_type="email", commit=commit,
+            )
+            action.send(admin_user, verb="Create", action_object=legal_basis)
+
+    def test_default_page(self, client, url):
+        response = client.get(url).json()
+
+        assert response["totalItems"] == 15
+        assert len(response["orderedItems"]) == 10
+        assert "cursor" in parse_qs(urlparse(response["next"]).query)
+
+    def test_page_size_is_kept_when_following_next(self, client, url):
+        response = client.get(url, {"page_size": 4, "count": "none"}).json()
+        seen = len(response["orderedItems"])
+        assert seen == 4
+        assert "totalItems" not in response
+
+        while "next" in response:
+            assert parse_qs(urlparse(response["next"]).query)["page_size"] == ["4"]
+            response = client.get(response["next"]).json()
+            assert "totalItems" not in response
+            seen += len(response["orderedItems"])
+
+        assert seen == 15
+
+    def test_page_size_is_capped(self, client, url, settings):
+        settings.ACTIVITY_FEED_MAX_PAGE_SIZE = 12
+
+        response = client.get(url, {"page_size": 1000}).json()
+
+        assert len(response["orderedItems"]) == 12
+
+    def test_invalid_page_size_uses_the_default(self, client, url):
+        response = client.get(url, {"page_size": "lots"}).json()
+
+        assert len(response["orderedItems"]) == 10
+
+    def test_count_is_cached(self, client, url, settings):
+        settings.ACTIVITY_FEED_COUNT_MODE = "cached"
+        assert client.get(url).json()["totalItems"] == 15
+        action.send(LegalBasis.objects.first(), verb="Update")
+
+        assert client.get(url).json()["totalItems"] == 15
+        assert client.get(url, {"count": "exact"}).json()["totalItems"] == 16
+
+    def test_count_can_be_estimated(self, client, url):
+        response = client.get(url, {"count": "estimate"}).json()
+
+        assert isinstance(response["totalItems"], int)
+
+    @pytest.mark.parametrize("page_size", [5, 15])
+    def test_page_queries_do_not_grow_with_page_size(
+        self, client, url, admin_user, page_size, django_assert_max_num_queries,
+    ):
+        consent = mixer.blend(Consent)
+        for legal_basis in LegalBasis.objects.all():
+            action.send(admin_user, verb="Add", action_object=consent, target=legal_basis)
+
+        # The content type, the actions, the users, the consents, and the legal
+        # bases that are action objects and targets
+        with mock.patch("actstream.settings.FETCH_RELATIONS", False):
+            with django_assert_max_num_queries(6):
+                response = client.get(url, {"page_size": page_size, "count": "none"})
+
+        assert len(response.json()["orderedItems"]) == page_size
+
+    def test_pages_behind_the_head_are_cached(self, client, url, settings, django_assert_num_queries):
+        settings.ACTIVITY_FEED_PAGE_SETTLE_TIME = 0
+        first = client.get(url, {"page_size": 4, "count": "none"}).json()
+        second = client.get(first["next"])
+
+        # Just the content type
+        with django_assert_num_queries(1):
+            cached = client.get(first["next"])
+        assert cached.content == second.content
+        assert cached.json()["orderedItems"] == second.json()["orderedItems"]
+
+    def test_pages_with_recent_actions_are_not_cached(self, client, url):
+        first = client.get(url, {"page_size": 4, "count": "none"}).json()
+        client.get(first["next"])
+
+        with mock.patch("server.apps.main.feeds.cache.set") as cache_set:
+            client.get(first["next"])
+        cache_set.assert_not_called()
+
+    def test_the_head_is_not_cached(self, client, url, admin_user):
+        first = client.get(url).json()
+        action.send(admin_user, verb="Delete", action_object=LegalBasis.objects.first())
+
+        assert client.get(url).json()["orderedItems"][0]["type"] == "Delete"
+        assert first["orderedItems"][0]["type"] == "Create"
+
+    def test_pretty_page(self, client, url):
+        response = client.get(url, {"pretty": ""})
+
+        assert response.content.startswith(b'{\n    "@context"')
+        assert len(response.json()["orderedItems"]) == 10
+
+    def test_unchanged_page_is_not_modified(self, client, url):
+        response = client.get(url)
+        assert response.status_code == 200
+
+        not_modified = client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+
+        assert not_modified.status_code == 304
+        assert not_modified.content == b""
+
+    def test_not_modified_is_answered_before_counting(self, client, url):
+        response = client.get(url)
+
+        with mock.patch.object(W3CModelJSONActivityFeed, "get_total_items") as get_total_items:
+            not_modified = client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+
+        assert not_modified.status_code == 304
+        assert not_modified["ETag"] == response["ETag"]
+        get_total_items.assert_not_called()
+
+    def test_etag_does_not_change_with_the_count(self, client, url, admin_user):
+        first = client.get(url, {"page_size": 4}).json()
+        second = client.get(first["next"])
+        action.send(admin_user, verb="Delete", action_object=LegalBasis.objects.first())
+
+        again = client.get(first["next"], HTTP_IF_NONE_MATCH=second["ETag"])
+
+        assert again.status_code == 304
+        assert client.get(first["next"]).json()["totalItems"] == 16
@@ -1,9 +1,13 @@
 from django.contrib.auth.models import Group, Permission, User
 from django.urls import reverse
+from mixer.backend.django import mixer
+from mohawk import Sender
 from requests_hawk import HawkAuth
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APILiveServerTestCase, RequestsClient
 
+from server.apps.main.models import LegalBasis
+
 
 class TestHawkAuth(APILiveServerTestCase):
     def setUp(self):
@@ -58,3 +62,70 @@ class TestHawkAuth(APILiveServerTestCase):
             auth=hawk_auth,
         )
         assert response.status_code == 200
+
+    def test_response_is_signed(self):
+        token = Token.objects.create(user=self.user, key='valid-user-key')
+        sender = Sender(
+            {'id': self.user.username, 'key': token.key, 'algorithm': 'sha256'},
+            self.url,
+            'GET',
+            content='',
+            content_type='',
+        )
+        response = self.client.get(
+            self.url,
+            headers={'Authorization': sender.request_header},
+        )
+        assert response.status_code == 200
+        # Raises if the signature or payload hash doesn't match the body
+        sender.accept_response(
+            response.headers['Server-Authorization'],
+            content=response.content,
+            content_type=response.headers['Content-Type'],
+        )
+
+    def _get_signed(self, url, **headers):
+        token, _ = Token.objects.get_or_create(user=self.user, key='valid-user-key')
+        sender = Sender(
+            {'id': self.user.username, 'key': token.key, 'algorithm': 'sha256'},
+            url,
+            'GET',
+            content='',
+            content_type='',
+        )
+        response = self.client.get(
+            url,
+            headers={'Authorization': sender.request_header, **headers},
+        )
+        return sender, response
+
+    def test_streaming_response_is_signed_with_its_payload(self):
+        mixer.cycle(3).blend(LegalBasis, email=mixer.sequence('user{0}@bar.com'), key=None, phone='')
+        url = 'http://testserver' + reverse(
+            'v1:legalbasis-datahub-export-stream', kwargs={'export_format': 'ndjson'},
+        )
+
+        # Small enough for the body to be spooled to disk
+        with self.settings(HAWK_RESPONSE_SPOOL_MAX_MEMORY=16):
+            sender, response = self._get_signed(url)
+
+        assert response.status_code == 200
+        assert len(response.content.splitlines()) == 3
+        assert 'hash=' in response.headers['Server-Authorization']
+        sender.accept_response(
+            response.headers['Server-Authorization'],
+            content=response.content,
+            content_type=response.headers['Content-Type'],
+        )
+
+    def test_payload_hash_can_be_skipped(self):
+        sender, response = self._get_signed(self.url, **{'X-Hawk-Skip-Payload-Hash': 'true'})
+
+        assert response.status_code == 200
+        assert 'hash=' not in response.headers['Server-Authorization']
+        sender.accept_response(
+            response.headers['Server-Authorization'],
+            content=response.content,
+            content_type=response.headers['Content-Type'],
+            accept_untrusted_content=True,
+        )
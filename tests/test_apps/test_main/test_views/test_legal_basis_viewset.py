@@ -1,11 +1,17 @@
+import base64
 import json
 
 import mohawk
 import pytest
+from actstream.models import Action
+from django.core.cache import cache
 from django.urls import reverse
 from mixer.backend.django import mixer
 
-from server.apps.main.models import LegalBasis
+from server.apps.api.serializers import LegalBasisDataWorkspaceSerializer
+from server.apps.api.views.legal_basis import LegalBasisViewSet
+from server.apps.main.lookup_cache import lookup_cache_key
+from server.apps.main.models import Commit, Consent, LegalBasis
 
 
 class TestLegalBasisViewSet:
@@ -47,6 +53,86 @@ class TestLegalBasisViewSet:
         assert response.data['count'] > 1
         assert len(response.data['results']) == 1
 
+    def test_list_endpoint_paging_without_count(self, read_only_client):
+        """Tests pagination of results when the count is omitted."""
+        mixer.cycle(2).blend(
+            LegalBasis, consents__name=mixer.sequence("email_{0}"), key=None, phone=''
+        )
+
+        url = reverse('v1:legalbasis-list') + '?limit=1&count=none'
+        response = read_only_client.get(
+            url,
+            HTTP_AUTHORIZATION=self._get_hawk_header('read-only', url),
+        )
+
+        assert response.status_code == 200
+        assert 'count' not in response.data
+        assert len(response.data['results']) == 1
+        assert 'offset=1' in response.data['next']
+
+        url = reverse('v1:legalbasis-list') + '?limit=1&offset=1&count=none'
+        response = read_only_client.get(
+            url,
+            HTTP_AUTHORIZATION=self._get_hawk_header('read-only', url),
+        )
+
+        assert len(response.data['results']) == 1
+        assert response.data['next'] is None
+        assert response.data['previous'] is not None
+
+    @pytest.mark.parametrize('count_mode', ['estimate', 'cached'])
+    def test_list_endpoint_paging_with_approximate_count(self, read_only_client, count_mode):
+        mixer.cycle(2).blend(
+            LegalBasis, consents__name=mixer.sequence("email_{0}"), key=None, phone=''
+        )
+
+        url = reverse('v1:legalbasis-list') + f'?limit=1&count={count_mode}'
+        response = read_only_client.get(
+            url,
+            HTTP_AUTHORIZATION=self._get_hawk_header('read-only', url),
+        )
+
+        assert response.status_code == 200
+        assert isinstance(response.data['count'], int)
+        assert len(response.data['results']) == 1
+        assert response.data['next'] is not None
+
+    def test_list_endpoint_cursor_paging(self, read_only_client):
+        """Tests keyset pagination of results."""
+        objs = mixer.cycle(3).blend(
+            LegalBasis, consents__name=mixer.sequence("email_{0}"), key=None, phone=''
+        )
+
+        url = reverse('v1:legalbasis-list') + '?pagination=cursor&limit=2'
+        response = read_only_client.get(
+            url,
+            HTTP_AUTHORIZATION=self._get_hawk_header('read-only', url),
+        )
+
+        assert response.status_code == 200
+        assert 'count' not in response.data
+        assert [result['id'] for result in response.data['results']] == [objs[0].id, objs[1].id]
+        assert response.data['next'].startswith('http://testserver/')
+
+        url = response.data['next'].replace(self.test_domain, '')
+        response = read_only_client.get(
+            url,
+            HTTP_AUTHORIZATION=self._get_hawk_header('read-only', url),
+        )
+
+        assert response.status_code == 200
+        assert [result['id'] for result in response.data['results']] == [objs[2].id]
+        assert response.data['next'] is None
+
+    def test_list_endpoint_invalid_cursor(self, read_only_client):
+        url = reverse('v1:legalbasis-list') + '?pagination=cursor&cursor=not-a-cursor'
+        response = read_only_client.get(
+            url,
+            HTTP_AUTHORIZATION=self._get_hawk_header('read-only', url),
+        )
+
+        assert response.status_code == 404
+
     def test_bulk_lookup_endpoint(self, read_write_client):
         """Test bulk lookup endpoint."""
         emails = ['foo_0@bar.com', 'foo_1@bar.com']
@@ -101,6 +187,49 @@ class TestLegalBasisViewSet:
         assert response.data["count"] == 1
         assert len(response.data["results"][0]["consents"]) == 1
 
+    def _get_detail(self, client, email):
+        url = reverse("v1:legalbasis-detail", kwargs={"key": email})
+        return client.get(url, HTTP_AUTHORIZATION=self._get_hawk_header('read-only', url))
+
+    def test_retrieve_is_cached(self, read_only_client):
+        lb = mixer.blend(LegalBasis, email="foo@bar.com", key_type="email", key=None, phone="")
+
+        response = self._get_detail(read_only_client, "FOO@bar.com")
+        assert response.status_code == 200
+        assert cache.get(lookup_cache_key(lb.key)) == response.data
+
+        # Queryset updates send no signals, so the cached record is still served
+        LegalBasis.objects.filter(pk=lb.pk).update(key_type="phone")
+        response = self._get_detail(read_only_client, "foo@bar.com")
+        assert response.data["key_type"] == "email"
+
+    def test_retrieve_cache_is_invalidated_by_changes(self, read_only_client):
+        lb = mixer.blend(LegalBasis, email="foo@bar.com", consents=[], key=None, phone="")
+        consent = mixer.blend(Consent, name="email_marketing")
+        self._get_detail(read_only_client, "foo@bar.com")
+
+        lb.consents.add(consent)
+        response = self._get_detail(read_only_client, "foo@bar.com")
+        assert response.data["consents"] == ["email_marketing"]
+
+        consent.legalbasis_set.clear()
+        response = self._get_detail(read_only_client, "foo@bar.com")
+        assert response.data["consents"] == []
+
+        newer = LegalBasis.objects.bulk_record(
+            [(LegalBasis(email="foo@bar.com", key_type="email", commit=lb.commit), [consent])]
+        )[0]
+        response = self._get_detail(read_only_client, "foo@bar.com")
+        assert response.data["id"] == newer.id
+
+    def test_retrieve_unknown_email_is_not_cached(self, read_only_client):
+        response = self._get_detail(read_only_client, "foo@bar.com")
+        assert response.status_code == 404
+
+        lb = mixer.blend(LegalBasis, email="foo@bar.com", key=None, phone="")
+        response = self._get_detail(read_only_client, "foo@bar.com")
+        assert response.data["id"] == lb.id
+
     def test_read_write_user_can_write(self, read_write_client):
         mixer.blend(LegalBasis, consents__name="email", key=None, phone="")
         legal_basis_count = LegalBasis.objects.all().count()
@@ -209,6 +338,82 @@ class TestLegalBasisViewSet:
         assert response.data["count"] == 1
         assert response.data["results"][0]["id"] == lb.id
 
+    def test_datahub_export_serializes_flags_without_prefetching(self, django_assert_num_queries):
+        consent = mixer.blend(Consent, name="email_marketing")
+        mixer.cycle(3).blend(LegalBasis, consents=[consent], key=None, phone="")
+        queryset = LegalBasis.objects.with_consent_flags(["email_marketing", "phone_marketing"])
+
+        with django_assert_num_queries(1):
+            data = LegalBasisDataWorkspaceSerializer(queryset, many=True).data
+
+        assert [row["email_marketing_consent"] for row in data] == [True] * 3
+        assert [row["phone_marketing_consent"] for row in data] == [False] * 3
+
+    def test_read_write_datahub_export_cursor_paging(self, read_write_client):
+        lb = mixer.blend(LegalBasis, consents__name="email", key=None, phone="")
+        url = reverse("v1:legalbasis-datahub-export") + "?pagination=cursor"
+        response = read_write_client.get(
+            url,
+            HTTP_AUTHORIZATION=self._get_hawk_header('read-write', url),
+        )
+        assert response.status_code == 200
+        assert response.data["next"] is None
+        assert response.data["results"][0]["id"] == lb.id
+
+    def test_datahub_export_ndjson_matches_paged_export(self, read_write_client):
+        consent = mixer.blend(Consent, name="email_marketing")
+        lb1 = mixer.blend(LegalBasis, consents=[consent], key=None, phone="")
+        lb2 = mixer.blend(LegalBasis, consents=[], key=None, email="", phone="+447897395794")
+
+        url = reverse("v1:legalbasis-datahub-export-stream", kwargs={"export_format": "ndjson"})
+        response = read_write_client.get(
+            url,
+            HTTP_AUTHORIZATION=self._get_hawk_header('read-write', url),
+        )
+        assert response.status_code == 200
+        assert response["Content-Type"] == "application/x-ndjson"
+        assert "Server-Authorization" in response
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+        url = reverse("v1:legalbasis-datahub-export")
+        paged = read_write_client.get(
+            url,
+            HTTP_AUTHORIZATION=self._get_hawk_header('read-write', url),
+        ).json()["results"]
+
+        assert [row["id"] for row in rows] == [lb1.id, lb2.id]
+        assert rows == paged
+        assert rows[0]["email_marketing_consent"] is True
+        assert rows[1]["email_marketing_consent"] is False
+
+    def test_datahub_export_csv(self, read_write_client):
+        consent = mixer.blend(Consent, name="phone_marketing")
+        lb = mixer.blend(LegalBasis, consents=[consent], key=None, email="", phone="+447897395794")
+
+        url = reverse("v1:legalbasis-datahub-export-stream", kwargs={"export_format": "csv"})
+        response = read_write_client.get(
+            url,
+            HTTP_AUTHORIZATION=self._get_hawk_header('read-write', url),
+        )
+        assert response.status_code == 200
+        header, row = b"".join(response.streaming_content).decode().splitlines()
+        assert header.split(",") == [
+            "id", "key", "email", "phone", "key_type", "created_at", "modified_at",
+            "current", "email_marketing_consent", "phone_marketing_consent",
+        ]
+        values = row.split(",")
+        assert values[0] == str(lb.id)
+        assert values[3] == "+447897395794"
+        assert values[-2:] == ["False", "True"]
+
+    def test_write_only_datahub_export_stream(self, write_only_client):
+        url = reverse("v1:legalbasis-datahub-export-stream", kwargs={"export_format": "ndjson"})
+        response = write_only_client.get(
+            url,
+            HTTP_AUTHORIZATION=self._get_hawk_header('write-only', url),
+        )
+        assert response.status_code == 403
+
     def test_read_write_bulk_lookup(self, read_write_client):
         lb1 = mixer.blend(LegalBasis, consents__name="email", key=None, phone="")
         mixer.blend(LegalBasis, consents__name="phone", key=None, email="")
@@ -229,3 +434,118 @@ class TestLegalBasisViewSet:
             HTTP_AUTHORIZATION=self._get_hawk_header('write-only', url),
         )
         assert response.status_code == 403
+
+    def _post(self, client, username, url, data):
+        return client.post(
+            url,
+            data=data,
+            content_type='application/json',
+            HTTP_AUTHORIZATION=self._get_hawk_header(
+                username,
+                url,
+                method='POST',
+                content=json.dumps(data),
+                content_type='application/json',
+            ),
+        )
+
+    def test_bulk_create(self, read_write_client, django_capture_on_commit_callbacks):
+        mixer.blend(Consent, name="email")
+        mixer.blend(Consent, name="phone")
+        commit_count = Commit.objects.count()
+        url = reverse("v1:legalbasis-bulk-create")
+        data = [
+            {"email": "first@example.com", "consents": ["email"]},
+            {"phone": "+447897395794", "consents": ["phone"]},
+            {"email": "first@example.com", "consents": [], "modified_at": "2099-01-01T00:00:00Z"},
+        ]
+        with django_capture_on_commit_callbacks(execute=True):
+            response = self._post(read_write_client, 'read-write', url, data)
+
+        assert response.status_code == 201
+        assert [item["email"] for item in response.data] == ["first@example.com", "", "first@example.com"]
+        assert [item["consents"] for item in response.data] == [["email"], ["phone"], []]
+        assert Commit.objects.count() == commit_count + 1
+        assert LegalBasis.objects.count() == 3
+        current = LegalBasis.objects.get(email="first@example.com", current=True)
+        assert current.id == response.data[2]["id"]
+        assert Action.objects.filter(verb="Create").count() == 3
+        assert Action.objects.filter(verb="Add").count() == 2
+
+    def test_bulk_create_returns_per_item_errors(self, read_write_client):
+        url = reverse("v1:legalbasis-bulk-create")
+        data = [
+            {"email": "valid@example.com", "consents": []},
+            {"email": "not-an-email", "consents": []},
+        ]
+        response = self._post(read_write_client, 'read-write', url, data)
+
+        assert response.status_code == 400
+        assert response.data[0] == {}
+        assert "email" in response.data[1]
+        assert LegalBasis.objects.count() == 0
+
+    def test_bulk_create_limits_items(self, read_write_client, settings):
+        settings.LEGAL_BASIS_BULK_CREATE_MAX_ITEMS = 1
+        url = reverse("v1:legalbasis-bulk-create")
+        data = [
+            {"email": "first@example.com", "consents": []},
+            {"email": "second@example.com", "consents": []},
+        ]
+        response = self._post(read_write_client, 'read-write', url, data)
+
+        assert response.status_code == 400
+        assert LegalBasis.objects.count() == 0
+
+    def test_read_only_user_cannot_bulk_create(self, read_only_client):
+        url = reverse("v1:legalbasis-bulk-create")
+        data = [{"email": "first@example.com", "consents": []}]
+        response = self._post(read_only_client, 'read-only', url, data)
+
+        assert response.status_code == 403
+        assert LegalBasis.objects.count() == 0
+
+    def test_post_bulk_lookup_returns_request_order(self, read_only_client, monkeypatch):
+        monkeypatch.setattr(LegalBasisViewSet, "bulk_lookup_chunk_size", 2)
+        consent = mixer.blend(Consent, name="email_marketing")
+        by_email = mixer.blend(LegalBasis, email="foo@bar.com", consents=[consent], key=None, phone="")
+        by_phone = mixer.blend(LegalBasis, email="", key=None, phone="+447897395794")
+        by_key = mixer.blend(LegalBasis, email="baz@bar.com", key=None, phone="")
+        mixer.blend(LegalBasis, email="other@bar.com", key=None, phone="")
+
+        response = self._post(
+            read_only_client,
+            "read-only",
+            reverse("v1:legalbasis-bulk-lookup"),
+            {
+                "emails": ["missing@bar.com", "FOO@bar.com"],
+                "phones": ["+447897395794"],
+                "keys": [base64.b64encode(by_key.key).decode(), base64.b64encode(by_email.key).decode()],
+            },
+        )
+
+        assert response.status_code == 200
+        assert [record["id"] for record in response.data] == [by_email.id, by_phone.id, by_key.id]
+        assert response.data[0]["consents"] == ["email_marketing"]
+
+    def test_post_bulk_lookup_validation(self, read_only_client, settings):
+        settings.LEGAL_BASIS_BULK_LOOKUP_MAX_ITEMS = 2
+        url = reverse("v1:legalbasis-bulk-lookup")
+
+        response = self._post(read_only_client, "read-only", url, {"emails": []})
+        assert response.status_code == 400
+
+        response = self._post(read_only_client, "read-only", url, {"keys": ["not-a-key"]})
+        assert response.status_code == 400
+        assert "keys" in response.data
+
+        response = self._post(
+            read_only_client, "read-only", url, {"emails": ["a@bar.com", "b@bar.com"], "phones": ["+447897395794"]}
+        )
+        assert response.status_code == 400
+
+    def test_write_only_user_cannot_post_bulk_lookup(self, write_only_client):
+        response = self._post(
+            write_only_client, "write-only", reverse("v1:legalbasis-bulk-lookup"), {"emails": ["foo@bar.com"]}
+        )
+        assert response.status_code == 403
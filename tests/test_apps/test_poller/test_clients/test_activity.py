@@ -0,0 +1,65 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from server.apps.poller.api_client.activity import PagePrefetcher
+
+
+def make_page(*sort_values):
+    page = mock.MagicMock()
+    page.hits.__len__.return_value = len(sort_values)
+    page.to_dict.return_value = {"hits": {"hits": [{"sort": sort} for sort in sort_values]}}
+    return page
+
+
+class FakeStream:
+    """Pages of two hits each, with the search_after each page was fetched with"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requested = []
+
+    def get_documents(self, search_after):
+        self.requested.append(search_after)
+        if len(self.requested) > self.pages:
+            return make_page()
+        n = len(self.requested)
+        return make_page((n, f"{n}-a"), (n, f"{n}-b"))
+
+
+class TestPagePrefetcher:
+    def test_pages_are_yielded_in_order(self):
+        stream = FakeStream(pages=3)
+
+        with PagePrefetcher(stream.get_documents, (0, "start"), depth=2) as pages:
+            last_sorts = [page.to_dict()["hits"]["hits"][-1]["sort"] for page in pages]
+
+        assert last_sorts == [(1, "1-b"), (2, "2-b"), (3, "3-b")]
+        assert stream.requested == [(0, "start"), (1, "1-b"), (2, "2-b"), (3, "3-b")]
+
+    def test_fetching_stays_within_the_depth(self):
+        stream = FakeStream(pages=10)
+        fetched_ahead = threading.Event()
+
+        def get_documents(search_after):
+            page = stream.get_documents(search_after)
+            if len(stream.requested) == 3:
+                fetched_ahead.set()
+            return page
+
+        with PagePrefetcher(get_documents, None, depth=2) as pages:
+            assert fetched_ahead.wait(timeout=5)
+            # Two pages are queued, and the third waits for room in the queue
+            assert len(stream.requested) == 3
+            next(iter(pages))
+
+        assert len(stream.requested) <= 4
+
+    def test_fetch_errors_are_raised_to_the_caller(self):
+        def get_documents(search_after):
+            raise ConnectionError("activity stream unavailable")
+
+        with PagePrefetcher(get_documents, None) as pages:
+            with pytest.raises(ConnectionError):
+                next(iter(pages))
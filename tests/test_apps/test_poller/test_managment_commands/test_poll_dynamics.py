@@ -1,9 +1,14 @@
 import io
+from unittest.mock import patch
 
 import pytest
+from actstream.models import Action
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from mixer.backend.django import mixer
 
-from server.apps.main.models import Consent, LegalBasis
+from server.apps.main.models import Commit, Consent, LegalBasis
 from server.apps.poller.management.commands import poll_dynamics
 
 
@@ -77,3 +82,53 @@ class TestDynamicsCommand:
         out = io.StringIO()
         command = poll_dynamics.Command(stdout=out)
         assert command._should_update("test@example.co")
+
+    @staticmethod
+    def _run(consents, batch_size=1000):
+        with patch.object(poll_dynamics, "DynamicsClient") as client:
+            client.return_value.get_consents.return_value = [
+                {"email": email_address, "consent": consented}
+                for email_address, consented in consents
+            ]
+            call_command("poll_dynamics", batch_size=batch_size, stdout=io.StringIO())
+
+    def test_run_writes_consents_in_batches(self, django_user_model):
+        consent = mixer.blend(Consent, name="email_marketing")
+        LegalBasis.objects.create(
+            email="opted-in@bar.com", key_type="email", commit=mixer.blend(Commit)
+        ).consents.add(consent)
+
+        self._run(
+            [
+                ("opted-in@bar.com", True),
+                ("new@bar.com", True),
+                ("new@bar.com", False),
+                ("opted-out@bar.com", False),
+                ("opted-out@bar.com", False),
+            ],
+            batch_size=4,
+        )
+
+        current = LegalBasis.objects.filter(current=True)
+        assert sorted(current.values_list("email", flat=True)) == [
+            "new@bar.com", "opted-in@bar.com", "opted-out@bar.com",
+        ]
+        assert list(current.filter(consents=consent).values_list("email", flat=True)) == [
+            "opted-in@bar.com",
+        ]
+        assert LegalBasis.objects.filter(email="new@bar.com").count() == 2
+        dynamics_user = django_user_model.objects.get(username="dynamics")
+        assert Action.objects.filter(verb="Create", actor_object_id=dynamics_user.pk).count() == 3
+
+    def test_run_queries_dont_grow_with_the_batch(self):
+        mixer.blend(Consent, name="email_marketing")
+        # Loads the consents and creates the dynamics user
+        self._run([("first@bar.com", True)])
+
+        with CaptureQueriesContext(connection) as few:
+            self._run([(f"few{i}@bar.com", i % 2 == 0) for i in range(3)])
+        with CaptureQueriesContext(connection) as many:
+            self._run([(f"many{i}@bar.com", i % 2 == 0) for i in range(30)])
+
+        assert len(many) == len(few)
+        assert LegalBasis.objects.count() == 34
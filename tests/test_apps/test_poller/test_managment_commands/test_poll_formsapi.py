@@ -5,13 +5,22 @@ from unittest.mock import patch
 from unittest import mock
 
 import pytest
+from actstream.models import Action
 from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
 
-from server.apps.main.models import LegalBasis
+from server.apps.main.models import Commit, LegalBasis
+from server.apps.poller.management.commands.poll_formsapi import (
+    Command,
+    shard_for,
+    write_records,
+)
+from server.apps.poller.models import ActivityStreamType
 
 
 @contextmanager
-def mock_activity_stream(published):
+def mock_activity_stream(published, phone_number=None):
     class AttrDict(dict):
         def __init__(self, *args, **kwargs):
             super(AttrDict, self).__init__(*args, **kwargs)
@@ -34,14 +43,17 @@ def mock_activity_stream(published):
 
         no_consent_hit = mock.MagicMock()
         no_consent_hit.__contains__.side_effect = lambda key: key == 'object'
+        no_consent_data = AttrDict({
+            'email_address': 'foo@bar.com',
+            'contact_consent': [],
+        })
+        if phone_number:
+            no_consent_data['phone_number'] = phone_number
         no_consent_hit.object = {
-            'dit:directoryFormsApi:Submission:Data': AttrDict({
-                'email_address': 'foo@bar.com',
-                'contact_consent': [],
-            })
+            'dit:directoryFormsApi:Submission:Data': no_consent_data,
         }
         no_consent_hit.to_dict.return_value = {
-            'id': 'dit:directoryFormsApi:Submission:134212:Create',
+            'id': 'dit:directoryFormsApi:Submission:134211:Create',
             'url': '/international/trade/contact/',
             'published': '2009-02-13 11:18:05',
         }
@@ -61,9 +73,10 @@ def mock_activity_stream(published):
         }
         results.__iter__.return_value = [current_hit, no_consent_hit]
 
-        search_mock.return_value.filter.return_value.sort.return_value.execute.return_value = results
+        search = search_mock.return_value.filter.return_value.filter.return_value
+        search.source.return_value.sort.return_value.extra.return_value.execute.return_value = results
 
-        yield
+        yield search_mock.return_value
 
 
 class TestFormsAPICommand:
@@ -101,3 +114,194 @@ class TestFormsAPICommand:
         assert len(all_current_basis) == 1
         expected_value = datetime.datetime(2010, 2, 13, 11, 18, 5, tzinfo=datetime.timezone.utc)
         assert all_current_basis[0].modified_at == expected_value
+
+    def test_chunked_rerun(self, directory_forms_user):
+        with mock_activity_stream(published='2011-02-13 11:18:05'):
+            call_command("poll_formsapi")
+        other_source = LegalBasis.objects.create(
+            email='foo@bar.com',
+            key_type='email',
+            commit=Commit.objects.create(source='maxemail', extra={'id': 'maxemail:1'}),
+            modified_at=datetime.datetime(2010, 6, 1, tzinfo=datetime.timezone.utc),
+        )
+
+        with mock_activity_stream(published='2012-02-13 11:18:05'):
+            call_command("poll_formsapi_rerun", "--chunked", "--chunk-size", "1")
+
+        assert Commit.objects.count() == 3
+        assert LegalBasis.objects.count() == 3
+        current = LegalBasis.objects.get(current=True)
+        expected_value = datetime.datetime(2012, 2, 13, 11, 18, 5, tzinfo=datetime.timezone.utc)
+        assert current.modified_at == expected_value
+        assert LegalBasis.objects.filter(pk=other_source.pk).exists()
+
+    def test_chunked_rerun_resume_keeps_loaded_records(self, directory_forms_user):
+        with mock_activity_stream(published='2011-02-13 11:18:05'):
+            call_command("poll_formsapi", "--defer-current")
+        assert not LegalBasis.objects.filter(current=True).exists()
+
+        with mock_activity_stream(published='2011-02-13 11:18:05'):
+            call_command("poll_formsapi_rerun", "--chunked", "--resume")
+
+        assert LegalBasis.objects.count() == 2
+        assert LegalBasis.objects.filter(current=True).count() == 1
+
+    def test_only_parsed_fields_of_possible_consents_are_fetched(self, directory_forms_user):
+        with mock_activity_stream(published='2011-02-13 11:18:05') as search:
+            call_command("poll_formsapi", "--page-size", "250")
+
+        data = "object.dit:directoryFormsApi:Submission:Data"
+        search.filter.assert_called_with("term", object__type="dit:directoryFormsApi:Submission")
+        search = search.filter.return_value
+        exists_filter = search.filter.call_args.kwargs
+        assert {query.field for query in exists_filter["should"]} == {
+            f"{data}.email_contact_consent",
+            f"{data}.contact_consent",
+            f"{data}.email_address",
+            f"{data}.email",
+            f"{data}.phone_number",
+        }
+        search = search.filter.return_value
+        source_fields = search.source.call_args.args[0]
+        assert "id" in source_fields
+        assert f"{data}.email_address" in source_fields
+        assert f"{data}" not in source_fields
+        search.source.return_value.sort.return_value.extra.assert_any_call(size=250)
+
+    def test_page_is_written_with_its_checkpoint(self, directory_forms_user):
+        with mock_activity_stream(published='2011-02-13 11:18:05'):
+            call_command("poll_formsapi")
+
+        activity = ActivityStreamType.objects.get(name="dit:directoryFormsApi:Submission")
+        assert activity.search_after == (1234, "last-id")
+        assert Commit.objects.count() == 2
+        actions = list(Action.objects.all())
+        assert len(actions) == 2
+        assert {action.actor for action in actions} == {directory_forms_user[0]}
+        assert {action.action_object for action in actions} == set(LegalBasis.objects.all())
+
+    def test_failed_page_is_not_applied(self, directory_forms_user):
+        with mock_activity_stream(published='2011-02-13 11:18:05'):
+            with patch.object(LegalBasis.objects, "bulk_record", side_effect=RuntimeError):
+                with pytest.raises(RuntimeError):
+                    call_command("poll_formsapi")
+
+        activity = ActivityStreamType.objects.get(name="dit:directoryFormsApi:Submission")
+        assert activity.search_after is None
+        assert not Commit.objects.exists()
+
+    def test_replayed_page_is_not_applied_again(self, directory_forms_user):
+        with mock_activity_stream(published='2011-02-13 11:18:05'):
+            call_command("poll_formsapi")
+        # As if the run had stopped before saving its checkpoint
+        ActivityStreamType.objects.update(last_document_timestamp=None, last_document_id='')
+
+        with mock_activity_stream(published='2011-02-13 11:18:05'):
+            call_command("poll_formsapi")
+
+        assert Commit.objects.count() == 2
+        assert LegalBasis.objects.count() == 2
+        assert Action.objects.count() == 2
+        activity = ActivityStreamType.objects.get(name="dit:directoryFormsApi:Submission")
+        assert activity.search_after == (1234, "last-id")
+
+    def test_missing_records_are_added_to_an_applied_commit(self, directory_forms_user):
+        commit = Commit.objects.create(
+            source='/international/trade/contact/',
+            extra={'id': 'dit:directoryFormsApi:Submission:134212:Create'},
+        )
+
+        with mock_activity_stream(published='2011-02-13 11:18:05'):
+            call_command("poll_formsapi")
+
+        assert Commit.objects.count() == 2
+        assert commit.legalbasis_set.get().consents.get().name == 'email_marketing'
+
+    def test_documents_are_checked_in_one_query(self, directory_forms_user):
+        document_ids = [f'dit:directoryFormsApi:Submission:{i}:Create' for i in range(3)]
+        first = Commit.objects.create(source='/contact/', extra={'id': document_ids[0]})
+        LegalBasis.objects.create(email='foo@bar.com', key_type='email', commit=first)
+        second = Commit.objects.create(source='/contact/', extra={'id': document_ids[1]})
+
+        with CaptureQueriesContext(connection) as queries:
+            applied = Command.get_applied(document_ids)
+
+        assert len(queries) == 1
+        assert applied == {
+            document_ids[0]: (first.pk, ['email']),
+            document_ids[1]: (second.pk, [None]),
+        }
+
+    def test_document_can_only_be_committed_once(self):
+        Commit.objects.create(source='/contact/', extra={'id': 'dit:directoryFormsApi:Submission:1:Create'})
+
+        with pytest.raises(IntegrityError):
+            Commit.objects.create(source='/contact/', extra={'id': 'dit:directoryFormsApi:Submission:1:Create'})
+
+
+def write_records_failing_for_phones(records, actor, defer_current=False):
+    if any(obj.key_type == "phone" for obj, _ in records):
+        raise RuntimeError("Shard failed")
+    return write_records(records, actor, defer_current)
+
+
+class TestShardedFormsAPICommand:
+
+    pytestmark = pytest.mark.django_db(transaction=True)
+
+    def test_records_for_a_key_share_a_shard(self):
+        first = LegalBasis(email="Foo@Bar.com", key_type="email")
+        second = LegalBasis(email="foo@bar.com", key_type="email")
+        phone = LegalBasis(phone="+441234567890", key_type="phone")
+
+        assert shard_for(first, 4) == shard_for(second, 4)
+        assert 0 <= shard_for(phone, 4) < 4
+        assert len({
+            shard_for(LegalBasis(email=f"user{i}@example.com", key_type="email"), 4)
+            for i in range(100)
+        }) == 4
+
+    def test_page_is_written_by_workers(self, directory_forms_user):
+        with mock_activity_stream(published='2011-02-13 11:18:05'):
+            call_command("poll_formsapi", "--workers", "2")
+
+        all_current_basis = list(LegalBasis.objects.filter(current=True))
+        assert len(all_current_basis) == 1
+        assert all_current_basis[0].consents.get().name == 'email_marketing'
+        assert LegalBasis.objects.count() == 2
+        assert Action.objects.count() == 2
+        activity = ActivityStreamType.objects.get(name="dit:directoryFormsApi:Submission")
+        assert activity.search_after == (1234, "last-id")
+
+    def test_replayed_page_is_not_applied_again(self, directory_forms_user):
+        with mock_activity_stream(published='2011-02-13 11:18:05'):
+            call_command("poll_formsapi", "--workers", "2")
+        ActivityStreamType.objects.update(last_document_timestamp=None, last_document_id='')
+
+        with mock_activity_stream(published='2011-02-13 11:18:05'):
+            call_command("poll_formsapi", "--workers", "2")
+
+        assert Commit.objects.count() == 2
+        assert LegalBasis.objects.count() == 2
+        assert Action.objects.count() == 2
+
+    def test_failed_shard_leaves_the_page_unapplied(self, directory_forms_user):
+        email_shard = shard_for(LegalBasis(email="foo@bar.com", key_type="email"), 2)
+        phone_number = next(
+            number for number in (f"+4478973957{i:02}" for i in range(100))
+            if shard_for(LegalBasis(phone=number, key_type="phone"), 2) != email_shard
+        )
+
+        with mock_activity_stream(published='2011-02-13 11:18:05', phone_number=phone_number):
+            with patch(
+                "server.apps.poller.management.commands.poll_formsapi.write_records",
+                write_records_failing_for_phones,
+            ):
+                with pytest.raises(RuntimeError):
+                    call_command("poll_formsapi", "--workers", "2")
+
+        assert not LegalBasis.objects.exists()
+        assert not Commit.objects.exists()
+        assert not Action.objects.exists()
+        activity = ActivityStreamType.objects.get(name="dit:directoryFormsApi:Submission")
+        assert activity.search_after is None
@@ -1,11 +1,15 @@
 import io
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 import pytest
+from actstream.models import Action
 from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from mixer.backend.django import mixer
 
-from server.apps.main.models import Consent, LegalBasis
+from server.apps.main.models import Commit, Consent, LegalBasis
 from server.apps.poller.management.commands import poll_maxemail
 
 
@@ -69,3 +73,48 @@ class TestMaxemailCommand:
         out = io.StringIO()
         command = poll_maxemail.Command(stdout=out)
         assert command._should_update("foo@bar.com")
+
+    @staticmethod
+    def _run(email_addresses, batch_size=1000):
+        client = Mock()
+        client.get_unsubscribe_list.return_value = {"list_id": 1}
+        client.get_members_for_list.return_value = [
+            {"email_address": email_address} for email_address in email_addresses
+        ]
+        with patch.object(poll_maxemail.Command, "get_client", return_value=client):
+            call_command("poll_maxemail", batch_size=batch_size, stdout=io.StringIO())
+
+    def test_run_opts_out_in_batches(self, django_user_model):
+        consent = mixer.blend(Consent, name="email_marketing")
+        commit = mixer.blend(Commit)
+        LegalBasis.objects.create(
+            email="opted-in@bar.com", key_type="email", commit=commit
+        ).consents.add(consent)
+        LegalBasis.objects.create(email="opted-out@bar.com", key_type="email", commit=commit)
+
+        self._run(
+            ["opted-in@bar.com", "new@bar.com", "opted-out@bar.com", "new@bar.com", "other@bar.com"],
+            batch_size=2,
+        )
+
+        current = LegalBasis.objects.filter(current=True)
+        assert sorted(current.values_list("email", flat=True)) == [
+            "new@bar.com", "opted-in@bar.com", "opted-out@bar.com", "other@bar.com",
+        ]
+        assert not current.filter(consents=consent).exists()
+        assert LegalBasis.objects.count() == 5
+        maxemail_user = django_user_model.objects.get(username="maxemail")
+        assert Action.objects.filter(verb="Create", actor_object_id=maxemail_user.pk).count() == 3
+
+    def test_run_queries_dont_grow_with_the_batch(self):
+        mixer.blend(Consent, name="email_marketing")
+        # Loads the consents and creates the maxemail user
+        self._run(["first@bar.com"])
+
+        with CaptureQueriesContext(connection) as few:
+            self._run([f"few{i}@bar.com" for i in range(3)])
+        with CaptureQueriesContext(connection) as many:
+            self._run([f"many{i}@bar.com" for i in range(30)])
+
+        assert len(many) == len(few)
+        assert LegalBasis.objects.count() == 34